@@ -0,0 +1,96 @@
+"""
+🚦 التحكم في القبول على مسار الويب هوك: حد للتزامن وميزانية انتظار وأولويات للإسقاط
+"""
+
+import os
+import time
+import threading
+
+from metrics import Counter, Gauge, Histogram
+
+# ============================================================================
+# الإعدادات
+# ============================================================================
+
+# أقصى عدد تحديثات تعالج معاً في العامل (gunicorn.conf.py يشتقه من عدد الخيوط)
+ADMISSION_LIMIT = int(os.environ.get('ADMISSION_LIMIT', '8'))
+# أقصى عدد تحديثات تنتظر دورها، وأطول مدة انتظار قبل الإسقاط (بالثواني)
+ADMISSION_QUEUE = int(os.environ.get('ADMISSION_QUEUE', '4'))
+ADMISSION_BUDGET_S = float(os.environ.get('ADMISSION_BUDGET_S', '2'))
+# نسبة السعة المتاحة للتحديثات منخفضة الأولوية (لا تنتظر أبداً)
+ADMISSION_LOW_SHARE = float(os.environ.get('ADMISSION_LOW_SHARE', '0.5'))
+
+# الأولويات: الحرجة تسبق العادية في الطابور، والمنخفضة تُسقط أولاً
+CRITICAL = 'critical'
+NORMAL = 'normal'
+LOW = 'low'
+
+ADMISSIONS = Counter('webhook_admission_total', 'قرارات القبول في الويب هوك', ['priority', 'result'])
+ADMISSION_WAIT = Histogram('webhook_admission_wait_seconds', 'زمن انتظار التحديث قبل قبوله', ['priority'])
+ADMISSION_STATE = Gauge('webhook_admission_updates', 'التحديثات المقبولة والمنتظرة في العامل الحالي', ['state'])
+
+# ============================================================================
+# المتحكم
+# ============================================================================
+
+class AdmissionController:
+    """
+    يقبل التحديث فوراً إن كان تحت الحد، وإلا ينتظر في طابور محدود حتى
+    ميزانية الانتظار ثم يُسقط. المنخفضة الأولوية مقيدة بحصة من السعة ولا تنتظر.
+    """
+
+    def __init__(self, limit=ADMISSION_LIMIT, queue=ADMISSION_QUEUE,
+                 budget_s=ADMISSION_BUDGET_S, low_share=ADMISSION_LOW_SHARE):
+        self.limit = max(1, limit)
+        self.queue = max(0, queue)
+        self.budget_s = budget_s
+        self.low_limit = max(1, int(self.limit * low_share))
+        self.active = 0
+        self.waiting = {CRITICAL: 0, NORMAL: 0}
+        self._cond = threading.Condition()
+        ADMISSION_STATE.set_function(lambda: {
+            ('active',): self.active,
+            ('waiting',): sum(self.waiting.values()),
+        })
+
+    def _can_enter(self, priority):
+        """يوجد مكان لهذه الأولوية الآن (العادية تفسح الطريق للحرجة المنتظرة)"""
+        if priority == LOW:
+            return self.active < self.low_limit and not any(self.waiting.values())
+        if priority == NORMAL and self.waiting[CRITICAL]:
+            return False
+        return self.active < self.limit
+
+    def acquire(self, priority=NORMAL):
+        """طلب القبول؛ يعيد False إذا أُسقط التحديث (ويجب عدم استدعاء release)"""
+        start = time.monotonic()
+        with self._cond:
+            if not self._can_enter(priority):
+                if priority == LOW or sum(self.waiting.values()) >= self.queue:
+                    ADMISSIONS.inc(priority, 'shed')
+                    return False
+                self.waiting[priority] += 1
+                deadline = start + self.budget_s
+                try:
+                    while not self._can_enter(priority):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            ADMISSIONS.inc(priority, 'shed')
+                            # قد تكون العادية تنتظر خروج هذا التحديث من الطابور
+                            self._cond.notify_all()
+                            return False
+                        self._cond.wait(remaining)
+                finally:
+                    self.waiting[priority] -= 1
+                ADMISSIONS.inc(priority, 'queued')
+            else:
+                ADMISSIONS.inc(priority, 'admitted')
+            self.active += 1
+        ADMISSION_WAIT.observe(time.monotonic() - start, priority)
+        return True
+
+    def release(self):
+        """انتهاء معالجة تحديث مقبول"""
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
@@ -0,0 +1,56 @@
+"""
+📈 تحليلات الرحلات: إعدادات التجميع الساعي ورسم منحنيات لوحة التحكم بصيغة SVG
+"""
+
+import os
+from html import escape
+
+# ============================================================================
+# الإعدادات
+# ============================================================================
+
+# الفترة بين تجميعات أحداث الرحلات وأقصى عدد أحداث في التجميع الواحد
+ANALYTICS_ROLLUP_S = float(os.environ.get('ANALYTICS_ROLLUP_S', '60'))
+ANALYTICS_ROLLUP_BATCH = int(os.environ.get('ANALYTICS_ROLLUP_BATCH', '50000'))
+# عدد الأيام المعروضة في منحنيات لوحة التحكم
+ANALYTICS_CHART_DAYS = int(os.environ.get('ANALYTICS_CHART_DAYS', '14'))
+
+# ============================================================================
+# المنحنيات
+# ============================================================================
+
+def svg_line_chart(title, values, labels, color='#667eea', unit='', width=1100, height=180):
+    """منحنى خطي بسيط كصورة SVG مضمنة؛ القيم المفقودة (None) تقطع الخط"""
+    pad = 30
+    top = max((v for v in values if v is not None), default=0) or 1
+    step = (width - 2 * pad) / max(1, len(values) - 1)
+
+    segments, current = [], []
+    for index, value in enumerate(values):
+        if value is None:
+            if current:
+                segments.append(current)
+            current = []
+            continue
+        x = pad + index * step
+        y = height - pad - (value / top) * (height - 2 * pad)
+        current.append(f"{x:.1f},{y:.1f}")
+    if current:
+        segments.append(current)
+
+    lines = "".join(
+        f'<polyline fill="none" stroke="{color}" stroke-width="2" points="{" ".join(points)}"/>'
+        for points in segments
+    )
+    first = escape(labels[0]) if labels else ''
+    last = escape(labels[-1]) if labels else ''
+    return (
+        f'<div class="card"><h3>{escape(title)}</h3>'
+        f'<svg viewBox="0 0 {width} {height}" width="100%" role="img" direction="ltr">'
+        f'<line x1="{pad}" y1="{height - pad}" x2="{width - pad}" y2="{height - pad}" stroke="#ddd"/>'
+        f'{lines}'
+        f'<text x="{pad}" y="{pad - 10}" font-size="12" fill="#999">{top:g}{escape(unit)}</text>'
+        f'<text x="{pad}" y="{height - 8}" font-size="12" fill="#999">{first}</text>'
+        f'<text x="{width - pad}" y="{height - 8}" font-size="12" fill="#999" text-anchor="end">{last}</text>'
+        f'</svg></div>'
+    )
@@ -6,15 +6,37 @@ import os
 import logging
 import json
 import uuid
-from datetime import datetime, timedelta
+import time
+import math
+import functools
+import threading
+from datetime import datetime
 from flask import Flask, request, jsonify
+import requests
 import telebot
-from telebot import types
+from telebot import types, apihelper
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
+import numpy as np
 import psycopg2
-from psycopg2.pool import SimpleConnectionPool
-from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+from psycopg2.extras import execute_values
 from contextlib import contextmanager
+from metrics import Counter, Histogram, Gauge, REGISTRY, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from database import TimedCursor, TimedTupleCursor, QueryStats, SlowQueryLog, CircuitBreaker, DatabaseUnavailable
+from telegram_client import TelegramClient, TELEGRAM_CONNECT_TIMEOUT, TELEGRAM_READ_TIMEOUT
+from quoting import quote_drivers, driver_coordinates
+from surge import SurgePricing, SURGE_WINDOW_S
+from matching import BatchMatcher
+from tracking import RideTrace, Throttle
+from presence import DriverPresence, PRESENCE_TTL_S
+from dedupe import UpdateDeduplicator, DEDUPE_BACKEND, DEDUPE_RETENTION_HOURS
+from admission import AdmissionController, CRITICAL, NORMAL, LOW
+from ratelimit import RateLimiter
+from outbox import OutboxDispatcher, PermanentError, RetryAfter
+from jobs import PeriodicJob
+from ledger import BalanceCache, LEDGER_ROLLUP_S, LEDGER_ROLLUP_BATCH
+from models import User, Ride, ActiveDriver
+from analytics import ANALYTICS_ROLLUP_S, ANALYTICS_ROLLUP_BATCH, ANALYTICS_CHART_DAYS, svg_line_chart
 
 # ============================================================================
 # إعدادات أساسية
@@ -31,13 +53,80 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# الحصول على التوكن من Environment Variables
-BOT_TOKEN = os.environ.get('BOT_TOKEN', 8314762629:AAFewIWyTZmANrnkaSyUZHUiDU0NmioJayo')
+# الحصول على التوكن من Environment Variables (إلزامي، لا قيمة افتراضية)
+BOT_TOKEN = os.environ['BOT_TOKEN']
 DATABASE_URL = os.environ.get('DATABASE_URL', '')
 
+# حجم تجمع اتصالات قاعدة البيانات لكل عامل (يجب ألا يقل عن عدد الخيوط)
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '10'))
+# أقصى انتظار لاتصال حر عند امتلاء التجمع (بالثواني)
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '5'))
+
+# نسخة قراءة متماثلة اختيارية للاستعلامات الثقيلة (لوحة التحكم، السجلات، مرشحو التوزيع)
+DATABASE_REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL', '')
+DB_REPLICA_POOL_MAX = int(os.environ.get('DB_REPLICA_POOL_MAX', str(DB_POOL_MAX)))
+# أقصى تأخر مقبول للنسخة المتماثلة قبل الرجوع للرئيسية، والفترة بين فحوص التأخر (بالثواني)
+REPLICA_MAX_LAG_S = float(os.environ.get('REPLICA_MAX_LAG_S', '2'))
+REPLICA_LAG_CHECK_S = float(os.environ.get('REPLICA_LAG_CHECK_S', '1'))
+
+# قاطع دائرة قاعدة البيانات: يفتح عند تجاوز نسبة الفشل في النافذة (بعد حد أدنى من الاستدعاءات)
+DB_BREAKER_WINDOW_S = float(os.environ.get('DB_BREAKER_WINDOW_S', '10'))
+DB_BREAKER_MIN_CALLS = int(os.environ.get('DB_BREAKER_MIN_CALLS', '20'))
+DB_BREAKER_FAILURE_RATE = float(os.environ.get('DB_BREAKER_FAILURE_RATE', '0.5'))
+# مدة الرفض الفوري قبل السماح باستدعاء اختباري (بالثواني)
+DB_BREAKER_OPEN_S = float(os.environ.get('DB_BREAKER_OPEN_S', '5'))
+
+# إعدادات مراقبة الاستعلامات
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '200'))
+EXPLAIN_SAMPLE_RATE = float(os.environ.get('EXPLAIN_SAMPLE_RATE', '0'))
+
+# توزيع الطلبات: عدد السائقين المرشحين للتسعير وعدد العروض المرسلة لأقربهم
+DISPATCH_CANDIDATES = int(os.environ.get('DISPATCH_CANDIDATES', '500'))
+DISPATCH_MAX_OFFERS = int(os.environ.get('DISPATCH_MAX_OFFERS', '10'))
+# نصف ضلع مربع البحث حول نقطة الالتقاط (بالكيلومتر)؛ يجب أن يغطي خلية الذروة كاملة
+DISPATCH_RADIUS_KM = float(os.environ.get('DISPATCH_RADIUS_KM', '5'))
+# وضع التوزيع: broadcast = عرض الطلب على أقرب السائقين وأول قبول يفوز،
+# batch = تجميع الطلبات خلال نافذة قصيرة وتعيين سائق واحد لكل رحلة بأقل مسافة إجمالية
+DISPATCH_MODE = os.environ.get('DISPATCH_MODE', 'broadcast')
+# مدة مشاركة موقع السائق المباشر مع العميل (بالثواني، بين 60 و 86400)
+LIVE_SHARE_PERIOD_S = int(os.environ.get('LIVE_SHARE_PERIOD_S', '3600'))
+# مدة الاحتفاظ بعروض الأسعار المرسلة للسائقين (بالثواني)
+QUOTE_TTL = int(os.environ.get('QUOTE_TTL', '900'))
+
+# مطابقة إحصائيات السائقين اليومية مع جدول الرحلات: عدد الأيام المكتملة المعاد حسابها
+# (لا تتجاوز مدة الاحتفاظ بالرحلات) والفترة بين فحوص موعد المطابقة الليلية
+STATS_RECONCILE_DAYS = int(os.environ.get('STATS_RECONCILE_DAYS', '7'))
+STATS_RECONCILE_CHECK_S = float(os.environ.get('STATS_RECONCILE_CHECK_S', '3600'))
+
+# الفترة بين عمليات تنظيف البيانات القديمة (نافذة منع التكرار، صندوق الصادر، الرحلات)
+CLEANUP_INTERVAL_S = float(os.environ.get('CLEANUP_INTERVAL_S', '3600'))
+
+# تعبئة مجاميع التقييم من الرحلات القديمة: عدد المستخدمين في الدفعة والفترة بين الدفعات
+RATING_BACKFILL_BATCH = int(os.environ.get('RATING_BACKFILL_BATCH', '500'))
+RATING_BACKFILL_S = float(os.environ.get('RATING_BACKFILL_S', '10'))
+
+# إرجاع أول رد مؤهل داخل استجابة الويب هوك (يتطلب معالجة التحديث داخل الطلب)
+INLINE_WEBHOOK_REPLY = os.environ.get('INLINE_WEBHOOK_REPLY', '0') == '1'
+
+# معالجة التحديث داخل طلب الويب هوك بدلاً من طابور خيوط telebot
+# (مفعل تلقائياً مع gunicorn حيث توفر خيوط gthread التزامن)
+PROCESS_IN_REQUEST = INLINE_WEBHOOK_REPLY or os.environ.get('PROCESS_IN_REQUEST', '0') == '1'
+
+# وضع الإقلاع: full = ترحيل المخطط وتسجيل الويب هوك (مرة واحدة بقفل استشاري)،
+# worker = فحص سريع لإصدار المخطط فقط (الترحيل يتم عبر: python app.py migrate)
+BOOT_MODE = os.environ.get('BOOT_MODE', 'full')
+
+# وضع التنفيذ: threads = خيط لكل تحديث، gevent = حلقة أحداث تعاونية لنفس المعالجات
+# (الترقيع يتم في gunicorn.conf.py قبل استيراد التطبيق)
+EXECUTION_MODE = os.environ.get('EXECUTION_MODE', 'threads')
+
+# رابط Bot API بديل (خادم محلي أو وهمي للاختبار)
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', '')
+
 # تهيئة التطبيق والبوت
 app = Flask(__name__)
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode='HTML')
+bot = telebot.TeleBot(BOT_TOKEN, parse_mode='HTML', threaded=not PROCESS_IN_REQUEST)
 
 # ============================================================================
 # فئات ومتغيرات مساعدة
@@ -61,33 +150,566 @@ class RideStatus:
     COMPLETED = "completed"
     CANCELLED = "cancelled"
 
+# الحالات التي يُسمح بالانتقال منها إلى كل حالة (ما عداها يُرفض في update_ride_status)
+RIDE_TRANSITIONS = {
+    RideStatus.ACCEPTED: [RideStatus.PENDING],
+    RideStatus.ON_THE_WAY: [RideStatus.ACCEPTED],
+    RideStatus.IN_PROGRESS: [RideStatus.ACCEPTED, RideStatus.ON_THE_WAY],
+    RideStatus.COMPLETED: [RideStatus.IN_PROGRESS],
+    RideStatus.CANCELLED: [RideStatus.PENDING, RideStatus.ACCEPTED, RideStatus.ON_THE_WAY, RideStatus.IN_PROGRESS],
+}
+
 # تخزين مؤقت لحالات المستخدمين
 user_states = {}
 user_data = {}
 ride_requests = {}
 active_rides = {}
 
+# ============================================================================
+# المقاييس
+# ============================================================================
+
+HANDLER_LATENCY = Histogram('bot_handler_seconds', 'زمن تنفيذ معالجات البوت', ['handler'])
+WEBHOOK_LATENCY = Histogram('webhook_request_seconds', 'زمن معالجة طلب الويب هوك كاملاً')
+DB_LATENCY = Histogram('db_method_seconds', 'زمن تنفيذ دوال قاعدة البيانات', ['method'])
+TELEGRAM_LATENCY = Histogram('telegram_api_seconds', 'زمن استدعاءات Telegram Bot API', ['method'])
+UPDATES_TOTAL = Counter('bot_updates_total', 'عدد التحديثات المستلمة', ['type'])
+ERRORS_TOTAL = Counter('bot_errors_total', 'عدد الأخطاء حسب المصدر', ['source'])
+OFFERS_DISPATCHED = Counter('ride_offers_dispatched_total', 'عدد عروض الرحلات المرسلة للسائقين')
+WEBHOOK_REPLIES = Counter('webhook_replies_total', 'استدعاءات Bot API أثناء معالجة التحديث حسب طريقة الإرسال', ['method', 'mode'])
+DEGRADED_REPLIES = Counter('bot_degraded_replies_total', 'ردود الوضع المحدود أثناء انقطاع قاعدة البيانات')
+
+# بادئات أزرار الاستدعاء المعروفة (لتقييد قيم التسميات)
+CALLBACK_ACTIONS = ('accept', 'reject', 'location', 'contact', 'arrived', 'start', 'complete', 'cancel', 'rate', 'pay')
+
+def timed_handler(func):
+    """قياس زمن تنفيذ معالج البوت"""
+    @functools.wraps(func)
+    def wrapper(update):
+        name = func.__name__
+        if isinstance(update, types.CallbackQuery):
+            action = (update.data or '').split('_', 1)[0]
+            name = f"{name}:{action if action in CALLBACK_ACTIONS else 'other'}"
+        start = time.perf_counter()
+        _db_context.handler = True
+        try:
+            return func(update)
+        except DatabaseUnavailable:
+            reply_degraded(update)
+        except Exception:
+            ERRORS_TOTAL.inc('handler')
+            raise
+        finally:
+            _db_context.handler = False
+            HANDLER_LATENCY.observe(time.perf_counter() - start, name)
+    return wrapper
+
+def reply_degraded(update):
+    """رد واضح بدلاً من نتائج فارغة مضللة أثناء انقطاع قاعدة البيانات"""
+    DEGRADED_REPLIES.inc()
+    text = "⚠️ الخدمة تعمل بشكل محدود حالياً بسبب عطل مؤقت، يرجى المحاولة بعد دقائق."
+    try:
+        if isinstance(update, types.CallbackQuery):
+            bot.answer_callback_query(update.id, text, show_alert=True)
+        else:
+            bot.send_message(update.chat.id, text)
+    except Exception as e:
+        logger.error(f"❌ خطأ في إرسال رد الوضع المحدود: {e}")
+
+def timed_db(func):
+    """قياس زمن تنفيذ دالة قاعدة البيانات"""
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if getattr(_db_context, 'handler', False):
+            # داخل المعالجات: الرفض يصل للمعالج بدلاً من قيمة فارغة مضللة
+            self.breaker.check()
+        start = time.perf_counter()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            DB_LATENCY.observe(time.perf_counter() - start, func.__name__)
+    return wrapper
+
+# عميل HTTP الصادر المشترك (تجمع اتصالات دائمة لكل عامل)
+telegram_client = TelegramClient()
+
+# ============================================================================
+# الرد داخل استجابة الويب هوك
+# ============================================================================
+
+# الطرق التي يمكن إرجاعها في جسم استجابة الويب هوك
+INLINE_REPLY_METHODS = ('sendMessage', 'editMessageText', 'answerCallbackQuery')
+
+# سياق التحديث الجاري معالجته في الخيط الحالي
+_reply_context = threading.local()
+
+class WebhookReply:
+    """التقاط أول استدعاء مؤهل لإرجاعه في استجابة الويب هوك بدلاً من إرساله"""
+    
+    def __init__(self):
+        self.payload = None
+        self.sent = 0
+        self.allow_messages = False
+    
+    def try_inline(self, api_method, params, files):
+        """محاولة التقاط الاستدعاء؛ تعيد True إذا تم التقاطه"""
+        if self.payload is not None or self.sent or files:
+            return False
+        if api_method not in INLINE_REPLY_METHODS:
+            return False
+        # الرسائل تُلتقط فقط من المعالجات ذات الرد الواحد، أما answerCallbackQuery فدائماً
+        if api_method != 'answerCallbackQuery' and not self.allow_messages:
+            return False
+        
+        payload = {'method': api_method}
+        payload.update(params or {})
+        if isinstance(payload.get('reply_markup'), str):
+            payload['reply_markup'] = json.loads(payload['reply_markup'])
+        self.payload = payload
+        return True
+    
+    def fake_response(self, api_method, params):
+        """استجابة Bot API بديلة للاستدعاء الملتقط"""
+        if api_method == 'answerCallbackQuery':
+            result = True
+        else:
+            chat_id = (params or {}).get('chat_id', 0)
+            result = {
+                'message_id': int((params or {}).get('message_id', 0) or 0),
+                'date': int(time.time()),
+                'chat': {'id': int(chat_id) if str(chat_id).lstrip('-').isdigit() else 0, 'type': 'private'},
+                'text': (params or {}).get('text', '')
+            }
+        response = requests.models.Response()
+        response.status_code = 200
+        response.encoding = 'utf-8'
+        response._content = json.dumps({'ok': True, 'result': result}).encode('utf-8')
+        return response
+
+def inline_reply(func):
+    """السماح بإرجاع رسالة المعالج داخل استجابة الويب هوك (للمعالجات ذات الرد الواحد)"""
+    @functools.wraps(func)
+    def wrapper(update):
+        capture = getattr(_reply_context, 'capture', None)
+        if capture is not None:
+            capture.allow_messages = True
+        return func(update)
+    return wrapper
+
+def send_telegram_request(method, url, **kwargs):
+    """إرسال طلب إلى Telegram Bot API مع قياس الزمن"""
+    api_method = url.rsplit('/', 1)[-1]
+    
+    capture = getattr(_reply_context, 'capture', None)
+    if capture is not None:
+        if capture.try_inline(api_method, kwargs.get('params'), kwargs.get('files')):
+            WEBHOOK_REPLIES.inc(api_method, 'inlined')
+            return capture.fake_response(api_method, kwargs.get('params'))
+        capture.sent += 1
+        WEBHOOK_REPLIES.inc(api_method, 'sent')
+    
+    start = time.perf_counter()
+    try:
+        result = telegram_client.request(method, url, **kwargs)
+        if result.status_code >= 400:
+            ERRORS_TOTAL.inc('telegram')
+        return result
+    except Exception:
+        ERRORS_TOTAL.inc('telegram')
+        raise
+    finally:
+        TELEGRAM_LATENCY.observe(time.perf_counter() - start, api_method)
+
+apihelper.CUSTOM_REQUEST_SENDER = send_telegram_request
+apihelper.CONNECT_TIMEOUT = TELEGRAM_CONNECT_TIMEOUT
+apihelper.READ_TIMEOUT = TELEGRAM_READ_TIMEOUT
+if TELEGRAM_API_URL:
+    apihelper.API_URL = TELEGRAM_API_URL
+
+# التحديثات قيد المعالجة (للتفريغ الآمن عند الإيقاف)
+_inflight = 0
+_inflight_cond = threading.Condition()
+
+INFLIGHT = Gauge('webhook_inflight_updates', 'التحديثات قيد المعالجة في العامل الحالي')
+INFLIGHT.set_function(lambda: {(): _inflight})
+
+@contextmanager
+def track_inflight():
+    """تسجيل تحديث قيد المعالجة"""
+    global _inflight
+    with _inflight_cond:
+        _inflight += 1
+    try:
+        yield
+    finally:
+        with _inflight_cond:
+            _inflight -= 1
+            if _inflight == 0:
+                _inflight_cond.notify_all()
+
+def wait_for_inflight(timeout):
+    """انتظار انتهاء التحديثات الجارية؛ يعيد True إذا اكتملت جميعها"""
+    with _inflight_cond:
+        return _inflight_cond.wait_for(lambda: _inflight == 0, timeout)
+
+def update_user_id(update):
+    """معرف المستخدم صاحب التحديث"""
+    for kind in ('message', 'edited_message', 'callback_query'):
+        item = getattr(update, kind, None)
+        if item is not None and item.from_user is not None:
+            return str(item.from_user.id)
+    return None
+
+# أزرار مسار الرحلة: لا تُسقط نهائياً بل يُطلب من Telegram إعادة إرسالها
+CRITICAL_CALLBACK_ACTIONS = ('accept', 'arrived', 'start', 'complete', 'cancel')
+# أزرار القراءة المقيدة بفئة history: تكرار الضغط عليها يُسقط أولاً تحت الضغط
+LOW_PRIORITY_TEXTS = ('💰 رصيدي', '📋 رحلاتي السابقة', '💰 أرباحي', '📋 رحلاتي')
+
+def update_priority(update):
+    """أولوية التحديث عند التحكم في القبول"""
+    if update.callback_query is not None:
+        action = (update.callback_query.data or '').split('_', 1)[0]
+        return CRITICAL if action in CRITICAL_CALLBACK_ACTIONS else NORMAL
+    if update.edited_message is not None:
+        # نقاط الموقع المباشر: فقدان نقطة لا يضر
+        return LOW
+    if update.message is not None and update.message.text in LOW_PRIORITY_TEXTS:
+        # الضغط المتكرر فقط منخفض؛ الضغطة الأولى تُعامل كأي رسالة
+        if update.message.from_user is not None and rate_limiter.recent('history', update.message.from_user.id):
+            return LOW
+    return NORMAL
+
+def shed_response(update, priority):
+    """الرد على تحديث أُسقط: المنخفض يُقر به مع تنبيه داخل الاستجابة، والباقي يعاد إرساله"""
+    if priority != LOW:
+        return 'Busy', 503, {'Retry-After': '1'}
+    busy_text = "⏳ الضغط مرتفع حالياً، يرجى المحاولة بعد قليل"
+    if update.callback_query is not None:
+        return jsonify({'method': 'answerCallbackQuery', 'callback_query_id': update.callback_query.id, 'text': busy_text}), 200
+    if update.message is not None:
+        return jsonify({'method': 'sendMessage', 'chat_id': update.message.chat.id, 'text': busy_text}), 200
+    return 'OK', 200
+
+def update_type(update):
+    """نوع التحديث المستلم"""
+    for kind in ('message', 'edited_message', 'callback_query'):
+        if getattr(update, kind, None) is not None:
+            return kind
+    return 'other'
+
 # ============================================================================
 # إدارة قاعدة البيانات
 # ============================================================================
 
+# ترحيلات المخطط: (الإصدار، الأوامر) - تُطبق مرة واحدة بالترتيب
+SCHEMA_MIGRATIONS = [
+    (1, [
+        # جدول المستخدمين
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id VARCHAR(50) PRIMARY KEY,
+            username VARCHAR(100),
+            first_name VARCHAR(100),
+            last_name VARCHAR(100),
+            phone VARCHAR(20),
+            role VARCHAR(20),
+            balance DECIMAL(10, 2) DEFAULT 0.0,
+            rating DECIMAL(3, 2) DEFAULT 5.0,
+            total_rides INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_active BOOLEAN DEFAULT TRUE
+        )
+        """,
+        # جدول الرحلات
+        """
+        CREATE TABLE IF NOT EXISTS rides (
+            ride_id VARCHAR(50) PRIMARY KEY,
+            customer_id VARCHAR(50),
+            driver_id VARCHAR(50),
+            pickup_location TEXT,
+            destination TEXT,
+            pickup_lat DECIMAL(10, 6),
+            pickup_lng DECIMAL(10, 6),
+            dest_lat DECIMAL(10, 6),
+            dest_lng DECIMAL(10, 6),
+            status VARCHAR(20),
+            fare DECIMAL(10, 2),
+            distance DECIMAL(10, 2),
+            duration INTEGER,
+            payment_method VARCHAR(20),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            accepted_at TIMESTAMP,
+            started_at TIMESTAMP,
+            completed_at TIMESTAMP,
+            cancelled_at TIMESTAMP,
+            customer_rating INTEGER,
+            driver_rating INTEGER,
+            notes TEXT
+        )
+        """,
+        # جدول السائقين النشطين
+        """
+        CREATE TABLE IF NOT EXISTS active_drivers (
+            driver_id VARCHAR(50) PRIMARY KEY,
+            username VARCHAR(100),
+            vehicle_type VARCHAR(50),
+            vehicle_number VARCHAR(50),
+            current_lat DECIMAL(10, 6),
+            current_lng DECIMAL(10, 6),
+            is_available BOOLEAN DEFAULT TRUE,
+            status VARCHAR(50),
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        # جدول الدفعات
+        """
+        CREATE TABLE IF NOT EXISTS payments (
+            payment_id VARCHAR(50) PRIMARY KEY,
+            ride_id VARCHAR(50),
+            user_id VARCHAR(50),
+            amount DECIMAL(10, 2),
+            payment_method VARCHAR(20),
+            status VARCHAR(20),
+            transaction_id VARCHAR(100),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        # الفهارس
+        "CREATE INDEX IF NOT EXISTS idx_users_role ON users(role)",
+        "CREATE INDEX IF NOT EXISTS idx_rides_status ON rides(status)",
+        "CREATE INDEX IF NOT EXISTS idx_rides_customer ON rides(customer_id)",
+        "CREATE INDEX IF NOT EXISTS idx_rides_driver ON rides(driver_id)",
+        "CREATE INDEX IF NOT EXISTS idx_active_drivers_available ON active_drivers(is_available)",
+    ]),
+    (2, [
+        # مسارات الرحلات المكتملة (مبسطة ومرمزة بالفروق)
+        """
+        CREATE TABLE IF NOT EXISTS ride_traces (
+            ride_id VARCHAR(50) PRIMARY KEY,
+            points INTEGER,
+            trace BYTEA,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    (3, [
+        # معرفات التحديثات المعالجة (نافذة إزالة التكرار المشتركة بين العمال)
+        """
+        CREATE TABLE IF NOT EXISTS processed_updates (
+            update_id BIGINT PRIMARY KEY,
+            processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_processed_updates_time ON processed_updates(processed_at)",
+    ]),
+    (4, [
+        # صندوق الصادر: إشعارات تُحفظ في معاملة تغيير الحالة وتُرسل لاحقاً بالترتيب
+        """
+        CREATE TABLE IF NOT EXISTS outbox (
+            id BIGSERIAL PRIMARY KEY,
+            chat_id VARCHAR(50) NOT NULL,
+            ride_id VARCHAR(50),
+            text TEXT NOT NULL,
+            reply_markup TEXT,
+            status VARCHAR(10) DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            locked_until TIMESTAMP,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sent_at TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox(chat_id, id) WHERE status = 'pending'",
+    ]),
+    (5, [
+        # دفتر المدفوعات: قيود إلحاقية مرقمة، والأرصدة = التجميع + الذيل غير المجمع
+        "ALTER TABLE payments ADD COLUMN IF NOT EXISTS seq BIGSERIAL",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_payments_seq ON payments(seq)",
+        "CREATE INDEX IF NOT EXISTS idx_payments_user_seq ON payments(user_id, seq)",
+        """
+        CREATE TABLE IF NOT EXISTS balance_rollups (
+            user_id VARCHAR(50) PRIMARY KEY,
+            balance DECIMAL(12, 2) NOT NULL DEFAULT 0,
+            rolled_seq BIGINT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        # الأرصدة الحالية تصبح قيوداً افتتاحية
+        """
+        INSERT INTO payments (payment_id, user_id, amount, payment_method, status)
+        SELECT 'opening:' || user_id, user_id, balance, 'opening', 'completed'
+        FROM users WHERE balance <> 0
+        ON CONFLICT (payment_id) DO NOTHING
+        """,
+    ]),
+    (6, [
+        # أرباح ورحلات كل سائق يومياً (تُحدث تزايدياً عند إكمال الرحلة)
+        """
+        CREATE TABLE IF NOT EXISTS driver_daily_stats (
+            driver_id VARCHAR(50),
+            day DATE,
+            trips INTEGER NOT NULL DEFAULT 0,
+            earnings DECIMAL(12, 2) NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (driver_id, day)
+        )
+        """,
+        # تعبئة من الرحلات المكتملة الموجودة
+        """
+        INSERT INTO driver_daily_stats (driver_id, day, trips, earnings)
+        SELECT driver_id, completed_at::date, COUNT(*), COALESCE(SUM(fare), 0)
+        FROM rides
+        WHERE status = 'completed' AND driver_id IS NOT NULL AND completed_at IS NOT NULL
+        GROUP BY driver_id, completed_at::date
+        ON CONFLICT (driver_id, day) DO NOTHING
+        """,
+    ]),
+    (7, [
+        # مجموع وعدد التقييمات لكل مستخدم (users.rating = المجموع / العدد)
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS rating_sum INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS rating_count INTEGER NOT NULL DEFAULT 0",
+    ]),
+    (8, [
+        # سجل انتقالات حالة الرحلات (يُجمع ساعياً بعد رقم تسلسلي محفوظ)
+        """
+        CREATE TABLE IF NOT EXISTS ride_events (
+            seq BIGSERIAL PRIMARY KEY,
+            ride_id VARCHAR(50),
+            status VARCHAR(20),
+            fare DECIMAL(10, 2),
+            accept_latency_s DOUBLE PRECISION,
+            at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        # تجميع ساعي: الرحلات حسب الحالة والإيرادات وزمن القبول
+        """
+        CREATE TABLE IF NOT EXISTS ride_stats_hourly (
+            hour TIMESTAMP PRIMARY KEY,
+            created INTEGER NOT NULL DEFAULT 0,
+            accepted INTEGER NOT NULL DEFAULT 0,
+            completed INTEGER NOT NULL DEFAULT 0,
+            cancelled INTEGER NOT NULL DEFAULT 0,
+            revenue DECIMAL(12, 2) NOT NULL DEFAULT 0,
+            accept_latency_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+            accept_latency_count INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        # أحداث الرحلات الموجودة من طوابعها الزمنية
+        """
+        INSERT INTO ride_events (ride_id, status, fare, accept_latency_s, at)
+        SELECT ride_id, 'pending', NULL::numeric, NULL::double precision, created_at FROM rides WHERE created_at IS NOT NULL
+        UNION ALL
+        SELECT ride_id, 'accepted', NULL, EXTRACT(EPOCH FROM accepted_at - created_at), accepted_at
+        FROM rides WHERE accepted_at IS NOT NULL
+        UNION ALL
+        SELECT ride_id, 'completed', fare, NULL, completed_at FROM rides WHERE completed_at IS NOT NULL
+        UNION ALL
+        SELECT ride_id, 'cancelled', NULL, NULL, cancelled_at FROM rides WHERE cancelled_at IS NOT NULL
+        """,
+    ]),
+    (9, [
+        # قفل كتّاب الدفتر المشترك حتى لا يتخطى التجميع الأرقام التسلسلية لهذه المعاملة
+        "SELECT pg_advisory_xact_lock_shared(7452004)",
+        # عكس أرباح الرحلات غير المدفوعة من المحفظة التي قُيدت سابقاً (الدفتر للإضافة فقط)
+        """
+        INSERT INTO payments (payment_id, ride_id, user_id, amount, payment_method, status)
+        SELECT p.ride_id || ':earning-reversal', p.ride_id, p.user_id, -p.amount, 'reversal', 'completed'
+        FROM payments p
+        WHERE p.payment_id LIKE '%:earning' AND p.payment_method IS DISTINCT FROM 'wallet'
+        ON CONFLICT (payment_id) DO NOTHING
+        """,
+    ]),
+    (10, [
+        # بحث المرشحين بمربع إحداثيات حول نقطة الالتقاط
+        """
+        CREATE INDEX IF NOT EXISTS idx_active_drivers_location
+        ON active_drivers(current_lat, current_lng) WHERE is_available
+        """,
+    ]),
+    (11, [
+        # طريقة الدفع المفضلة للعميل وطريقة دفع كل رحلة (النقد افتراضياً)
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS payment_method VARCHAR(20) DEFAULT 'cash'",
+        "ALTER TABLE rides ALTER COLUMN payment_method SET DEFAULT 'cash'",
+    ]),
+    (12, [
+        # total_rides يُجمع من أحداث الرحلات: الإكمالات بعد حد التجميع عُدّت مباشرة سابقاً،
+        # فتُطرح هنا ليضيفها التجميع مرة واحدة (مع منع التجميع والكتّاب أثناء الترحيل)
+        "SELECT pg_advisory_xact_lock(7452009)",
+        "SELECT pg_advisory_xact_lock(7452008)",
+        """
+        UPDATE users u SET total_rides = u.total_rides - done.rides
+        FROM (
+            SELECT party.user_id, COUNT(*) AS rides
+            FROM ride_events e
+            JOIN rides r ON r.ride_id = e.ride_id
+            CROSS JOIN LATERAL (VALUES (r.customer_id), (NULLIF(r.driver_id, r.customer_id))) AS party(user_id)
+            WHERE e.status = 'completed' AND party.user_id IS NOT NULL
+            AND e.seq > COALESCE((SELECT value::bigint FROM app_meta WHERE key = 'ride_events_seq'), 0)
+            GROUP BY party.user_id
+        ) done
+        WHERE u.user_id = done.user_id
+        """,
+    ]),
+    (13, [
+        # علامة اكتمال تعبئة التقييمات كانت تُخزن 'None' فتُعاد التعبئة عند كل تشغيل
+        "UPDATE app_meta SET value = 'done' WHERE key = 'rating_backfill_after' AND value = 'None'",
+    ]),
+]
+
+SCHEMA_VERSION = SCHEMA_MIGRATIONS[-1][0]
+
+DB_READ_ROUTES = Counter('db_read_routes_total', 'توجيه استعلامات القراءة عند وجود نسخة متماثلة', ['route'])
+REPLICA_LAG = Gauge('db_replica_lag_seconds', 'آخر تأخر مقاس للنسخة المتماثلة')
+
+# سياق قاعدة البيانات للتحديث الجاري: بعد أول كتابة تُقرأ بقية التحديث من الرئيسية
+_db_context = threading.local()
+
+# مفاتيح الأقفال الاستشارية في Postgres
+SCHEMA_LOCK_ID = 7452001
+WEBHOOK_LOCK_ID = 7452002
+OUTBOX_LOCK_ID = 7452003
+# الكتابة في الدفتر تأخذ القفل مشتركاً، وقراءة حد التجميع تأخذه حصرياً لحظياً
+LEDGER_LOCK_ID = 7452004
+LEDGER_ROLLUP_LOCK_ID = 7452005
+STATS_RECONCILE_LOCK_ID = 7452006
+RATING_BACKFILL_LOCK_ID = 7452007
+RIDE_EVENTS_LOCK_ID = 7452008
+ANALYTICS_ROLLUP_LOCK_ID = 7452009
+CLEANUP_LOCK_ID = 7452010
+
 class DatabaseManager:
     """مدير قاعدة البيانات"""
     
     def __init__(self):
         self.pool = None
-        self.init_pool()
-        self.init_tables()
+        self._pool_pid = None
+        self._pool_lock = threading.Lock()
+        # التجمع يرفض الطلب فوراً عند امتلائه، لذا ننتظر دورنا عبر إشارة بعدد الاتصالات
+        self._pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+        self.query_stats = QueryStats()
+        self.slow_queries = SlowQueryLog(SLOW_QUERY_MS, EXPLAIN_SAMPLE_RATE)
+        self.query_hooks = [self.query_stats.record, self.slow_queries.record]
+        self.breaker = CircuitBreaker(DB_BREAKER_WINDOW_S, DB_BREAKER_MIN_CALLS, DB_BREAKER_FAILURE_RATE, DB_BREAKER_OPEN_S)
+        # النسخة المتماثلة: تجمع مستقل وآخر تأخر مقاس (None = غير صالحة)
+        self.replica_pool = None
+        self._replica_pid = None
+        self._replica_slots = threading.BoundedSemaphore(DB_REPLICA_POOL_MAX)
+        self._replica_lag = None
+        self._replica_checked_at = None
+        self._replica_check_lock = threading.Lock()
+        REPLICA_LAG.set_function(lambda: {(): self._replica_lag} if self._replica_lag is not None else {})
     
     def init_pool(self):
         """تهيئة تجمع الاتصالات"""
         try:
             if DATABASE_URL:
-                self.pool = SimpleConnectionPool(1, 10, DATABASE_URL)
+                self.pool = ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DATABASE_URL)
             else:
                 # استخدام قاعدة بيانات محلية للتطوير
-                self.pool = SimpleConnectionPool(
-                    1, 10,
+                self.pool = ThreadedConnectionPool(
+                    DB_POOL_MIN, DB_POOL_MAX,
                     host="localhost",
                     database="transport_bot",
                     user="postgres",
@@ -98,121 +720,241 @@ class DatabaseManager:
             logger.error(f"❌ فشل تهيئة قاعدة البيانات: {e}")
             self.pool = None
     
+    def get_pool(self):
+        """تجمع الاتصالات الخاص بالعملية الحالية (يُنشأ عند أول استخدام بعد fork)"""
+        pid = os.getpid()
+        if self.pool is None or self._pool_pid != pid:
+            with self._pool_lock:
+                if self.pool is None or self._pool_pid != pid:
+                    # اتصالات العملية الأم الموروثة لا تُغلق ولا تُستخدم
+                    self.pool = None
+                    self.init_pool()
+                    self._pool_pid = pid
+        return self.pool
+    
+    def get_replica_pool(self):
+        """تجمع النسخة المتماثلة الخاص بالعملية الحالية"""
+        pid = os.getpid()
+        if self.replica_pool is None or self._replica_pid != pid:
+            with self._pool_lock:
+                if self.replica_pool is None or self._replica_pid != pid:
+                    self.replica_pool = ThreadedConnectionPool(DB_POOL_MIN, DB_REPLICA_POOL_MAX, DATABASE_REPLICA_URL)
+                    self._replica_pid = pid
+                    logger.info("✅ تم تهيئة تجمع اتصالات النسخة المتماثلة")
+        return self.replica_pool
+    
+    def close_pool(self):
+        """إغلاق تجمعات العملية الحالية (قبل fork أو عند إيقاف العامل)"""
+        with self._pool_lock:
+            pool, self.pool = self.pool, None
+            owned = self._pool_pid == os.getpid()
+            self._pool_pid = None
+            replica, self.replica_pool = self.replica_pool, None
+            replica_owned = self._replica_pid == os.getpid()
+            self._replica_pid = None
+        if pool is not None and owned:
+            pool.closeall()
+        if replica is not None and replica_owned:
+            replica.closeall()
+    
+    def _checkout(self, slots, get_pool):
+        """حجز مكان في التجمع ثم أخذ اتصال منه"""
+        if not slots.acquire(timeout=DB_POOL_TIMEOUT):
+            raise PoolError("انتهت مهلة انتظار اتصال حر في التجمع")
+        try:
+            pool = get_pool()
+            return pool, pool.getconn()
+        except Exception:
+            slots.release()
+            raise
+    
+    def replica_lag(self):
+        """تأخر النسخة المتماثلة بالثواني (مخزن مؤقتاً)؛ None إذا تعذر القياس"""
+        now = time.monotonic()
+        checked_at = self._replica_checked_at
+        if checked_at is not None and now - checked_at < REPLICA_LAG_CHECK_S:
+            return self._replica_lag
+        # خيط واحد يقيس، والبقية تستخدم آخر قيمة
+        if not self._replica_check_lock.acquire(blocking=False):
+            return self._replica_lag
+        try:
+            pool, conn = self._checkout(self._replica_slots, self.get_replica_pool)
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        SELECT CASE
+                            WHEN NOT pg_is_in_recovery() THEN 0
+                            WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                            ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+                        END::float8
+                    """)
+                    self._replica_lag = cur.fetchone()[0]
+                conn.rollback()
+            finally:
+                pool.putconn(conn)
+                self._replica_slots.release()
+        except Exception as e:
+            if self._replica_lag is not None:
+                logger.error(f"❌ تعذر قياس تأخر النسخة المتماثلة: {e}")
+            self._replica_lag = None
+        finally:
+            self._replica_checked_at = time.monotonic()
+            self._replica_check_lock.release()
+        return self._replica_lag
+    
+    def _read_route(self):
+        """اختيار مصدر القراءة: replica أو سبب الرجوع للرئيسية"""
+        if getattr(_db_context, 'wrote', False):
+            return 'pinned'
+        lag = self.replica_lag()
+        if lag is None:
+            return 'unavailable'
+        if lag > REPLICA_MAX_LAG_S:
+            return 'lagging'
+        return 'replica'
+    
     @contextmanager
-    def get_connection(self):
-        """الحصول على اتصال من التجمع"""
-        conn = None
+    def update_scope(self):
+        """نطاق تحديث واحد: القراءات بعد أول كتابة فيه تذهب للرئيسية"""
+        _db_context.wrote = False
+        try:
+            yield
+        finally:
+            # خارج التحديثات (لوحة التحكم، الخيوط الخلفية) لا تثبيت
+            _db_context.wrote = None
+    
+    @contextmanager
+    def get_connection(self, readonly=False):
+        """الحصول على اتصال من التجمع (القراءات للنسخة المتماثلة إن كانت صالحة)"""
+        checkout = None
+        if readonly and DATABASE_REPLICA_URL:
+            route = self._read_route()
+            if route == 'replica':
+                try:
+                    checkout = self._replica_slots, self._checkout(self._replica_slots, self.get_replica_pool)
+                except Exception as e:
+                    logger.error(f"❌ تعذر الاتصال بالنسخة المتماثلة: {e}")
+                    # إعادة القياس قبل المحاولة التالية
+                    self._replica_lag = None
+                    route = 'unavailable'
+            DB_READ_ROUTES.inc(route)
+        probe = False
+        if checkout is None:
+            # الرئيسية خلف قاطع الدائرة: الرفض فوري بدلاً من انتظار مهلة الاتصال
+            probe = self.breaker.acquire()
+            try:
+                checkout = self._pool_slots, self._checkout(self._pool_slots, self.get_pool)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                # فشل الاتصال الفعلي فقط يُحسب على القاطع
+                ERRORS_TOTAL.inc('database')
+                self.breaker.record(False, probe)
+                raise
+            except Exception:
+                # تشبع التجمع (PoolError) من شأن التحكم بالقبول لا القاطع
+                ERRORS_TOTAL.inc('database')
+                self.breaker.release(probe)
+                raise
+            if not readonly and getattr(_db_context, 'wrote', None) is False:
+                _db_context.wrote = True
+        slots, (pool, conn) = checkout
+        healthy = True
         try:
-            conn = self.pool.getconn()
             yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # انقطاع الاتصال أو الخادم (أخطاء البيانات لا تُحسب فشلاً)
+            healthy = False
+            raise
         finally:
-            if conn:
-                self.pool.putconn(conn)
+            pool.putconn(conn)
+            slots.release()
+            if slots is self._pool_slots:
+                self.breaker.record(healthy, probe)
+    
+    def add_query_hook(self, hook):
+        """إضافة خطاف يُستدعى بعد كل استعلام"""
+        self.query_hooks.append(hook)
     
     @contextmanager
-    def get_cursor(self):
-        """الحصول على مؤشر قاعدة البيانات"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor(cursor_factory=RealDictCursor)
+    def get_cursor(self, readonly=False, tuples=False):
+        """الحصول على مؤشر قاعدة البيانات (readonly: يمكن توجيهه للنسخة المتماثلة، tuples: صفوف لنماذج models.py)"""
+        start = time.perf_counter()
+        with self.get_connection(readonly) as conn:
+            cursor = conn.cursor(cursor_factory=TimedTupleCursor if tuples else TimedCursor)
+            cursor.hooks = self.query_hooks
+            cursor.pool_wait = time.perf_counter() - start
             try:
                 yield cursor
                 conn.commit()
             except Exception as e:
+                ERRORS_TOTAL.inc('database')
                 conn.rollback()
                 raise e
             finally:
                 cursor.close()
     
-    def init_tables(self):
-        """إنشاء الجداول الأساسية"""
+    def migrate(self):
+        """تطبيق ترحيلات المخطط الناقصة مرة واحدة تحت قفل استشاري"""
         try:
             with self.get_cursor() as cur:
-                # جدول المستخدمين
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS users (
-                        user_id VARCHAR(50) PRIMARY KEY,
-                        username VARCHAR(100),
-                        first_name VARCHAR(100),
-                        last_name VARCHAR(100),
-                        phone VARCHAR(20),
-                        role VARCHAR(20),
-                        balance DECIMAL(10, 2) DEFAULT 0.0,
-                        rating DECIMAL(3, 2) DEFAULT 5.0,
-                        total_rides INTEGER DEFAULT 0,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        is_active BOOLEAN DEFAULT TRUE
-                    )
-                """)
-                
-                # جدول الرحلات
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS rides (
-                        ride_id VARCHAR(50) PRIMARY KEY,
-                        customer_id VARCHAR(50),
-                        driver_id VARCHAR(50),
-                        pickup_location TEXT,
-                        destination TEXT,
-                        pickup_lat DECIMAL(10, 6),
-                        pickup_lng DECIMAL(10, 6),
-                        dest_lat DECIMAL(10, 6),
-                        dest_lng DECIMAL(10, 6),
-                        status VARCHAR(20),
-                        fare DECIMAL(10, 2),
-                        distance DECIMAL(10, 2),
-                        duration INTEGER,
-                        payment_method VARCHAR(20),
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        accepted_at TIMESTAMP,
-                        started_at TIMESTAMP,
-                        completed_at TIMESTAMP,
-                        cancelled_at TIMESTAMP,
-                        customer_rating INTEGER,
-                        driver_rating INTEGER,
-                        notes TEXT
-                    )
-                """)
-                
-                # جدول السائقين النشطين
+                cur.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK_ID,))
                 cur.execute("""
-                    CREATE TABLE IF NOT EXISTS active_drivers (
-                        driver_id VARCHAR(50) PRIMARY KEY,
-                        username VARCHAR(100),
-                        vehicle_type VARCHAR(50),
-                        vehicle_number VARCHAR(50),
-                        current_lat DECIMAL(10, 6),
-                        current_lng DECIMAL(10, 6),
-                        is_available BOOLEAN DEFAULT TRUE,
-                        status VARCHAR(50),
+                    CREATE TABLE IF NOT EXISTS app_meta (
+                        key VARCHAR(50) PRIMARY KEY,
+                        value TEXT,
                         updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                     )
                 """)
+                current = int(self.get_meta('schema_version', 0, cur))
                 
-                # جدول الدفعات
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS payments (
-                        payment_id VARCHAR(50) PRIMARY KEY,
-                        ride_id VARCHAR(50),
-                        user_id VARCHAR(50),
-                        amount DECIMAL(10, 2),
-                        payment_method VARCHAR(20),
-                        status VARCHAR(20),
-                        transaction_id VARCHAR(100),
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                """)
-                
-                # إنشاء الفهارس
-                cur.execute("CREATE INDEX IF NOT EXISTS idx_users_role ON users(role)")
-                cur.execute("CREATE INDEX IF NOT EXISTS idx_rides_status ON rides(status)")
-                cur.execute("CREATE INDEX IF NOT EXISTS idx_rides_customer ON rides(customer_id)")
-                cur.execute("CREATE INDEX IF NOT EXISTS idx_rides_driver ON rides(driver_id)")
-                cur.execute("CREATE INDEX IF NOT EXISTS idx_active_drivers_available ON active_drivers(is_available)")
+                for version, statements in SCHEMA_MIGRATIONS:
+                    if version <= current:
+                        continue
+                    for statement in statements:
+                        cur.execute(statement)
+                    self.set_meta('schema_version', version, cur)
+                    logger.info(f"🗄️ تم تطبيق ترحيل المخطط رقم {version}")
                 
-                logger.info("✅ تم إنشاء/تأكيد الجداول بنجاح")
+                logger.info(f"✅ إصدار المخطط: {max(current, SCHEMA_VERSION)}")
+                return True
         except Exception as e:
-            logger.error(f"❌ فشل إنشاء الجداول: {e}")
+            logger.error(f"❌ فشل ترحيل المخطط: {e}")
+            return False
     
+    def check_schema(self):
+        """فحص سريع لإصدار المخطط (استعلام واحد)"""
+        try:
+            version = int(self.get_meta('schema_version', 0))
+        except Exception as e:
+            logger.error(f"❌ تعذر قراءة إصدار المخطط: {e}")
+            return False
+        if version < SCHEMA_VERSION:
+            logger.error(f"❌ المخطط قديم ({version} < {SCHEMA_VERSION}) - شغّل: python app.py migrate")
+            return False
+        return True
+    
+    def get_meta(self, key, default=None, cur=None):
+        """قراءة قيمة من جدول app_meta"""
+        if cur is None:
+            with self.get_cursor() as cur:
+                return self.get_meta(key, default, cur)
+        cur.execute("SELECT value FROM app_meta WHERE key = %s", (key,))
+        row = cur.fetchone()
+        return row['value'] if row else default
+    
+    def set_meta(self, key, value, cur=None):
+        """كتابة قيمة في جدول app_meta"""
+        if cur is None:
+            with self.get_cursor() as cur:
+                return self.set_meta(key, value, cur)
+        cur.execute("""
+            INSERT INTO app_meta (key, value, updated_at)
+            VALUES (%s, %s, CURRENT_TIMESTAMP)
+            ON CONFLICT (key) DO UPDATE SET
+            value = EXCLUDED.value,
+            updated_at = CURRENT_TIMESTAMP
+        """, (key, str(value)))
+    
+    @timed_db
     def save_user(self, user_id, username, first_name, last_name="", phone="", role="customer"):
         """حفظ أو تحديث بيانات المستخدم"""
         try:
@@ -233,16 +975,32 @@ class DatabaseManager:
             logger.error(f"❌ خطأ في حفظ المستخدم: {e}")
             return False
     
+    @timed_db
     def get_user(self, user_id):
         """الحصول على بيانات مستخدم"""
         try:
-            with self.get_cursor() as cur:
-                cur.execute("SELECT * FROM users WHERE user_id = %s", (user_id,))
-                return cur.fetchone()
+            with self.get_cursor(tuples=True) as cur:
+                cur.execute(f"SELECT {User.columns()} FROM users WHERE user_id = %s", (user_id,))
+                return User.fetchone(cur)
         except Exception as e:
             logger.error(f"❌ خطأ في جلب بيانات المستخدم: {e}")
             return None
     
+    @timed_db
+    def set_payment_method(self, user_id, payment_method):
+        """حفظ طريقة الدفع المفضلة للمستخدم ('cash' أو 'wallet')"""
+        try:
+            with self.get_cursor() as cur:
+                cur.execute(
+                    "UPDATE users SET payment_method = %s WHERE user_id = %s",
+                    (payment_method, user_id)
+                )
+                return cur.rowcount > 0
+        except Exception as e:
+            logger.error(f"❌ خطأ في حفظ طريقة الدفع: {e}")
+            return False
+    
+    @timed_db
     def save_ride(self, ride_data):
         """حفظ رحلة جديدة"""
         try:
@@ -250,8 +1008,8 @@ class DatabaseManager:
                 cur.execute("""
                     INSERT INTO rides 
                     (ride_id, customer_id, pickup_location, pickup_lat, pickup_lng, 
-                     status, fare, created_at)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
+                     status, fare, payment_method, created_at)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
                 """, (
                     ride_data['ride_id'],
                     ride_data['customer_id'],
@@ -259,15 +1017,21 @@ class DatabaseManager:
                     ride_data['pickup_lat'],
                     ride_data['pickup_lng'],
                     RideStatus.PENDING,
-                    ride_data.get('fare', 15.0)
+                    ride_data.get('fare', 15.0),
+                    ride_data.get('payment_method', 'cash')
                 ))
+                self._append_ride_event(cur, ride_data['ride_id'])
                 return True
         except Exception as e:
             logger.error(f"❌ خطأ في حفظ الرحلة: {e}")
             return False
     
-    def update_ride_status(self, ride_id, status, driver_id=None):
-        """تحديث حالة الرحلة"""
+    @timed_db
+    def update_ride_status(self, ride_id, status, driver_id=None, fare=None, notify=()):
+        """
+        نقل الرحلة إلى status إن كانت في حالة يُسمح بالانتقال منها، مع حفظ إشعاراتها
+        [(chat_id, text, reply_markup)] في نفس المعاملة؛ يعيد False إذا لم تتغير الرحلة
+        """
         try:
             with self.get_cursor() as cur:
                 query = "UPDATE rides SET status = %s"
@@ -276,6 +1040,9 @@ class DatabaseManager:
                 if status == RideStatus.ACCEPTED and driver_id:
                     query += ", driver_id = %s, accepted_at = CURRENT_TIMESTAMP"
                     params.append(driver_id)
+                    if fare is not None:
+                        query += ", fare = %s"
+                        params.append(fare)
                 elif status == RideStatus.IN_PROGRESS:
                     query += ", started_at = CURRENT_TIMESTAMP"
                 elif status == RideStatus.COMPLETED:
@@ -283,25 +1050,137 @@ class DatabaseManager:
                 elif status == RideStatus.CANCELLED:
                     query += ", cancelled_at = CURRENT_TIMESTAMP"
                 
-                query += " WHERE ride_id = %s"
-                params.append(ride_id)
+                # الضغط المكرر أو المتزامن والانتقالات غير الصالحة لا تغير شيئاً،
+                # فلا أحداث ولا إحصائيات ولا قيود ولا إشعارات
+                query += " WHERE ride_id = %s AND status = ANY(%s)"
+                params.extend([ride_id, RIDE_TRANSITIONS.get(status, [])])
                 
                 cur.execute(query, params)
+                if not cur.rowcount:
+                    return False
+                # total_rides يُضاف في تجميع أحداث الرحلات (لا تحديث لصف المستخدم هنا)
+                self._append_ride_event(cur, ride_id)
+                if status == RideStatus.COMPLETED:
+                    self._add_driver_daily_stats(cur, ride_id)
+                    self._append_ride_ledger(cur, ride_id)
+                self._enqueue_notifications(cur, ride_id, notify)
                 return True
         except Exception as e:
             logger.error(f"❌ خطأ في تحديث حالة الرحلة: {e}")
             return False
     
+    def _enqueue_notifications(self, cur, ride_id, notify):
+        """إضافة إشعارات إلى صندوق الصادر ضمن المعاملة الجارية"""
+        if notify:
+            execute_values(cur, """
+                INSERT INTO outbox (chat_id, ride_id, text, reply_markup) VALUES %s
+            """, [(str(chat_id), ride_id, text, markup) for chat_id, text, markup in notify])
+    
+    @timed_db
+    def enqueue_notifications(self, ride_id, notify):
+        """حفظ إشعارات لا يرافقها تغيير حالة"""
+        try:
+            with self.get_cursor() as cur:
+                self._enqueue_notifications(cur, ride_id, notify)
+                return True
+        except Exception as e:
+            logger.error(f"❌ خطأ في حفظ الإشعارات: {e}")
+            return False
+    
+    @timed_db
+    def claim_outbox(self, limit, lease_s):
+        """حجز دفعة إشعارات جاهزة (الأقدم أولاً ولا تتخطى رسالة محادثة معلقة قبلها)"""
+        try:
+            with self.get_cursor() as cur:
+                # عامل واحد يحجز في كل لحظة حتى لا تتداخل رسائل نفس المحادثة
+                cur.execute("SELECT pg_try_advisory_xact_lock(%s) AS locked", (OUTBOX_LOCK_ID,))
+                if not cur.fetchone()['locked']:
+                    return None
+                cur.execute("""
+                    SELECT COUNT(*) AS pending,
+                           COALESCE(EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - MIN(created_at)), 0)::float8 AS oldest_s
+                    FROM outbox WHERE status = 'pending'
+                """)
+                backlog = dict(cur.fetchone())
+                cur.execute("""
+                    UPDATE outbox SET locked_until = CURRENT_TIMESTAMP + %s * INTERVAL '1 second'
+                    WHERE id IN (
+                        SELECT o.id FROM outbox o
+                        WHERE o.status = 'pending' AND o.next_attempt_at <= CURRENT_TIMESTAMP
+                        AND (o.locked_until IS NULL OR o.locked_until < CURRENT_TIMESTAMP)
+                        AND NOT EXISTS (
+                            SELECT 1 FROM outbox p
+                            WHERE p.chat_id = o.chat_id AND p.status = 'pending' AND p.id < o.id
+                            AND (p.next_attempt_at > CURRENT_TIMESTAMP OR p.locked_until >= CURRENT_TIMESTAMP)
+                        )
+                        ORDER BY o.id
+                        LIMIT %s
+                    )
+                    RETURNING id, chat_id, text, reply_markup, attempts,
+                              EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - created_at)::float8 AS age_s
+                """, (lease_s, limit))
+                return sorted(cur.fetchall(), key=lambda row: row['id']), backlog
+        except Exception as e:
+            logger.error(f"❌ خطأ في حجز صندوق الصادر: {e}")
+            return None
+    
+    @timed_db
+    def finish_outbox(self, results):
+        """تسجيل نتائج الإرسال [(id, action, delay_s, error)]"""
+        if not results:
+            return True
+        try:
+            with self.get_cursor() as cur:
+                execute_values(cur, """
+                    UPDATE outbox AS o SET
+                    status = CASE v.action WHEN 'sent' THEN 'sent' WHEN 'failed' THEN 'failed' ELSE o.status END,
+                    sent_at = CASE WHEN v.action = 'sent' THEN CURRENT_TIMESTAMP ELSE o.sent_at END,
+                    attempts = o.attempts + CASE WHEN v.action IN ('retry', 'failed') THEN 1 ELSE 0 END,
+                    next_attempt_at = CASE WHEN v.action = 'retry'
+                        THEN CURRENT_TIMESTAMP + v.delay_s * INTERVAL '1 second' ELSE o.next_attempt_at END,
+                    last_error = COALESCE(v.error, o.last_error),
+                    locked_until = NULL
+                    FROM (VALUES %s) AS v(id, action, delay_s, error)
+                    WHERE o.id = v.id
+                """, results, template="(%s::bigint, %s, %s::float8, %s)")
+                return True
+        except Exception as e:
+            logger.error(f"❌ خطأ في تسجيل نتائج صندوق الصادر: {e}")
+            return False
+    
+    @timed_db
+    def save_ride_trace(self, ride_id, distance_km, duration_min, points, trace):
+        """حفظ مسار الرحلة وتسجيل المسافة (كم) والمدة (دقائق) الفعليتين"""
+        try:
+            with self.get_cursor() as cur:
+                cur.execute("""
+                    INSERT INTO ride_traces (ride_id, points, trace)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (ride_id) DO UPDATE SET
+                    points = EXCLUDED.points,
+                    trace = EXCLUDED.trace
+                """, (ride_id, points, psycopg2.Binary(trace)))
+                cur.execute("""
+                    UPDATE rides SET distance = %s, duration = %s
+                    WHERE ride_id = %s
+                """, (round(distance_km, 2), duration_min, ride_id))
+                return True
+        except Exception as e:
+            logger.error(f"❌ خطأ في حفظ مسار الرحلة: {e}")
+            return False
+    
+    @timed_db
     def get_ride(self, ride_id):
         """الحصول على بيانات رحلة"""
         try:
-            with self.get_cursor() as cur:
-                cur.execute("SELECT * FROM rides WHERE ride_id = %s", (ride_id,))
-                return cur.fetchone()
+            with self.get_cursor(tuples=True) as cur:
+                cur.execute(f"SELECT {Ride.columns()} FROM rides WHERE ride_id = %s", (ride_id,))
+                return Ride.fetchone(cur)
         except Exception as e:
             logger.error(f"❌ خطأ في جلب بيانات الرحلة: {e}")
             return None
     
+    @timed_db
     def add_active_driver(self, driver_id, username, vehicle_type="سيارة", vehicle_number=""):
         """إضافة سائق نشط"""
         try:
@@ -321,6 +1200,7 @@ class DatabaseManager:
             logger.error(f"❌ خطأ في إضافة سائق نشط: {e}")
             return False
     
+    @timed_db
     def remove_active_driver(self, driver_id):
         """إزالة سائق من القائمة النشطة"""
         try:
@@ -331,79 +1211,781 @@ class DatabaseManager:
             logger.error(f"❌ خطأ في إزالة سائق نشط: {e}")
             return False
     
-    def update_driver_location(self, driver_id, lat, lng):
-        """تحديث موقع السائق"""
+    @timed_db
+    def sync_driver_heartbeats(self, rows):
+        """كتابة دفعة نبضات [(driver_id, lat, lng, age_s)] في استعلام واحد"""
+        try:
+            with self.get_cursor() as cur:
+                execute_values(cur, """
+                    UPDATE active_drivers AS a SET
+                    current_lat = COALESCE(v.lat, a.current_lat),
+                    current_lng = COALESCE(v.lng, a.current_lng),
+                    is_available = TRUE,
+                    updated_at = GREATEST(a.updated_at, CURRENT_TIMESTAMP - v.age_s * INTERVAL '1 second')
+                    FROM (VALUES %s) AS v(driver_id, lat, lng, age_s)
+                    WHERE a.driver_id = v.driver_id
+                """, rows, template="(%s, %s::decimal, %s::decimal, %s::float8)", page_size=1000)
+                return True
+        except Exception as e:
+            logger.error(f"❌ خطأ في مزامنة نبضات السائقين: {e}")
+            return False
+    
+    @timed_db
+    def expire_drivers(self, driver_ids, ttl_s):
+        """تعليم السائقين المنتهية مهلتهم غير متاحين؛ يعيد من ما زالوا متصلين {driver_id: age_s}"""
+        try:
+            with self.get_cursor() as cur:
+                cur.execute("""
+                    UPDATE active_drivers SET is_available = FALSE
+                    WHERE driver_id = ANY(%s) AND is_available = TRUE
+                    AND updated_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 second'
+                """, (driver_ids, ttl_s))
+                cur.execute("""
+                    SELECT driver_id, EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - updated_at)::float8 AS age_s
+                    FROM active_drivers
+                    WHERE driver_id = ANY(%s) AND is_available = TRUE
+                """, (driver_ids,))
+                return {row['driver_id']: row['age_s'] for row in cur.fetchall()}
+        except Exception as e:
+            logger.error(f"❌ خطأ في إنهاء حضور السائقين: {e}")
+            return None
+    
+    @timed_db
+    def load_online_drivers(self):
+        """السائقون المتاحون وعمر آخر نبضة لكل منهم بالثواني"""
+        try:
+            with self.get_cursor(readonly=True) as cur:
+                cur.execute("""
+                    SELECT driver_id, EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - updated_at)::float8 AS age_s
+                    FROM active_drivers
+                    WHERE is_available = TRUE
+                """)
+                return {row['driver_id']: row['age_s'] for row in cur.fetchall()}
+        except Exception as e:
+            logger.error(f"❌ خطأ في تحميل السائقين المتصلين: {e}")
+            return {}
+    
+    @timed_db
+    def claim_update(self, update_id):
+        """تسجيل التحديث كمعالج؛ يعيد False إن سجله عامل آخر و None عند الخطأ"""
         try:
             with self.get_cursor() as cur:
                 cur.execute("""
-                    UPDATE active_drivers 
-                    SET current_lat = %s, current_lng = %s, updated_at = CURRENT_TIMESTAMP
-                    WHERE driver_id = %s
-                """, (lat, lng, driver_id))
+                    INSERT INTO processed_updates (update_id) VALUES (%s)
+                    ON CONFLICT (update_id) DO NOTHING
+                """, (update_id,))
+                return cur.rowcount == 1
+        except Exception as e:
+            logger.error(f"❌ خطأ في تسجيل التحديث {update_id}: {e}")
+            return None
+    
+    @timed_db
+    def release_update(self, update_id):
+        """حذف تسجيل تحديث فشلت معالجته لتُقبل إعادة إرساله"""
+        try:
+            with self.get_cursor() as cur:
+                cur.execute("DELETE FROM processed_updates WHERE update_id = %s", (update_id,))
                 return True
         except Exception as e:
-            logger.error(f"❌ خطأ في تحديث موقع السائق: {e}")
+            logger.error(f"❌ خطأ في إلغاء تسجيل التحديث {update_id}: {e}")
             return False
     
+    @timed_db
     def get_available_drivers(self):
         """الحصول على السائقين المتاحين"""
         try:
-            with self.get_cursor() as cur:
-                cur.execute("""
-                    SELECT * FROM active_drivers 
+            with self.get_cursor(readonly=True, tuples=True) as cur:
+                cur.execute(f"""
+                    SELECT {ActiveDriver.columns()} FROM active_drivers 
                     WHERE is_available = TRUE
+                    AND updated_at > CURRENT_TIMESTAMP - %s * INTERVAL '1 second'
                     ORDER BY updated_at DESC
                     LIMIT 50
-                """)
-                return cur.fetchall()
+                """, (PRESENCE_TTL_S,))
+                return ActiveDriver.fetchall(cur)
         except Exception as e:
             logger.error(f"❌ خطأ في جلب السائقين المتاحين: {e}")
             return []
     
+    @timed_db
+    def get_dispatch_candidates(self, points, limit, radius_km=DISPATCH_RADIUS_KM):
+        """السائقون المتاحون داخل مربع حول كل نقطة التقاط، بإحداثيات عشرية جاهزة للتسعير المتجه"""
+        if not points:
+            return []
+        lat_min, lat_max, lng_min, lng_max = [], [], [], []
+        for lat, lng in points:
+            dlat = radius_km / 111.0
+            dlng = radius_km / (111.0 * max(math.cos(math.radians(lat)), 0.01))
+            lat_min.append(lat - dlat)
+            lat_max.append(lat + dlat)
+            lng_min.append(lng - dlng)
+            lng_max.append(lng + dlng)
+        try:
+            with self.get_cursor(readonly=True) as cur:
+                # التصفية بالمربع (عبر الفهرس) قبل الترتيب حتى لا يزيح سائقو المدينة سائقي المنطقة
+                cur.execute("""
+                    SELECT driver_id, username, current_lat, current_lng
+                    FROM (
+                        SELECT DISTINCT ON (d.driver_id)
+                               d.driver_id, d.username, d.updated_at,
+                               d.current_lat::float8 AS current_lat,
+                               d.current_lng::float8 AS current_lng
+                        FROM unnest(%s::numeric[], %s::numeric[], %s::numeric[], %s::numeric[])
+                             AS box(lat_min, lat_max, lng_min, lng_max)
+                        JOIN active_drivers d
+                          ON d.is_available
+                         AND d.current_lat BETWEEN box.lat_min AND box.lat_max
+                         AND d.current_lng BETWEEN box.lng_min AND box.lng_max
+                        WHERE d.updated_at > CURRENT_TIMESTAMP - %s * INTERVAL '1 second'
+                    ) candidates
+                    ORDER BY updated_at DESC
+                    LIMIT %s
+                """, (lat_min, lat_max, lng_min, lng_max, PRESENCE_TTL_S, limit))
+                return cur.fetchall()
+        except Exception as e:
+            logger.error(f"❌ خطأ في جلب السائقين المرشحين: {e}")
+            return []
+    
+    @timed_db
     def get_user_rides(self, user_id, limit=10):
         """الحصول على رحلات المستخدم"""
         try:
-            with self.get_cursor() as cur:
-                cur.execute("""
-                    SELECT * FROM rides 
+            with self.get_cursor(readonly=True, tuples=True) as cur:
+                cur.execute(f"""
+                    SELECT {Ride.columns()} FROM rides 
                     WHERE customer_id = %s OR driver_id = %s
                     ORDER BY created_at DESC 
                     LIMIT %s
                 """, (user_id, user_id, limit))
-                return cur.fetchall()
+                return Ride.fetchall(cur)
         except Exception as e:
             logger.error(f"❌ خطأ في جلب رحلات المستخدم: {e}")
             return []
     
-    def update_user_balance(self, user_id, amount):
-        """تحديث رصيد المستخدم"""
+    def _append_ride_event(self, cur, ride_id):
+        """تسجيل الحالة الحالية للرحلة كحدث ضمن المعاملة الجارية"""
+        cur.execute("SELECT pg_advisory_xact_lock_shared(%s)", (RIDE_EVENTS_LOCK_ID,))
+        cur.execute("""
+            INSERT INTO ride_events (ride_id, status, fare, accept_latency_s)
+            SELECT ride_id, status,
+            CASE WHEN status = 'completed' THEN fare END,
+            CASE WHEN status = 'accepted' THEN EXTRACT(EPOCH FROM accepted_at - created_at) END
+            FROM rides WHERE ride_id = %s
+        """, (ride_id,))
+    
+    @timed_db
+    def rollup_ride_stats(self, batch):
+        """
+        تجميع دفعة من أحداث الرحلات الجديدة في ride_stats_hourly وعدد رحلات المستخدمين
+        (total_rides)؛ يعيد عدد الأحداث المتبقية أو None
+        """
+        try:
+            # كل رقم تسلسلي حتى هذا الحد التُزم أو أُلغي (لا كتابات جارية أثناء القفل الحصري)
+            with self.get_cursor() as cur:
+                cur.execute("SELECT pg_advisory_xact_lock(%s)", (RIDE_EVENTS_LOCK_ID,))
+                cur.execute("SELECT COALESCE(MAX(seq), 0) AS seq FROM ride_events")
+                safe_seq = cur.fetchone()['seq']
+            
+            with self.get_cursor() as cur:
+                cur.execute("SELECT pg_try_advisory_xact_lock(%s) AS locked", (ANALYTICS_ROLLUP_LOCK_ID,))
+                if not cur.fetchone()['locked']:
+                    # عامل آخر يجمع الآن
+                    return 0
+                mark = int(self.get_meta('ride_events_seq', 0, cur))
+                upto = min(safe_seq, mark + batch)
+                if upto <= mark:
+                    return 0
+                cur.execute("""
+                    INSERT INTO ride_stats_hourly
+                    (hour, created, accepted, completed, cancelled, revenue, accept_latency_sum, accept_latency_count)
+                    SELECT date_trunc('hour', at),
+                        COUNT(*) FILTER (WHERE status = 'pending'),
+                        COUNT(*) FILTER (WHERE status = 'accepted'),
+                        COUNT(*) FILTER (WHERE status = 'completed'),
+                        COUNT(*) FILTER (WHERE status = 'cancelled'),
+                        COALESCE(SUM(fare), 0),
+                        COALESCE(SUM(accept_latency_s), 0),
+                        COUNT(accept_latency_s)
+                    FROM ride_events WHERE seq > %s AND seq <= %s
+                    GROUP BY date_trunc('hour', at)
+                    ON CONFLICT (hour) DO UPDATE SET
+                    created = ride_stats_hourly.created + EXCLUDED.created,
+                    accepted = ride_stats_hourly.accepted + EXCLUDED.accepted,
+                    completed = ride_stats_hourly.completed + EXCLUDED.completed,
+                    cancelled = ride_stats_hourly.cancelled + EXCLUDED.cancelled,
+                    revenue = ride_stats_hourly.revenue + EXCLUDED.revenue,
+                    accept_latency_sum = ride_stats_hourly.accept_latency_sum + EXCLUDED.accept_latency_sum,
+                    accept_latency_count = ride_stats_hourly.accept_latency_count + EXCLUDED.accept_latency_count
+                """, (mark, upto))
+                hours = cur.rowcount
+                # تحديث واحد لكل مستخدم في الدفعة بدل تحديث عند كل إكمال
+                cur.execute("""
+                    UPDATE users u SET total_rides = u.total_rides + done.rides
+                    FROM (
+                        SELECT party.user_id, COUNT(*) AS rides
+                        FROM ride_events e
+                        JOIN rides r ON r.ride_id = e.ride_id
+                        CROSS JOIN LATERAL (VALUES (r.customer_id), (NULLIF(r.driver_id, r.customer_id))) AS party(user_id)
+                        WHERE e.seq > %s AND e.seq <= %s AND e.status = 'completed' AND party.user_id IS NOT NULL
+                        GROUP BY party.user_id
+                    ) done
+                    WHERE u.user_id = done.user_id
+                """, (mark, upto))
+                self.set_meta('ride_events_seq', upto, cur)
+                if hours:
+                    logger.info(f"📈 تجميع أحداث الرحلات حتى {upto}: {hours} ساعة")
+                return safe_seq - upto
+        except Exception as e:
+            logger.error(f"❌ خطأ في تجميع أحداث الرحلات: {e}")
+            return None
+    
+    @timed_db
+    def get_ride_stats(self, days):
+        """الإجماليات من كل التجميعات وسلسلة ساعية لآخر days يوماً (الساعات الفارغة أصفار)"""
+        try:
+            with self.get_cursor(readonly=True) as cur:
+                cur.execute("""
+                    SELECT
+                        COALESCE(SUM(created), 0) AS total,
+                        COALESCE(SUM(completed), 0) AS completed,
+                        COALESCE(SUM(cancelled), 0) AS cancelled,
+                        COALESCE(SUM(revenue), 0) AS total_revenue
+                    FROM ride_stats_hourly
+                """)
+                totals = cur.fetchone()
+                cur.execute("""
+                    SELECT h.hour,
+                        COALESCE(s.created, 0) AS created,
+                        COALESCE(s.completed, 0) AS completed,
+                        COALESCE(s.cancelled, 0) AS cancelled,
+                        COALESCE(s.revenue, 0) AS revenue,
+                        s.accept_latency_sum / NULLIF(s.accept_latency_count, 0) AS accept_latency_s
+                    FROM generate_series(
+                        date_trunc('hour', CURRENT_TIMESTAMP::timestamp) - %s * INTERVAL '1 day' + INTERVAL '1 hour',
+                        date_trunc('hour', CURRENT_TIMESTAMP::timestamp),
+                        INTERVAL '1 hour'
+                    ) AS h(hour)
+                    LEFT JOIN ride_stats_hourly s ON s.hour = h.hour
+                    ORDER BY h.hour
+                """, (days,))
+                return totals, cur.fetchall()
+        except Exception as e:
+            logger.error(f"❌ خطأ في جلب تحليلات الرحلات: {e}")
+            return {}, []
+    
+    def _add_driver_daily_stats(self, cur, ride_id):
+        """إضافة الرحلة المكتملة إلى صف السائق لليوم"""
+        cur.execute("""
+            INSERT INTO driver_daily_stats (driver_id, day, trips, earnings)
+            SELECT driver_id, completed_at::date, 1, COALESCE(fare, 0)
+            FROM rides WHERE ride_id = %s AND driver_id IS NOT NULL
+            ON CONFLICT (driver_id, day) DO UPDATE SET
+            trips = driver_daily_stats.trips + 1,
+            earnings = driver_daily_stats.earnings + EXCLUDED.earnings,
+            updated_at = CURRENT_TIMESTAMP
+        """, (ride_id,))
+    
+    @timed_db
+    def get_driver_stats(self, driver_id):
+        """رحلات وأرباح السائق لليوم وآخر 7 و 30 يوماً من صفوف الأيام"""
+        try:
+            with self.get_cursor(readonly=True) as cur:
+                cur.execute("""
+                    SELECT
+                        COALESCE(SUM(trips) FILTER (WHERE day = CURRENT_DATE), 0) AS today_trips,
+                        COALESCE(SUM(earnings) FILTER (WHERE day = CURRENT_DATE), 0) AS today_earnings,
+                        COALESCE(SUM(trips) FILTER (WHERE day > CURRENT_DATE - 7), 0) AS week_trips,
+                        COALESCE(SUM(earnings) FILTER (WHERE day > CURRENT_DATE - 7), 0) AS week_earnings,
+                        COALESCE(SUM(trips), 0) AS month_trips,
+                        COALESCE(SUM(earnings), 0) AS month_earnings
+                    FROM driver_daily_stats
+                    WHERE driver_id = %s AND day > CURRENT_DATE - 30
+                """, (driver_id,))
+                return cur.fetchone()
+        except Exception as e:
+            logger.error(f"❌ خطأ في جلب إحصائيات السائق: {e}")
+            return None
+    
+    @timed_db
+    def reconcile_driver_stats(self, days):
+        """إعادة حساب أيام السائقين المكتملة من الرحلات مرة يومياً؛ يعيد عدد الصفوف المصححة أو None"""
+        try:
+            with self.get_cursor() as cur:
+                cur.execute("SELECT pg_try_advisory_xact_lock(%s) AS locked", (STATS_RECONCILE_LOCK_ID,))
+                if not cur.fetchone()['locked']:
+                    return 0
+                today = datetime.now().date().isoformat()
+                if self.get_meta('driver_stats_reconciled', None, cur) == today:
+                    return 0
+                # اليوم الجاري يُترك للتحديث التزايدي حتى لا تُفقد رحلة تكتمل أثناء المطابقة
+                cur.execute("""
+                    WITH truth AS (
+                        SELECT driver_id, completed_at::date AS day, COUNT(*) AS trips, COALESCE(SUM(fare), 0) AS earnings
+                        FROM rides
+                        WHERE status = 'completed' AND driver_id IS NOT NULL
+                        AND completed_at >= CURRENT_DATE - %s AND completed_at < CURRENT_DATE
+                        GROUP BY driver_id, completed_at::date
+                    ),
+                    fixed AS (
+                        INSERT INTO driver_daily_stats (driver_id, day, trips, earnings)
+                        SELECT driver_id, day, trips, earnings FROM truth
+                        ON CONFLICT (driver_id, day) DO UPDATE SET
+                        trips = EXCLUDED.trips,
+                        earnings = EXCLUDED.earnings,
+                        updated_at = CURRENT_TIMESTAMP
+                        WHERE (driver_daily_stats.trips, driver_daily_stats.earnings)
+                        IS DISTINCT FROM (EXCLUDED.trips, EXCLUDED.earnings)
+                        RETURNING 1
+                    ),
+                    removed AS (
+                        DELETE FROM driver_daily_stats s
+                        WHERE s.day >= CURRENT_DATE - %s AND s.day < CURRENT_DATE
+                        AND NOT EXISTS (SELECT 1 FROM truth t WHERE t.driver_id = s.driver_id AND t.day = s.day)
+                        RETURNING 1
+                    )
+                    SELECT (SELECT COUNT(*) FROM fixed) + (SELECT COUNT(*) FROM removed) AS repaired
+                """, (days, days))
+                repaired = cur.fetchone()['repaired']
+                self.set_meta('driver_stats_reconciled', today, cur)
+                if repaired:
+                    logger.warning(f"🧮 تصحيح {repaired} صف من إحصائيات السائقين اليومية")
+                return repaired
+        except Exception as e:
+            logger.error(f"❌ خطأ في مطابقة إحصائيات السائقين: {e}")
+            return None
+    
+    @timed_db
+    def rate_ride(self, ride_id, rater_id, stars):
+        """
+        تقييم الطرف الآخر في رحلة مكتملة مرة واحدة، وتحديث مجموع وعدد تقييماته
+        ومتوسطه في نفس المعاملة؛ يعيد False إذا قُيمت الرحلة مسبقاً أو لم يكن طرفاً فيها
+        """
+        try:
+            with self.get_cursor() as cur:
+                # العميل يقيم السائق والسائق يقيم العميل
+                cur.execute("""
+                    WITH rated AS (
+                        UPDATE rides SET
+                        driver_rating = CASE WHEN customer_id = %(rater)s THEN %(stars)s ELSE driver_rating END,
+                        customer_rating = CASE WHEN driver_id = %(rater)s THEN %(stars)s ELSE customer_rating END
+                        WHERE ride_id = %(ride)s AND status = 'completed' AND (
+                            (customer_id = %(rater)s AND driver_rating IS NULL)
+                            OR (driver_id = %(rater)s AND customer_rating IS NULL)
+                        )
+                        RETURNING CASE WHEN customer_id = %(rater)s THEN driver_id ELSE customer_id END AS rated_id
+                    )
+                    UPDATE users SET
+                    rating_sum = rating_sum + %(stars)s,
+                    rating_count = rating_count + 1,
+                    rating = ROUND((rating_sum + %(stars)s)::numeric / (rating_count + 1), 2)
+                    FROM rated WHERE users.user_id = rated.rated_id
+                    RETURNING users.user_id
+                """, {'ride': ride_id, 'rater': rater_id, 'stars': stars})
+                return cur.fetchone() is not None
+        except Exception as e:
+            logger.error(f"❌ خطأ في تسجيل التقييم: {e}")
+            return False
+    
+    @timed_db
+    def backfill_ratings(self, batch):
+        """
+        حساب مجاميع التقييم من الرحلات القديمة لدفعة مستخدمين
+        بعد آخر مستخدم معالج؛ يعيد True عند الانتهاء وFalse إذا بقيت دفعات
+        وNone إذا كان عامل آخر يعبئ الآن أو عند الخطأ
+        """
+        try:
+            with self.get_cursor() as cur:
+                cur.execute("SELECT pg_try_advisory_xact_lock(%s) AS locked", (RATING_BACKFILL_LOCK_ID,))
+                if not cur.fetchone()['locked']:
+                    return None
+                # آخر مستخدم معالج، و'done' بعد اكتمال التعبئة
+                after = self.get_meta('rating_backfill_after', '', cur)
+                if after == 'done':
+                    return True
+                # قفل صفوف الدفعة أولاً: التقييمات الجارية تنتظر ثم تضيف فوق المجموع المحسوب
+                cur.execute("""
+                    SELECT user_id FROM users WHERE user_id > %s
+                    ORDER BY user_id LIMIT %s FOR UPDATE
+                """, (after, batch))
+                ids = [row['user_id'] for row in cur.fetchall()]
+                if ids:
+                    cur.execute("""
+                        UPDATE users u SET
+                        rating_sum = agg.rating_sum,
+                        rating_count = agg.rating_count,
+                        rating = CASE WHEN agg.rating_count > 0
+                                 THEN ROUND(agg.rating_sum::numeric / agg.rating_count, 2) ELSE u.rating END
+                        FROM (
+                            SELECT user_id, COALESCE(SUM(stars), 0) AS rating_sum, COUNT(stars) AS rating_count
+                            FROM (
+                                SELECT driver_id AS user_id, driver_rating AS stars
+                                FROM rides WHERE driver_id = ANY(%s)
+                                UNION ALL
+                                SELECT customer_id, customer_rating
+                                FROM rides WHERE customer_id = ANY(%s)
+                            ) received
+                            GROUP BY user_id
+                        ) agg
+                        WHERE u.user_id = agg.user_id
+                    """, (ids, ids))
+                done = len(ids) < batch
+                self.set_meta('rating_backfill_after', 'done' if done else ids[-1], cur)
+                if done:
+                    logger.info("⭐ اكتملت تعبئة مجاميع التقييم من الرحلات القديمة")
+                return done
+        except Exception as e:
+            logger.error(f"❌ خطأ في تعبئة مجاميع التقييم: {e}")
+            return None
+    
+    def _append_ride_ledger(self, cur, ride_id):
+        """
+        قيود الرحلة المكتملة المدفوعة من المحفظة فقط: خصم العميل وإضافة المبلغ للسائق
+        (مرة واحدة لكل رحلة). الرحلات النقدية لا تُقيد: السائق استلم المبلغ مباشرة
+        والمنصة لم تستلم شيئاً تضيفه لمحفظته
+        """
+        cur.execute("SELECT pg_advisory_xact_lock_shared(%s)", (LEDGER_LOCK_ID,))
+        cur.execute("""
+            INSERT INTO payments (payment_id, ride_id, user_id, amount, payment_method, status)
+            SELECT ride_id || ':earning', ride_id, driver_id, fare, payment_method, 'completed'
+            FROM rides WHERE ride_id = %s AND payment_method = 'wallet' AND driver_id IS NOT NULL AND fare IS NOT NULL
+            UNION ALL
+            SELECT ride_id || ':charge', ride_id, customer_id, -fare, payment_method, 'completed'
+            FROM rides WHERE ride_id = %s AND payment_method = 'wallet' AND fare IS NOT NULL
+            ON CONFLICT (payment_id) DO NOTHING
+        """, (ride_id, ride_id))
+    
+    @timed_db
+    def update_user_balance(self, user_id, amount, payment_id=None, payment_method='adjustment'):
+        """إضافة قيد إلى رصيد المستخدم (payment_id يجعل الإضافة قابلة للتكرار بأمان)"""
         try:
             with self.get_cursor() as cur:
+                cur.execute("SELECT pg_advisory_xact_lock_shared(%s)", (LEDGER_LOCK_ID,))
                 cur.execute("""
-                    UPDATE users 
-                    SET balance = balance + %s
-                    WHERE user_id = %s
-                """, (amount, user_id))
+                    INSERT INTO payments (payment_id, user_id, amount, payment_method, status)
+                    VALUES (%s, %s, %s, %s, 'completed')
+                    ON CONFLICT (payment_id) DO NOTHING
+                """, (payment_id or str(uuid.uuid4()), user_id, amount, payment_method))
                 return True
         except Exception as e:
             logger.error(f"❌ خطأ في تحديث رصيد المستخدم: {e}")
             return False
+    
+    @timed_db
+    def get_balance(self, user_id):
+        """الرصيد = آخر تجميع + القيود بعد حد التجميع (في لقطة واحدة)"""
+        try:
+            with self.get_cursor() as cur:
+                cur.execute("""
+                    WITH mark AS (
+                        SELECT COALESCE((SELECT value::bigint FROM app_meta WHERE key = 'ledger_seq'), 0) AS seq
+                    )
+                    SELECT (
+                        COALESCE((SELECT balance FROM balance_rollups WHERE user_id = %s), 0)
+                        + COALESCE((
+                            SELECT SUM(p.amount) FROM payments p, mark
+                            WHERE p.user_id = %s AND p.seq > mark.seq AND p.status = 'completed'
+                        ), 0)
+                    )::float8 AS balance
+                """, (user_id, user_id))
+                return cur.fetchone()['balance']
+        except Exception as e:
+            logger.error(f"❌ خطأ في حساب رصيد المستخدم: {e}")
+            return None
+    
+    @timed_db
+    def rollup_ledger(self, batch):
+        """تجميع دفعة من القيود الجديدة في balance_rollups؛ يعيد عدد الأرقام المتبقية بعدها أو None"""
+        try:
+            # كل رقم تسلسلي حتى هذا الحد التُزم أو أُلغي (لا كتابات جارية أثناء القفل الحصري)
+            with self.get_cursor() as cur:
+                cur.execute("SELECT pg_advisory_xact_lock(%s)", (LEDGER_LOCK_ID,))
+                cur.execute("SELECT COALESCE(MAX(seq), 0) AS seq FROM payments")
+                safe_seq = cur.fetchone()['seq']
+            
+            with self.get_cursor() as cur:
+                cur.execute("SELECT pg_try_advisory_xact_lock(%s) AS locked", (LEDGER_ROLLUP_LOCK_ID,))
+                if not cur.fetchone()['locked']:
+                    # عامل آخر يجمع الآن
+                    return 0
+                mark = int(self.get_meta('ledger_seq', 0, cur))
+                upto = min(safe_seq, mark + batch)
+                if upto <= mark:
+                    return 0
+                cur.execute("""
+                    INSERT INTO balance_rollups (user_id, balance, rolled_seq)
+                    SELECT user_id, SUM(amount), MAX(seq) FROM payments
+                    WHERE seq > %s AND seq <= %s AND status = 'completed' AND user_id IS NOT NULL
+                    GROUP BY user_id
+                    ON CONFLICT (user_id) DO UPDATE SET
+                    balance = balance_rollups.balance + EXCLUDED.balance,
+                    rolled_seq = EXCLUDED.rolled_seq,
+                    updated_at = CURRENT_TIMESTAMP
+                """, (mark, upto))
+                users = cur.rowcount
+                self.set_meta('ledger_seq', upto, cur)
+                if users:
+                    logger.info(f"💳 تجميع الدفتر حتى {upto}: {users} مستخدم")
+                return safe_seq - upto
+        except Exception as e:
+            logger.error(f"❌ خطأ في تجميع الدفتر: {e}")
+            return None
 
 # إنشاء كائن قاعدة البيانات
 db = DatabaseManager()
 
+# عدادات العرض والطلب لتسعير الذروة (لكل عملية)
+surge_pricing = SurgePricing()
+
+# حضور السائقين: النبضات تُكتب إلى active_drivers في دفعات
+presence = DriverPresence(
+    flush_heartbeats=db.sync_driver_heartbeats,
+    flush_expired=db.expire_drivers,
+    load_online=db.load_online_drivers,
+)
+
+admission = AdmissionController()
+rate_limiter = RateLimiter()
+
+# Telegram يعيد إرسال نفس update_id عند البطء أو الخطأ: نعالج كل تحديث مرة واحدة
+if DEDUPE_BACKEND == 'postgres':
+    update_dedupe = UpdateDeduplicator(claim_shared=db.claim_update, release_shared=db.release_update)
+else:
+    update_dedupe = UpdateDeduplicator()
+
 # ============================================================================
 # دوال مساعدة
 # ============================================================================
 
-def calculate_fare(distance_km, duration_min):
-    """حساب تكلفة الرحلة"""
+def calculate_fare(distance_km, duration_min, surge=1.0):
+    """حساب تكلفة الرحلة (يقبل أرقاماً أو مصفوفات NumPy) مع معامل الذروة"""
     base_fare = 5.0  # رسوم البدء
     per_km = 2.0     # سعر الكيلومتر
     per_min = 0.5    # سعر الدقيقة
     
-    fare = base_fare + (distance_km * per_km) + (duration_min * per_min)
-    return round(fare, 2)
+    fare = (base_fare + (distance_km * per_km) + (duration_min * per_min)) * surge
+    return np.round(fare, 2)
+
+def rate_limit_exceeded(message, action, notify=True):
+    """استهلاك رمز من حد المستخدم للإجراء؛ يعيد True عند التجاوز (مع رد ودي)"""
+    wait = rate_limiter.check(action, message.from_user.id)
+    if not wait:
+        return False
+    logger.info(f"🪣 تجاوز حد {action} من: {message.from_user.id}")
+    if notify:
+        bot.send_message(
+            message.chat.id,
+            "⏳ <b>طلبات كثيرة في وقت قصير</b>\n\n"
+            f"يرجى الانتظار {int(wait) + 1} ثانية ثم المحاولة مجدداً."
+        )
+    return True
+
+def rate_limited(action):
+    """تطبيق حد المعدل لفئة الإجراء على معالج رسائل"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(message):
+            if rate_limit_exceeded(message, action):
+                return
+            return func(message)
+        return wrapper
+    return decorator
+
+def remember_quotes(ride_id, quotes):
+    """حفظ عروض الأسعار المرسلة لكل سائق حتى يُطبق سعر السائق الذي يقبل الرحلة"""
+    now = time.time()
+    if len(ride_requests) > 1000:
+        for key in [key for key, entry in ride_requests.items() if now - entry['created'] > QUOTE_TTL]:
+            ride_requests.pop(key, None)
+    ride_requests[ride_id] = {
+        'created': now,
+        'quotes': {str(driver['driver_id']): quote for driver, quote in quotes},
+    }
+
+def accepted_quote(ride_id, driver_id):
+    """عرض السعر الذي أُرسل للسائق عند قبوله الرحلة (إن وجد في هذه العملية)"""
+    entry = ride_requests.pop(ride_id, None)
+    if not entry:
+        return None
+    return entry['quotes'].get(driver_id)
+
+def send_ride_offer(driver, ride_id, customer_name, quote, surge):
+    """إرسال عرض رحلة لسائق مع أزرار القبول والرفض"""
+    surge_note = f"⚡ <b>طلب مرتفع:</b> الأسعار ×{surge}\n" if surge > 1.0 else ""
+    try:
+        bot.send_message(
+            driver['driver_id'],
+            f"🚖 <b>طلب رحلة جديد</b>\n\n"
+            f"• <b>العميل:</b> {customer_name}\n"
+            f"• <b>المسافة:</b> {quote['distance_km']} كم (≈ {quote['eta_min']} دقيقة)\n"
+            f"• <b>التكلفة:</b> {quote['fare']} ريال\n"
+            f"{surge_note}\n"
+            f"<b>رقم الرحلة:</b> {ride_id[-8:]}",
+            reply_markup=create_inline_ride_buttons(ride_id)
+        )
+        OFFERS_DISPATCHED.inc()
+        return True
+    except Exception as e:
+        logger.error(f"❌ فشل إرسال طلب الرحلة للسائق {driver['driver_id']}: {e}")
+        return False
+
+def send_batch_offer(ride, driver, distance_km):
+    """إرسال العرض الموجه الذي اختاره المطابق الدفعي"""
+    quote = quote_drivers(
+        ride['lat'], ride['lng'], [driver],
+        functools.partial(calculate_fare, surge=ride['surge'])
+    )[0][1]
+    remember_quotes(ride['ride_id'], [(driver, quote)])
+    return send_ride_offer(driver, ride['ride_id'], ride['customer_name'], quote, ride['surge'])
+
+def ride_is_pending(ride_id):
+    """هل ما زالت الرحلة بانتظار سائق"""
+    ride = db.get_ride(ride_id)
+    return bool(ride) and ride['status'] == RideStatus.PENDING
+
+def expire_batch_ride(ride):
+    """إلغاء رحلة لم يُعثر لها على سائق خلال المهلة وإعلام العميل"""
+    if not ride_is_pending(ride['ride_id']):
+        return
+    # قد يقبلها سائق بين الفحص والإلغاء
+    if not db.update_ride_status(ride['ride_id'], RideStatus.CANCELLED, notify=[(
+        ride['customer_id'],
+        "⚠️ <b>لم نعثر على سائق متاح لرحلتك</b>\n\n"
+        "يرجى المحاولة مرة أخرى لاحقاً.",
+        create_ride_keyboard("customer").to_json()
+    )]):
+        return
+    outbox_dispatcher.wake()
+    set_user_state(ride['customer_id'], UserState.MAIN_MENU)
+
+# ============================================================================
+# صندوق الصادر
+# ============================================================================
+
+def send_outbox_message(row):
+    """إرسال رسالة من صندوق الصادر مع تصنيف أخطاء Telegram"""
+    try:
+        bot.send_message(row['chat_id'], row['text'], reply_markup=row['reply_markup'])
+    except apihelper.ApiTelegramException as e:
+        if e.error_code == 429:
+            raise RetryAfter((e.result_json.get('parameters') or {}).get('retry_after', 5), e.description)
+        if e.error_code in (400, 403):
+            # المستخدم حظر البوت أو المحادثة غير موجودة
+            raise PermanentError(e.description)
+        raise
+
+# إشعارات الرحلات تُحفظ مع تغيير الحالة وتُرسل من خيط خلفي (يعمل عند أول إشعار)
+outbox_dispatcher = OutboxDispatcher(
+    claim=db.claim_outbox,
+    send=send_outbox_message,
+    finish=db.finish_outbox,
+)
+
+# ============================================================================
+# دفتر المدفوعات
+# ============================================================================
+
+# لقطات الأرصدة لكل عامل (تُلغى محلياً عند إضافة قيود، وتنتهي بعد BALANCE_CACHE_S)
+balance_cache = BalanceCache(db.get_balance)
+
+def run_ledger_rollup():
+    """تجميع القيود الجديدة حتى اللحاق بآخر قيد ملتزم"""
+    while True:
+        remaining = db.rollup_ledger(LEDGER_ROLLUP_BATCH)
+        if not remaining:
+            return
+
+ledger_rollup_job = PeriodicJob('ledger-rollup', LEDGER_ROLLUP_S, run_ledger_rollup)
+
+def run_analytics_rollup():
+    """تجميع أحداث الرحلات الجديدة حتى اللحاق بآخر حدث ملتزم"""
+    while True:
+        remaining = db.rollup_ride_stats(ANALYTICS_ROLLUP_BATCH)
+        if not remaining:
+            return
+
+analytics_rollup_job = PeriodicJob('analytics-rollup', ANALYTICS_ROLLUP_S, run_analytics_rollup)
+
+# مطابقة ليلية لإحصائيات السائقين (أول فحص بعد منتصف الليل في أي عامل)
+stats_reconcile_job = PeriodicJob(
+    'driver-stats-reconcile', STATS_RECONCILE_CHECK_S,
+    lambda: db.reconcile_driver_stats(STATS_RECONCILE_DAYS)
+)
+
+# ============================================================================
+# التقييمات
+# ============================================================================
+
+rating_backfill_done = threading.Event()
+
+def run_rating_backfill():
+    """تعبئة مجاميع التقييم دفعة بعد دفعة حتى الاكتمال، ثم لا شيء في هذا العامل"""
+    while not rating_backfill_done.is_set():
+        done = db.backfill_ratings(RATING_BACKFILL_BATCH)
+        if done is None:
+            # عامل آخر يعبئ الآن أو حدث خطأ: المتابعة في الدورة التالية
+            return
+        if done:
+            rating_backfill_done.set()
+
+rating_backfill_job = PeriodicJob('rating-backfill', RATING_BACKFILL_S, run_rating_backfill)
+
+# ============================================================================
+# تتبع الرحلات المباشر
+# ============================================================================
+
+# تقييد تحديثات الموقع المباشر لكل سائق
+live_throttle = Throttle()
+
+def track_ride(driver_id, ride_id, customer_id):
+    """بدء متابعة رحلة السائق (active_rides: السائق ← الرحلة الجارية)"""
+    active_rides[driver_id] = {
+        'ride_id': ride_id,
+        'customer_id': customer_id,
+        'trace': None,
+        'live_message_id': None,
+    }
+
+def forward_live_location(ride, lat, lng):
+    """عرض موقع السائق للعميل كرسالة موقع مباشر تُحدّث في مكانها"""
+    try:
+        if ride['live_message_id'] is None:
+            sent = bot.send_location(ride['customer_id'], lat, lng, live_period=LIVE_SHARE_PERIOD_S)
+            ride['live_message_id'] = sent.message_id
+        else:
+            bot.edit_message_live_location(
+                lat, lng, chat_id=ride['customer_id'], message_id=ride['live_message_id']
+            )
+    except Exception as e:
+        logger.error(f"❌ فشل تحديث موقع السائق للعميل: {e}")
+
+def finish_ride_tracking(driver_id, ride_id, save=True):
+    """إيقاف المتابعة وحفظ المسار المبسط مع المسافة والمدة الفعليتين"""
+    ride = active_rides.get(driver_id)
+    if not ride or ride['ride_id'] != ride_id:
+        return None
+    del active_rides[driver_id]
+    if ride['live_message_id'] is not None:
+        try:
+            bot.stop_message_live_location(chat_id=ride['customer_id'], message_id=ride['live_message_id'])
+        except Exception as e:
+            logger.error(f"❌ فشل إيقاف الموقع المباشر: {e}")
+    trace = ride['trace']
+    if not save or trace is None or len(trace) < 2:
+        return None
+    distance_km = trace.distance_km()
+    duration_min = max(1, round(trace.duration_s() / 60))
+    encoded = trace.encode()
+    db.save_ride_trace(ride_id, distance_km, duration_min, RideTrace.point_count(encoded), encoded)
+    logger.info(f"🛰️ تم حفظ مسار الرحلة {ride_id}: {len(trace)} نقطة، {distance_km:.2f} كم")
+    return distance_km, duration_min
+
+# المطابق الدفعي (يعمل خيطه عند أول رحلة في وضع batch)
+batch_matcher = BatchMatcher(
+    fetch_drivers=lambda points: db.get_dispatch_candidates(points, DISPATCH_CANDIDATES),
+    send_offer=send_batch_offer,
+    is_pending=ride_is_pending,
+    on_expired=expire_batch_ride,
+)
 
 def create_ride_keyboard(user_type="customer"):
     """إنشاء لوحة مفاتيح حسب نوع المستخدم"""
@@ -462,6 +2044,17 @@ def create_inline_ride_status_buttons(ride_id):
     markup.add(*buttons)
     return markup
 
+def create_inline_rating_buttons(ride_id):
+    """إنشاء أزرار تقييم الطرف الآخر في الرحلة من 1 إلى 5"""
+    markup = InlineKeyboardMarkup()
+    markup.row_width = 5
+    
+    markup.add(*[
+        InlineKeyboardButton(f"{stars}⭐", callback_data=f"rate_{ride_id}_{stars}")
+        for stars in range(1, 6)
+    ])
+    return markup
+
 def get_user_state(user_id):
     """الحصول على حالة المستخدم"""
     return user_states.get(str(user_id), UserState.MAIN_MENU)
@@ -486,6 +2079,8 @@ def get_user_data(user_id, key, default=None):
 # ============================================================================
 
 @bot.message_handler(commands=['start', 'help'])
+@timed_handler
+@inline_reply
 def handle_start(message):
     """معالجة أمر البدء"""
     user_id = str(message.from_user.id)
@@ -524,6 +2119,7 @@ def handle_start(message):
     logger.info(f"✅ تم الترحيب بـ {first_name}")
 
 @bot.message_handler(func=lambda msg: msg.text in ['👤 عميل', '🚖 سائق'])
+@timed_handler
 def handle_role_selection(message):
     """معالجة اختيار الدور"""
     user_id = str(message.from_user.id)
@@ -553,6 +2149,7 @@ def handle_role_selection(message):
     logger.info(f"✅ تم تعيين دور {role} لـ {user_id}")
 
 @bot.message_handler(func=lambda msg: msg.text == '🚖 طلب رحلة جديدة')
+@timed_handler
 def handle_new_ride_request(message):
     """معالجة طلب رحلة جديدة"""
     user_id = str(message.from_user.id)
@@ -582,6 +2179,7 @@ def handle_new_ride_request(message):
     )
 
 @bot.message_handler(func=lambda msg: msg.text == '🟢 بدء العمل')
+@timed_handler
 def handle_driver_start(message):
     """بدء عمل السائق"""
     user_id = str(message.from_user.id)
@@ -596,16 +2194,19 @@ def handle_driver_start(message):
     
     # إضافة السائق إلى القائمة النشطة
     db.add_active_driver(user_id, user['username'] or user['first_name'])
+    presence.heartbeat(user_id)
     
     bot.send_message(
         message.chat.id,
         "✅ <b>تم تفعيل وضع السائق!</b>\n\n"
         "🎯 أنت الآن تستقبل طلبات الركوب تلقائياً.\n"
-        "📍 تأكد من تحديث موقعك بانتظام.\n\n"
+        "📍 تأكد من تحديث موقعك بانتظام.\n"
+        f"📡 شارك موقعك المباشر حتى لا تُعتبر غير متصل بعد {int(PRESENCE_TTL_S // 60)} دقيقة.\n\n"
         "لإيقاف الخدمة، اضغط '🔴 إنهاء العمل'"
     )
 
 @bot.message_handler(func=lambda msg: msg.text == '🔴 إنهاء العمل')
+@timed_handler
 def handle_driver_stop(message):
     """إنهاء عمل السائق"""
     user_id = str(message.from_user.id)
@@ -613,6 +2214,7 @@ def handle_driver_stop(message):
     logger.info(f"🔴 إنهاء عمل سائق: {user_id}")
     
     # إزالة السائق من القائمة النشطة
+    presence.offline(user_id)
     db.remove_active_driver(user_id)
     
     bot.send_message(
@@ -622,6 +2224,7 @@ def handle_driver_stop(message):
     )
 
 @bot.message_handler(content_types=['location'])
+@timed_handler
 def handle_location(message):
     """معالجة الموقع المرسل"""
     user_id = str(message.from_user.id)
@@ -631,17 +2234,34 @@ def handle_location(message):
     logger.info(f"📍 موقع من: {user_id} - {location.latitude}, {location.longitude}")
     
     if user_state == UserState.REQUESTING_RIDE:
+        # كل طلب يرسل عروضاً لعشرات السائقين
+        if rate_limit_exceeded(message, 'ride'):
+            return
+        
         # إنشاء طلب رحلة جديد
         ride_id = f"ride_{user_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
         
+        # البحث عن سائقين متاحين وتسعير الرحلة لكل منهم حسب بعده عن العميل
+        available_drivers = db.get_dispatch_candidates([(location.latitude, location.longitude)], DISPATCH_CANDIDATES)
+        coordinates = driver_coordinates(available_drivers)
+        surge = surge_pricing.observe_request(location.latitude, location.longitude, *coordinates)
+        quotes = quote_drivers(
+            location.latitude, location.longitude, available_drivers,
+            functools.partial(calculate_fare, surge=surge),
+            limit=DISPATCH_MAX_OFFERS, coordinates=coordinates
+        )
+        surge_note = f"⚡ <b>طلب مرتفع:</b> الأسعار ×{surge}\n" if surge > 1.0 else ""
+        
         ride_data = {
             'ride_id': ride_id,
             'customer_id': user_id,
             'pickup_location': 'الموقع المرسل',
             'pickup_lat': location.latitude,
             'pickup_lng': location.longitude,
-            'fare': 15.0  # سعر افتراضي
+            # السعر المبدئي هو سعر أقرب سائق
+            'fare': quotes[0][1]['fare'] if quotes else float(calculate_fare(0, 0, surge))
         }
+        ride_data['payment_method'], payment_note = ride_payment_method(user_id, ride_data['fare'])
         
         # حفظ الرحلة في قاعدة البيانات
         if db.save_ride(ride_data):
@@ -655,39 +2275,43 @@ def handle_location(message):
             set_user_state(user_id, UserState.WAITING_DRIVER)
             
             # إعلام المستخدم
+            estimate = (
+                f"• <b>أقرب سائق:</b> {quotes[0][1]['eta_min']} دقيقة\n"
+                f"• <b>التكلفة التقديرية:</b> {ride_data['fare']} ريال\n"
+                f"{surge_note}\n"
+                if quotes else ""
+            )
             bot.send_message(
                 message.chat.id,
                 "📍 <b>تم استلام موقعك بنجاح!</b>\n\n"
                 f"• <b>خط العرض:</b> {location.latitude:.6f}\n"
                 f"• <b>خط الطول:</b> {location.longitude:.6f}\n\n"
+                f"{estimate}"
+                f"{payment_note}"
                 "🚖 <b>تم إنشاء طلب رحلة!</b>\n"
                 "⏳ جاري البحث عن سائق قريب...",
                 reply_markup=types.ReplyKeyboardRemove()
             )
             
-            # البحث عن سائقين متاحين
-            available_drivers = db.get_available_drivers()
-            
-            if available_drivers:
-                # إرسال طلب الرحلة للسائقين المتاحين
-                for driver in available_drivers:
-                    try:
-                        # إنشاء أزرار للرد على الطلب
-                        markup = create_inline_ride_buttons(ride_id)
-                        
-                        bot.send_message(
-                            driver['driver_id'],
-                            f"🚖 <b>طلب رحلة جديد</b>\n\n"
-                            f"• <b>العميل:</b> {message.from_user.first_name}\n"
-                            f"• <b>المسافة:</b> قريب منك\n"
-                            f"• <b>التكلفة:</b> 15 ريال\n\n"
-                            f"<b>رقم الرحلة:</b> {ride_id[-8:]}",
-                            reply_markup=markup
-                        )
-                    except Exception as e:
-                        logger.error(f"❌ فشل إرسال طلب الرحلة للسائق {driver['driver_id']}: {e}")
+            if quotes and DISPATCH_MODE == 'batch':
+                # سائق واحد يُختار في الدفعة القادمة
+                batch_matcher.submit({
+                    'ride_id': ride_id,
+                    'customer_id': user_id,
+                    'customer_name': message.from_user.first_name,
+                    'lat': location.latitude,
+                    'lng': location.longitude,
+                    'surge': surge,
+                })
+                logger.info(f"🧩 تمت إضافة الرحلة {ride_id} إلى دفعة المطابقة")
+            elif quotes:
+                remember_quotes(ride_id, quotes)
+                
+                # إرسال طلب الرحلة لأقرب السائقين المتاحين
+                for driver, quote in quotes:
+                    send_ride_offer(driver, ride_id, message.from_user.first_name, quote, surge)
                 
-                logger.info(f"✅ تم إرسال طلب الرحلة {ride_id} لـ {len(available_drivers)} سائق")
+                logger.info(f"✅ تم إرسال طلب الرحلة {ride_id} لأقرب {len(quotes)} سائق")
             else:
                 bot.send_message(
                     message.chat.id,
@@ -706,10 +2330,14 @@ def handle_location(message):
             set_user_state(user_id, UserState.MAIN_MENU)
     
     elif user_state == UserState.MAIN_MENU:
+        # المواقع الزائدة تُهمل بصمت (الرد عليها يضاعف الرسائل)
+        if rate_limit_exceeded(message, 'location', notify=False):
+            return
+        
         # تحديث موقع السائق إذا كان سائقاً
         user = db.get_user(user_id)
         if user and user['role'] == 'driver':
-            db.update_driver_location(user_id, location.latitude, location.longitude)
+            presence.heartbeat(user_id, location.latitude, location.longitude)
             
             bot.send_message(
                 message.chat.id,
@@ -720,7 +2348,29 @@ def handle_location(message):
                 reply_markup=create_ride_keyboard("driver")
             )
 
+@bot.edited_message_handler(content_types=['location'])
+@timed_handler
+def handle_live_location(message):
+    """معالجة تحديثات الموقع المباشر (edited_message)"""
+    driver_id = str(message.from_user.id)
+    if not live_throttle.allow(driver_id):
+        return
+    
+    location = message.location
+    ride = active_rides.get(driver_id)
+    if ride is None:
+        # مشاركة دون رحلة جارية: تحديث موقع السائقين الموجودين في الفهرس فقط
+        # (العملاء ومن لم يبدأ العمل لا يدخلون فهرس التوزيع)
+        presence.touch(driver_id, location.latitude, location.longitude)
+        return
+    
+    if ride['trace'] is not None:
+        ride['trace'].append(location.latitude, location.longitude, message.edit_date or message.date)
+    forward_live_location(ride, location.latitude, location.longitude)
+
 @bot.message_handler(func=lambda msg: msg.text == '📋 رحلاتي السابقة')
+@timed_handler
+@rate_limited('history')
 def handle_my_rides(message):
     """عرض رحلات المستخدم السابقة"""
     user_id = str(message.from_user.id)
@@ -766,6 +2416,8 @@ def handle_my_rides(message):
     )
 
 @bot.message_handler(func=lambda msg: msg.text == '💰 رصيدي')
+@timed_handler
+@rate_limited('history')
 def handle_balance(message):
     """عرض رصيد المستخدم"""
     user_id = str(message.from_user.id)
@@ -775,16 +2427,74 @@ def handle_balance(message):
         bot.send_message(message.chat.id, "❌ يجب البدء باستخدام /start أولاً.")
         return
     
+    balance = balance_cache.get(user_id)
+    
     bot.send_message(
         message.chat.id,
-        f"💰 <b>رصيدك الحالي:</b> {user.get('balance', 0)} ريال\n\n"
+        f"💰 <b>رصيدك الحالي:</b> {balance if balance is not None else 'غير متاح حالياً'} ريال\n\n"
         f"📊 <b>إحصائياتك:</b>\n"
         f"• عدد الرحلات: {user.get('total_rides', 0)}\n"
         f"• تقييمك: {user.get('rating', 5.0)} ⭐",
         reply_markup=create_ride_keyboard("customer")
     )
 
+def driver_stats_or_reply(message):
+    """إحصائيات السائق من صفوف الأيام، أو None بعد الرد على غير السائق"""
+    user = db.get_user(str(message.from_user.id))
+    if not user or user['role'] != 'driver':
+        bot.send_message(message.chat.id, "❌ هذه الخدمة متاحة للسائقين فقط.")
+        return None
+    stats = db.get_driver_stats(str(message.from_user.id))
+    if stats is None:
+        bot.send_message(message.chat.id, "⚠️ الإحصائيات غير متاحة حالياً، حاول لاحقاً.",
+                         reply_markup=create_ride_keyboard("driver"))
+    return stats
+
+@bot.message_handler(func=lambda msg: msg.text == '💰 أرباحي')
+@timed_handler
+@rate_limited('history')
+def handle_driver_earnings(message):
+    """عرض أرباح السائق لليوم وآخر أسبوع وشهر"""
+    stats = driver_stats_or_reply(message)
+    if stats is None:
+        return
+    
+    bot.send_message(
+        message.chat.id,
+        f"💰 <b>أرباحي</b>\n\n"
+        f"• <b>اليوم:</b> {stats['today_earnings']} ريال ({stats['today_trips']} رحلة)\n"
+        f"• <b>آخر 7 أيام:</b> {stats['week_earnings']} ريال ({stats['week_trips']} رحلة)\n"
+        f"• <b>آخر 30 يوماً:</b> {stats['month_earnings']} ريال ({stats['month_trips']} رحلة)",
+        reply_markup=create_ride_keyboard("driver")
+    )
+
+@bot.message_handler(func=lambda msg: msg.text == '📋 رحلاتي')
+@timed_handler
+@rate_limited('history')
+def handle_driver_rides(message):
+    """عرض عدد رحلات السائق وآخر رحلاته"""
+    stats = driver_stats_or_reply(message)
+    if stats is None:
+        return
+    
+    response = (
+        f"📋 <b>رحلاتي</b>\n\n"
+        f"• <b>اليوم:</b> {stats['today_trips']} | "
+        f"<b>7 أيام:</b> {stats['week_trips']} | "
+        f"<b>30 يوماً:</b> {stats['month_trips']}\n\n"
+    )
+    
+    for ride in db.get_user_rides(str(message.from_user.id), limit=5):
+        created_time = ride['created_at'].strftime('%Y-%m-%d %H:%M') if ride['created_at'] else 'غير معروف'
+        response += (
+            f"🚖 <b>رحلة #{ride['ride_id'][-8:]}</b> - {ride['status']}\n"
+            f"• <b>التكلفة:</b> {ride['fare']} ريال | {created_time}\n"
+        )
+    
+    bot.send_message(message.chat.id, response, reply_markup=create_ride_keyboard("driver"))
+
 @bot.message_handler(func=lambda msg: msg.text == '📊 الرحلات المتاحة')
+@timed_handler
 def handle_available_rides(message):
     """عرض الرحلات المتاحة للسائقين"""
     user_id = str(message.from_user.id)
@@ -808,6 +2518,8 @@ def handle_available_rides(message):
     )
 
 @bot.message_handler(func=lambda msg: msg.text == '📞 الدعم' or msg.text == '📞 المساعدة')
+@timed_handler
+@inline_reply
 def handle_support(message):
     """عرض معلومات الدعم"""
     support_msg = """
@@ -844,7 +2556,48 @@ support@example.com
         reply_markup=create_ride_keyboard("customer")
     )
 
+PAYMENT_METHODS = {'cash': '💵 نقداً', 'wallet': '👛 المحفظة'}
+
+def ride_payment_method(user_id, fare):
+    """طريقة دفع الرحلة الجديدة وسطر توضيحي لها: المحفظة فقط إذا غطى الرصيد السعر المبدئي"""
+    user = db.get_user(user_id)
+    if not user or user['payment_method'] != 'wallet':
+        return 'cash', f"• <b>الدفع:</b> {PAYMENT_METHODS['cash']}\n\n"
+    balance = balance_cache.get(user_id)
+    if balance is None or balance < fare:
+        return 'cash', "• <b>الدفع:</b> 💵 نقداً (رصيد المحفظة لا يكفي)\n\n"
+    return 'wallet', f"• <b>الدفع:</b> {PAYMENT_METHODS['wallet']}\n\n"
+
+def create_payment_method_buttons(current):
+    """أزرار اختيار طريقة الدفع مع تعليم الحالية"""
+    markup = InlineKeyboardMarkup(row_width=2)
+    markup.add(*[
+        InlineKeyboardButton(f"{'✅ ' if method == current else ''}{label}", callback_data=f"pay_{method}")
+        for method, label in PAYMENT_METHODS.items()
+    ])
+    return markup
+
+@bot.message_handler(func=lambda msg: msg.text == '⚙️ الإعدادات')
+@timed_handler
+def handle_settings(message):
+    """إعدادات العميل: طريقة الدفع"""
+    user = db.get_user(str(message.from_user.id))
+    if not user:
+        bot.send_message(message.chat.id, "❌ يجب البدء باستخدام /start أولاً.")
+        return
+    
+    current = user['payment_method'] or 'cash'
+    bot.send_message(
+        message.chat.id,
+        "⚙️ <b>الإعدادات</b>\n\n"
+        f"• <b>طريقة الدفع:</b> {PAYMENT_METHODS.get(current, current)}\n\n"
+        "الدفع من المحفظة يُخصم عند إكمال الرحلة إذا كان رصيدك يكفي عند الطلب، وإلا تكون الرحلة نقداً.",
+        reply_markup=create_payment_method_buttons(current)
+    )
+
 @bot.message_handler(func=lambda msg: msg.text == 'رجوع')
+@timed_handler
+@inline_reply
 def handle_back(message):
     """العودة للقائمة الرئيسية"""
     user_id = str(message.from_user.id)
@@ -870,6 +2623,7 @@ def handle_back(message):
 # ============================================================================
 
 @bot.callback_query_handler(func=lambda call: True)
+@timed_handler
 def handle_callback_query(call):
     """معالجة استدعاء الأزرار"""
     user_id = str(call.from_user.id)
@@ -879,12 +2633,39 @@ def handle_callback_query(call):
     
     if callback_data.startswith('accept_'):
         # قبول الرحلة
-        ride_id = callback_data.split('_')[1]
+        ride_id = callback_data.split('_', 1)[1]
         ride = db.get_ride(ride_id)
         
         if ride and ride['status'] == RideStatus.PENDING:
-            # تحديث حالة الرحلة
-            db.update_ride_status(ride_id, RideStatus.ACCEPTED, user_id)
+            # تحديث حالة الرحلة بسعر العرض الذي وصل لهذا السائق
+            quote = accepted_quote(ride_id, user_id)
+            if quote:
+                ride['fare'] = quote['fare']
+            # أزرار حالة الرحلة للسائق وإعلام العميل يُحفظان مع القبول
+            accepted = db.update_ride_status(ride_id, RideStatus.ACCEPTED, user_id, fare=quote['fare'] if quote else None, notify=[
+                (
+                    user_id,
+                    f"🟢 <b>تم قبول الرحلة #{ride_id[-8:]}</b>\n\n"
+                    f"استخدم الأزرار أدناه لتحديث حالة الرحلة:",
+                    create_inline_ride_status_buttons(ride_id).to_json()
+                ),
+                (
+                    ride['customer_id'],
+                    f"✅ <b>تم العثور على سائق!</b>\n\n"
+                    f"🎉 تهانينا! سائقنا في طريقه إليك الآن.\n"
+                    f"• <b>رقم الرحلة:</b> {ride_id[-8:]}\n"
+                    f"• <b>التكلفة:</b> {ride['fare']} ريال\n\n"
+                    f"⏳ الرجاء الانتظار، السائق في الطريق...",
+                    None
+                ),
+            ])
+            if not accepted:
+                # سائق آخر سبقه إلى القبول
+                bot.answer_callback_query(call.id, "⚠️ الرحلة لم تعد متاحة")
+                return
+            outbox_dispatcher.wake()
+            batch_matcher.accepted(ride_id)
+            track_ride(user_id, ride_id, ride['customer_id'])
             
             # إعلام السائق
             bot.answer_callback_query(call.id, "✅ تم قبول الرحلة!")
@@ -896,32 +2677,12 @@ def handle_callback_query(call):
                 call.message.chat.id,
                 call.message.message_id
             )
-            
-            # إرسال أزرار حالة الرحلة للسائق
-            markup = create_inline_ride_status_buttons(ride_id)
-            bot.send_message(
-                user_id,
-                f"🟢 <b>تم قبول الرحلة #{ride_id[-8:]}</b>\n\n"
-                f"استخدم الأزرار أدناه لتحديث حالة الرحلة:",
-                reply_markup=markup
-            )
-            
-            # إعلام العميل
-            try:
-                bot.send_message(
-                    ride['customer_id'],
-                    f"✅ <b>تم العثور على سائق!</b>\n\n"
-                    f"🎉 تهانينا! سائقنا في طريقه إليك الآن.\n"
-                    f"• <b>رقم الرحلة:</b> {ride_id[-8:]}\n"
-                    f"• <b>التكلفة:</b> {ride['fare']} ريال\n\n"
-                    f"⏳ الرجاء الانتظار، السائق في الطريق..."
-                )
-            except Exception as e:
-                logger.error(f"❌ فشل إعلام العميل: {e}")
     
     elif callback_data.startswith('reject_'):
         # رفض الرحلة
-        ride_id = callback_data.split('_')[1]
+        ride_id = callback_data.split('_', 1)[1]
+        # في وضع batch تعود الرحلة للدفعة التالية دون هذا السائق
+        batch_matcher.reject(ride_id, user_id)
         
         bot.answer_callback_query(call.id, "❌ تم رفض الرحلة")
         bot.edit_message_text(
@@ -932,92 +2693,147 @@ def handle_callback_query(call):
     
     elif callback_data.startswith('arrived_'):
         # وصول السائق للموقع
-        ride_id = callback_data.split('_')[1]
+        ride_id = callback_data.split('_', 1)[1]
         ride = db.get_ride(ride_id)
         
         if ride and ride['driver_id'] == user_id:
-            bot.answer_callback_query(call.id, "📍 تم تحديث الحالة: وصلت للموقع")
-            
             # إعلام العميل
-            try:
-                bot.send_message(
-                    ride['customer_id'],
-                    f"📍 <b>السائق وصل إلى موقعك!</b>\n\n"
-                    f"🚗 السائق في انتظارك الآن.\n"
-                    f"• <b>رقم الرحلة:</b> {ride_id[-8:]}\n\n"
-                    f"⏳ الرجاء التوجه إلى موقع السائق."
-                )
-            except Exception as e:
-                logger.error(f"❌ فشل إعلام العميل: {e}")
+            db.enqueue_notifications(ride_id, [(
+                ride['customer_id'],
+                f"📍 <b>السائق وصل إلى موقعك!</b>\n\n"
+                f"🚗 السائق في انتظارك الآن.\n"
+                f"• <b>رقم الرحلة:</b> {ride_id[-8:]}\n\n"
+                f"⏳ الرجاء التوجه إلى موقع السائق.",
+                None
+            )])
+            outbox_dispatcher.wake()
+            
+            bot.answer_callback_query(call.id, "📍 تم تحديث الحالة: وصلت للموقع")
     
     elif callback_data.startswith('start_'):
         # بدء الرحلة
-        ride_id = callback_data.split('_')[1]
+        ride_id = callback_data.split('_', 1)[1]
         ride = db.get_ride(ride_id)
         
         if ride and ride['driver_id'] == user_id:
-            db.update_ride_status(ride_id, RideStatus.IN_PROGRESS)
+            started = db.update_ride_status(ride_id, RideStatus.IN_PROGRESS, notify=[(
+                ride['customer_id'],
+                f"▶️ <b>بدأت الرحلة!</b>\n\n"
+                f"🚖 الرحلة قد بدأت الآن.\n"
+                f"• <b>رقم الرحلة:</b> {ride_id[-8:]}\n"
+                f"• <b>وجهتك:</b> {ride.get('destination', 'غير محددة')}\n\n"
+                f"🚗 استمتع برحلتك!",
+                None
+            )])
+            if not started:
+                bot.answer_callback_query(call.id, "⚠️ لا يمكن بدء الرحلة في حالتها الحالية")
+                return
+            outbox_dispatcher.wake()
             
-            bot.answer_callback_query(call.id, "▶️ تم بدء الرحلة")
+            # تسجيل مسار الرحلة من نقاط الموقع المباشر
+            if active_rides.get(user_id, {}).get('ride_id') != ride_id:
+                track_ride(user_id, ride_id, ride['customer_id'])
+            active_rides[user_id]['trace'] = RideTrace()
             
-            # إعلام العميل
-            try:
-                bot.send_message(
-                    ride['customer_id'],
-                    f"▶️ <b>بدأت الرحلة!</b>\n\n"
-                    f"🚖 الرحلة قد بدأت الآن.\n"
-                    f"• <b>رقم الرحلة:</b> {ride_id[-8:]}\n"
-                    f"• <b>وجهتك:</b> {ride.get('destination', 'غير محددة')}\n\n"
-                    f"🚗 استمتع برحلتك!"
-                )
-            except Exception as e:
-                logger.error(f"❌ فشل إعلام العميل: {e}")
+            bot.answer_callback_query(call.id, "▶️ تم بدء الرحلة")
     
     elif callback_data.startswith('complete_'):
         # إنهاء الرحلة
-        ride_id = callback_data.split('_')[1]
+        ride_id = callback_data.split('_', 1)[1]
         ride = db.get_ride(ride_id)
         
         if ride and ride['driver_id'] == user_id:
-            db.update_ride_status(ride_id, RideStatus.COMPLETED)
+            if ride['status'] != RideStatus.IN_PROGRESS:
+                bot.answer_callback_query(call.id, "⚠️ لا يمكن إنهاء رحلة لم تبدأ أو انتهت")
+                return
+            measured = finish_ride_tracking(user_id, ride_id)
+            distance_line = (
+                f"• <b>المسافة:</b> {measured[0]:.1f} كم خلال {measured[1]} دقيقة\n"
+                if measured else ""
+            )
+            completed = db.update_ride_status(ride_id, RideStatus.COMPLETED, notify=[(
+                ride['customer_id'],
+                f"✅ <b>تم إنهاء الرحلة!</b>\n\n"
+                f"🎉 وصلت إلى وجهتك بنجاح.\n"
+                f"• <b>رقم الرحلة:</b> {ride_id[-8:]}\n"
+                f"{distance_line}"
+                f"• <b>التكلفة:</b> {ride['fare']} ريال\n\n"
+                f"⭐ كيف كانت رحلتك؟ قيّم السائق:",
+                create_inline_rating_buttons(ride_id).to_json()
+            ), (
+                user_id,
+                f"🎉 <b>أنهيت الرحلة #{ride_id[-8:]}</b>\n\n"
+                f"⭐ قيّم العميل:",
+                create_inline_rating_buttons(ride_id).to_json()
+            )])
+            if not completed:
+                bot.answer_callback_query(call.id, "⚠️ لا يمكن إنهاء رحلة لم تبدأ أو انتهت")
+                return
+            outbox_dispatcher.wake()
+            balance_cache.invalidate(user_id, ride['customer_id'])
             
             bot.answer_callback_query(call.id, "✅ تم إنهاء الرحلة")
-            
-            # إعلام العميل
-            try:
-                bot.send_message(
-                    ride['customer_id'],
-                    f"✅ <b>تم إنهاء الرحلة!</b>\n\n"
-                    f"🎉 وصلت إلى وجهتك بنجاح.\n"
-                    f"• <b>رقم الرحلة:</b> {ride_id[-8:]}\n"
-                    f"• <b>التكلفة:</b> {ride['fare']} ريال\n\n"
-                    f"⭐ الرجاء تقييم السائق من خلال الدعم الفني."
-                )
-            except Exception as e:
-                logger.error(f"❌ فشل إعلام العميل: {e}")
+    
+    elif callback_data.startswith('rate_'):
+        # تقييم الطرف الآخر بعد إنهاء الرحلة
+        ride_id, stars = callback_data.split('_', 1)[1].rsplit('_', 1)
+        if not stars.isdigit() or not 1 <= int(stars) <= 5:
+            bot.answer_callback_query(call.id, "❌ تقييم غير صالح")
+            return
+        
+        if db.rate_ride(ride_id, user_id, int(stars)):
+            bot.answer_callback_query(call.id, "🙏 شكراً لتقييمك!")
+            bot.edit_message_text(
+                f"⭐ <b>تم تقييم الرحلة #{ride_id[-8:]}:</b> {'⭐' * int(stars)}",
+                call.message.chat.id,
+                call.message.message_id
+            )
+        else:
+            bot.answer_callback_query(call.id, "ℹ️ تم تقييم هذه الرحلة مسبقاً")
+    
+    elif callback_data.startswith('pay_'):
+        # تغيير طريقة الدفع المفضلة
+        method = callback_data.split('_', 1)[1]
+        if method not in PAYMENT_METHODS:
+            bot.answer_callback_query(call.id, "❌ طريقة دفع غير صالحة")
+            return
+        
+        if db.set_payment_method(user_id, method):
+            bot.answer_callback_query(call.id, f"✅ طريقة الدفع: {PAYMENT_METHODS[method]}")
+            bot.edit_message_reply_markup(
+                call.message.chat.id,
+                call.message.message_id,
+                reply_markup=create_payment_method_buttons(method)
+            )
+        else:
+            bot.answer_callback_query(call.id, "⚠️ تعذر حفظ طريقة الدفع، حاول لاحقاً")
     
     elif callback_data.startswith('cancel_'):
         # إلغاء الرحلة
-        ride_id = callback_data.split('_')[1]
+        ride_id = callback_data.split('_', 1)[1]
         ride = db.get_ride(ride_id)
         
         if ride:
-            db.update_ride_status(ride_id, RideStatus.CANCELLED)
-            
-            bot.answer_callback_query(call.id, "❌ تم إلغاء الرحلة")
-            
             # إعلام العميل إذا كان السائق هو من ألغى
+            notify = []
             if ride['customer_id'] and ride['driver_id'] == user_id:
-                try:
-                    bot.send_message(
-                        ride['customer_id'],
-                        f"❌ <b>تم إلغاء الرحلة!</b>\n\n"
-                        f"تم إلغاء الرحلة #{ride_id[-8:]} من قبل السائق.\n"
-                        f"• <b>التكلفة:</b> {ride['fare']} ريال\n\n"
-                        f"🔁 يمكنك طلب رحلة جديدة."
-                    )
-                except Exception as e:
-                    logger.error(f"❌ فشل إعلام العميل: {e}")
+                notify.append((
+                    ride['customer_id'],
+                    f"❌ <b>تم إلغاء الرحلة!</b>\n\n"
+                    f"تم إلغاء الرحلة #{ride_id[-8:]} من قبل السائق.\n"
+                    f"• <b>التكلفة:</b> {ride['fare']} ريال\n\n"
+                    f"🔁 يمكنك طلب رحلة جديدة.",
+                    None
+                ))
+            if not db.update_ride_status(ride_id, RideStatus.CANCELLED, notify=notify):
+                bot.answer_callback_query(call.id, "⚠️ لا يمكن إلغاء الرحلة في حالتها الحالية")
+                return
+            if notify:
+                outbox_dispatcher.wake()
+            if ride['driver_id']:
+                finish_ride_tracking(ride['driver_id'], ride_id, save=False)
+            
+            bot.answer_callback_query(call.id, "❌ تم إلغاء الرحلة")
 
 # ============================================================================
 # صفحات الويب
@@ -1034,7 +2850,7 @@ def home():
     
     # الحصول على إحصائيات من قاعدة البيانات
     try:
-        with db.get_cursor() as cur:
+        with db.get_cursor(readonly=True) as cur:
             cur.execute("SELECT COUNT(*) as total_users FROM users")
             total_users = cur.fetchone()['total_users']
             
@@ -1161,31 +2977,21 @@ def home():
 @app.route('/dashboard')
 def dashboard():
     """لوحة التحكم"""
+    # إحصائيات الرحلات من التجميعات الساعية (تتأخر حتى ANALYTICS_ROLLUP_S)
+    ride_stats, hourly = db.get_ride_stats(ANALYTICS_CHART_DAYS)
+    
     try:
-        with db.get_cursor() as cur:
-            # إحصائيات الرحلات
-            cur.execute("""
-                SELECT 
-                    COUNT(*) as total,
-                    SUM(CASE WHEN status = 'completed' THEN 1 ELSE 0 END) as completed,
-                    SUM(CASE WHEN status = 'cancelled' THEN 1 ELSE 0 END) as cancelled,
-                    SUM(CASE WHEN status = 'pending' THEN 1 ELSE 0 END) as pending,
-                    COALESCE(SUM(fare), 0) as total_revenue
-                FROM rides
-            """)
-            ride_stats = cur.fetchone()
-            
+        with db.get_cursor(readonly=True, tuples=True) as cur:
             # آخر الرحلات
-            cur.execute("SELECT * FROM rides ORDER BY created_at DESC LIMIT 10")
-            recent_rides = cur.fetchall()
+            cur.execute(f"SELECT {Ride.columns()} FROM rides ORDER BY created_at DESC LIMIT 10")
+            recent_rides = Ride.fetchall(cur)
             
             # السائقين النشطين
-            cur.execute("SELECT * FROM active_drivers WHERE is_available = TRUE ORDER BY updated_at DESC")
-            active_drivers = cur.fetchall()
+            cur.execute(f"SELECT {ActiveDriver.columns()} FROM active_drivers WHERE is_available = TRUE ORDER BY updated_at DESC")
+            active_drivers = ActiveDriver.fetchall(cur)
             
     except Exception as e:
         logger.error(f"❌ خطأ في جلب بيانات لوحة التحكم: {e}")
-        ride_stats = {}
         recent_rides = []
         active_drivers = []
     
@@ -1202,6 +3008,30 @@ def dashboard():
         </tr>
         """
     
+    labels = [row['hour'].strftime('%m-%d %H:00') for row in hourly]
+    charts_html = "".join([
+        svg_line_chart("🚖 الرحلات الجديدة بالساعة", [row['created'] for row in hourly], labels),
+        svg_line_chart("💵 الإيرادات بالساعة", [float(row['revenue']) for row in hourly], labels,
+                       color='#2e7d32', unit=' ريال'),
+        svg_line_chart("⏱️ متوسط زمن القبول", [
+            None if row['accept_latency_s'] is None else round(row['accept_latency_s'], 1) for row in hourly
+        ], labels, color='#f57c00', unit=' ث'),
+        svg_line_chart("❌ نسبة الإلغاء", [
+            round(100.0 * row['cancelled'] / row['created'], 1) if row['created'] else None for row in hourly
+        ], labels, color='#c62828', unit='%'),
+    ])
+    
+    surge_html = ""
+    for cell in surge_pricing.snapshot():
+        surge_html += f"""
+        <tr>
+            <td>{cell['lat']}, {cell['lng']}</td>
+            <td>{cell['demand']}</td>
+            <td>{cell['supply']}</td>
+            <td>{'⚡' if cell['multiplier'] > 1.0 else ''} ×{cell['multiplier']}</td>
+        </tr>
+        """
+    
     drivers_html = ""
     for driver in active_drivers:
         drivers_html += f"""
@@ -1321,6 +3151,11 @@ def dashboard():
                 <a href="/set_webhook" class="btn">⚙️ تحديث الويب هوك</a>
             </div>
             
+            <h2>📈 آخر {ANALYTICS_CHART_DAYS} يوماً</h2>
+            <div style="display: grid; gap: 20px; margin-bottom: 30px;">
+                {charts_html}
+            </div>
+            
             <h2>🚖 آخر الرحلات</h2>
             <table>
                 <thead>
@@ -1353,6 +3188,21 @@ def dashboard():
                     {drivers_html}
                 </tbody>
             </table>
+            
+            <h2 style="margin-top: 40px;">⚡ تسعير الذروة (آخر {SURGE_WINDOW_S / 60:.0f} دقيقة)</h2>
+            <table>
+                <thead>
+                    <tr>
+                        <th>مركز الخلية</th>
+                        <th>الطلبات</th>
+                        <th>السائقون المتاحون</th>
+                        <th>المعامل</th>
+                    </tr>
+                </thead>
+                <tbody>
+                    {surge_html}
+                </tbody>
+            </table>
         </div>
     </body>
     </html>
@@ -1511,23 +3361,77 @@ def test_bot():
 def webhook():
     """نقطة استقبال تحديثات Telegram"""
     if request.headers.get('content-type') == 'application/json':
+        start = time.perf_counter()
         try:
             json_string = request.get_data().decode('utf-8')
             update = telebot.types.Update.de_json(json_string)
             
             logger.info(f"📩 استلام تحديث: {update.update_id}")
+            UPDATES_TOTAL.inc(update_type(update))
             
-            bot.process_new_updates([update])
+            # التحكم في القبول قبل أي عمل: تحت الضغط يبقى العامل قادراً على الرد
+            priority = update_priority(update)
+            if not admission.acquire(priority):
+                logger.warning(f"🚦 إسقاط تحديث ({priority}): {update.update_id}")
+                return shed_response(update, priority)
+            
+            try:
+                if not update_dedupe.claim(update.update_id):
+                    # إعادة تسليم لتحديث سبقت معالجته: نقر بالاستلام دون إعادة التنفيذ
+                    logger.info(f"♻️ تحديث مكرر تم تجاهله: {update.update_id}")
+                    return 'OK', 200
+                
+                # أي نشاط من سائق متصل يمدد حضوره
+                user_id = update_user_id(update)
+                if user_id:
+                    presence.touch(user_id)
+                
+                capture = WebhookReply() if INLINE_WEBHOOK_REPLY else None
+                _reply_context.capture = capture
+                try:
+                    with track_inflight(), db.update_scope():
+                        bot.process_new_updates([update])
+                except Exception:
+                    # سنعيد 500 وسيعيد Telegram الإرسال: يجب ألا يُعامل كمكرر
+                    update_dedupe.release(update.update_id)
+                    raise
+                finally:
+                    _reply_context.capture = None
+            finally:
+                admission.release()
             
             logger.info(f"✅ تم معالجة تحديث: {update.update_id}")
+            if capture is not None and capture.payload is not None:
+                return jsonify(capture.payload), 200
             return 'OK', 200
             
         except Exception as e:
+            ERRORS_TOTAL.inc('webhook')
             logger.error(f"❌ خطأ في ويب هوك: {e}")
             return 'Error', 500
+        finally:
+            WEBHOOK_LATENCY.observe(time.perf_counter() - start)
     
     return 'Bad Request', 400
 
+@app.route('/query_stats')
+def query_stats():
+    """أعلى الاستعلامات حسب الزمن الكلي وآخر الاستعلامات البطيئة"""
+    limit = request.args.get('limit', 20, type=int)
+    order_by = request.args.get('order_by', 'total_time')
+    if order_by not in ('total_time', 'calls', 'max_time', 'rows', 'pool_wait'):
+        order_by = 'total_time'
+    return jsonify({
+        'top': db.query_stats.top(limit, order_by),
+        'slow': db.slow_queries.recent(limit),
+        'slow_threshold_ms': SLOW_QUERY_MS
+    })
+
+@app.route('/metrics')
+def metrics():
+    """مقاييس التشغيل بصيغة Prometheus"""
+    return REGISTRY.render(), 200, {'Content-Type': METRICS_CONTENT_TYPE}
+
 @app.route('/health')
 def health_check():
     """فحص صحة التطبيق"""
@@ -1560,6 +3464,11 @@ def cleanup_old_data():
     """تنظيف البيانات القديمة"""
     try:
         with db.get_cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_xact_lock(%s) AS locked", (CLEANUP_LOCK_ID,))
+            if not cur.fetchone()['locked']:
+                # عملية أخرى تنظف الآن
+                return
+            
             # حذف الرحلات الأقدم من 30 يوم
             cur.execute("""
                 DELETE FROM rides 
@@ -1567,6 +3476,29 @@ def cleanup_old_data():
                 AND status IN ('completed', 'cancelled')
             """)
             
+            cur.execute("""
+                DELETE FROM ride_traces 
+                WHERE created_at < CURRENT_TIMESTAMP - INTERVAL '30 days'
+            """)
+            
+            cur.execute("""
+                DELETE FROM outbox 
+                WHERE status IN ('sent', 'failed')
+                AND created_at < CURRENT_TIMESTAMP - INTERVAL '7 days'
+            """)
+            
+            # الأحداث المجمعة لا يُحتاج إليها بعد التجميع
+            cur.execute("""
+                DELETE FROM ride_events 
+                WHERE at < CURRENT_TIMESTAMP - INTERVAL '7 days'
+                AND seq <= COALESCE((SELECT value::bigint FROM app_meta WHERE key = 'ride_events_seq'), 0)
+            """)
+            
+            cur.execute("""
+                DELETE FROM processed_updates 
+                WHERE processed_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 hour'
+            """, (DEDUPE_RETENTION_HOURS,))
+            
             # حذف السائقين غير النشطين
             cur.execute("""
                 DELETE FROM active_drivers 
@@ -1577,45 +3509,86 @@ def cleanup_old_data():
     except Exception as e:
         logger.error(f"❌ خطأ في تنظيف البيانات: {e}")
 
+# التنظيف الدوري في العامل حتى لا تنمو processed_updates و outbox بلا حد
+cleanup_job = PeriodicJob('cleanup', CLEANUP_INTERVAL_S, cleanup_old_data)
+
 # ============================================================================
 # التهيئة والتشغيل
 # ============================================================================
 
+def register_webhook():
+    """تسجيل الويب هوك مرة واحدة لكل رابط (محمي بقفل استشاري وصف في app_meta)"""
+    hostname = os.environ.get('RENDER_EXTERNAL_HOSTNAME', '')
+    if not hostname:
+        return False
+    webhook_url = f"https://{hostname}/webhook"
+    
+    try:
+        with db.get_cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_xact_lock(%s) AS locked", (WEBHOOK_LOCK_ID,))
+            if not cur.fetchone()['locked']:
+                # عامل آخر يقوم بالتسجيل الآن
+                return False
+            if db.get_meta('webhook_url', None, cur) == webhook_url:
+                return True
+            
+            # set_webhook يستبدل الرابط السابق مباشرة دون حاجة لحذفه والانتظار
+            bot.set_webhook(url=webhook_url)
+            db.set_meta('webhook_url', webhook_url, cur)
+            logger.info(f"🌐 تم تعيين ويب هوك تلقائياً على: {webhook_url}")
+            return True
+    except Exception as e:
+        logger.error(f"❌ فشل تعيين الويب هوك: {e}")
+        return False
+
+def bootstrap():
+    """مهام الإقلاع المتكررة بأمان: ترحيل المخطط، الويب هوك، والتنظيف مرة يومياً"""
+    if not db.migrate():
+        return False
+    register_webhook()
+    
+    today = datetime.now().date().isoformat()
+    if db.get_meta('last_cleanup') != today:
+        cleanup_old_data()
+        db.set_meta('last_cleanup', today)
+    return True
+
+def start_background_jobs():
+    """تشغيل المهام الدورية في العملية الحالية (بعد fork في gunicorn)"""
+    ledger_rollup_job.start()
+    stats_reconcile_job.start()
+    analytics_rollup_job.start()
+    rating_backfill_job.start()
+    cleanup_job.start()
+    outbox_dispatcher.start()
+
 def init_bot():
     """تهيئة البوت"""
     try:
-        # اختبار البوت
-        bot_info = bot.get_me()
-        logger.info(f"✅ البوت جاهز: @{bot_info.username} ({bot_info.first_name})")
-        
-        # تعيين ويب هوك تلقائياً
-        try:
-            webhook_url = f"https://{os.environ.get('RENDER_EXTERNAL_HOSTNAME', '')}/webhook"
-            if webhook_url.startswith("https://"):
-                bot.remove_webhook()
-                time.sleep(1)
-                bot.set_webhook(url=webhook_url)
-                logger.info(f"🌐 تم تعيين ويب هوك تلقائياً على: {webhook_url}")
-        except:
-            pass
-        
-        # تنظيف البيانات القديمة
-        cleanup_old_data()
-        
-        return True
+        if BOOT_MODE == 'worker':
+            # العامل يكتفي بفحص الإصدار؛ التجمع يُنشأ عند أول استخدام
+            return db.check_schema()
+        return bootstrap()
     except Exception as e:
         logger.error(f"❌ فشل تهيئة البوت: {e}")
         return False
 
-# استيراد time للتأخير
-import time
-
 # تهيئة البوت
 if __name__ != '__main__':
     init_bot()
 
 # تشغيل التطبيق
 if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'migrate':
+        # خطوة الإصدار: ترحيل المخطط وتسجيل الويب هوك ثم الخروج
+        sys.exit(0 if bootstrap() else 1)
+    
+    # مسار التطوير: ترحيل المخطط وتسجيل الويب هوك قبل استقبال التحديثات (حسب BOOT_MODE)
+    if not init_bot():
+        sys.exit(1)
+    
     port = int(os.environ.get('PORT', 10000))
+    start_background_jobs()
     logger.info(f"🚀 بدء التشغيل على منفذ {port}")
     app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
@@ -0,0 +1,3 @@
+"""
+⏱️ أدوات قياس الأداء لبوت النقل الذكي
+"""
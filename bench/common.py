@@ -0,0 +1,58 @@
+"""
+🧰 أدوات مشتركة لسكربتات القياس
+"""
+
+import os
+import sys
+import json
+import math
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+def percentile(values, p):
+    """حساب المئين بطريقة الرتبة الأقرب"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(int(math.ceil(p / 100.0 * len(ordered))) - 1, 0)
+    return ordered[rank]
+
+def latency_summary(latencies, elapsed):
+    """ملخص زمن الاستجابة والإنتاجية"""
+    count = len(latencies)
+    return {
+        'count': count,
+        'elapsed_s': round(elapsed, 3),
+        'updates_per_s': round(count / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'max_ms': round(max(latencies) * 1000, 3) if latencies else 0.0,
+    }
+
+def load_app(fake_server, token='123456:BENCH'):
+    """
+    استيراد التطبيق بحيث تذهب استدعاءات Bot API إلى الخادم الوهمي.
+    يجب استدعاؤها قبل أي استيراد آخر لـ app لأن تهيئة البوت تتم عند الاستيراد.
+    """
+    os.environ.setdefault('BOT_TOKEN', token)
+    from telebot import apihelper
+    apihelper.API_URL = fake_server.api_url
+    import app
+    # المعالجة داخل طلب الويب هوك حتى يشمل القياس زمن المعالجات
+    app.bot.threaded = False
+    return app
+
+def post_update(client, update):
+    """إرسال تحديث إلى /webhook وإرجاع رمز الحالة"""
+    response = client.post('/webhook', data=json.dumps(update), content_type='application/json')
+    return response.status_code
+
+def print_report(title, report):
+    """طباعة تقرير بصيغة مقروءة"""
+    print(f"\n📊 {title}")
+    print("─" * 40)
+    for key, value in report.items():
+        print(f"• {key}: {value}")
@@ -0,0 +1,186 @@
+"""
+🤖 خادم Telegram Bot API وهمي محلي لقياس الأداء
+"""
+
+import json
+import time
+import random
+import threading
+from collections import deque, Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qsl
+
+# ============================================================================
+# معالج الطلبات
+# ============================================================================
+
+class _Handler(BaseHTTPRequestHandler):
+    """معالج طلبات HTTP للخادم الوهمي"""
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def _handle(self):
+        parsed = urlparse(self.path)
+        api_method = parsed.path.rsplit('/', 1)[-1]
+        params = dict(parse_qsl(parsed.query))
+
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length)
+            content_type = self.headers.get('Content-Type', '')
+            if content_type.startswith('application/json'):
+                params.update(json.loads(body))
+            elif content_type.startswith('application/x-www-form-urlencoded'):
+                params.update(parse_qsl(body.decode('utf-8')))
+
+        status, payload = self.server.fake.handle(api_method, params)
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+# ============================================================================
+# الخادم الوهمي
+# ============================================================================
+
+class FakeTelegramServer:
+    """
+    خادم Bot API وهمي يسجل الرسائل المرسلة ويحقن تأخيراً قابلاً للضبط.
+    عروض الرحلات (رسائل تحتوي على زر accept_) تُحفظ في طابور ليستخدمها المُشغّل.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self.messages = deque(maxlen=10000)
+        self.offers = deque()
+        self._message_id = 0
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.fake = self
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._httpd.server_address[1]
+
+    @property
+    def api_url(self):
+        """قالب الرابط المناسب لـ telebot.apihelper.API_URL"""
+        return f"http://127.0.0.1:{self.port}/bot{{0}}/{{1}}"
+
+    def start(self):
+        """تشغيل الخادم في خيط خلفي"""
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """إيقاف الخادم"""
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def reset(self):
+        """مسح السجلات"""
+        with self._lock:
+            self.calls.clear()
+            self.messages.clear()
+            self.offers.clear()
+
+    def take_offer(self):
+        """سحب أقدم عرض رحلة لم يُرد عليه"""
+        try:
+            return self.offers.popleft()
+        except IndexError:
+            return None
+
+    def handle(self, api_method, params):
+        """تنفيذ استدعاء API وهمي"""
+        delay = self.latency_ms + random.uniform(0, self.jitter_ms)
+        if delay:
+            time.sleep(delay / 1000.0)
+
+        with self._lock:
+            self.calls[api_method] += 1
+
+        if self.error_rate and random.random() < self.error_rate:
+            return 500, {'ok': False, 'error_code': 500, 'description': 'Internal Server Error'}
+
+        if api_method == 'getMe':
+            return 200, {'ok': True, 'result': {
+                'id': 1, 'is_bot': True, 'first_name': 'FakeBot', 'username': 'fake_bot'
+            }}
+        if api_method == 'getWebhookInfo':
+            return 200, {'ok': True, 'result': {'url': '', 'has_custom_certificate': False, 'pending_update_count': 0}}
+        if api_method in ('sendMessage', 'editMessageText', 'sendLocation', 'editMessageLiveLocation',
+                          'stopMessageLiveLocation'):
+            return 200, {'ok': True, 'result': self._record_message(api_method, params)}
+        return 200, {'ok': True, 'result': True}
+
+    def _record_message(self, api_method, params):
+        """تسجيل رسالة وإرجاع كائن Message"""
+        chat_id = params.get('chat_id', 0)
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+
+        with self._lock:
+            if api_method not in ('sendMessage', 'sendLocation') and params.get('message_id'):
+                message_id = int(params['message_id'])
+            else:
+                self._message_id += 1
+                message_id = self._message_id
+
+        now = time.time()
+        message = {
+            'message_id': message_id,
+            'date': int(now),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': params.get('text', ''),
+        }
+        self.messages.append((api_method, chat_id, params.get('text', ''), now))
+
+        markup = params.get('reply_markup')
+        if markup:
+            if isinstance(markup, str):
+                markup = json.loads(markup)
+            for row in markup.get('inline_keyboard', []):
+                for button in row:
+                    data = button.get('callback_data', '')
+                    if data.startswith('accept_'):
+                        self.offers.append({
+                            'chat_id': chat_id,
+                            'message_id': message_id,
+                            'data': data,
+                            'text': message['text'],
+                            'sent_at': now,
+                        })
+        return message
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='خادم Telegram Bot API وهمي')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = FakeTelegramServer(port=args.port, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms)
+    print(f"🤖 الخادم الوهمي يعمل على: {server.api_url}")
+    server._httpd.serve_forever()
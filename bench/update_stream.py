@@ -0,0 +1,179 @@
+"""
+🔁 مولد تدفقات تحديثات Telegram واقعية للقياس
+"""
+
+import math
+import time
+import random
+import itertools
+
+# نصوص الأزرار كما في لوحات المفاتيح في app.py
+CUSTOMER_ROLE = '👤 عميل'
+DRIVER_ROLE = '🚖 سائق'
+NEW_RIDE = '🚖 طلب رحلة جديدة'
+DRIVER_START = '🟢 بدء العمل'
+DRIVER_STOP = '🔴 إنهاء العمل'
+MY_RIDES = '📋 رحلاتي السابقة'
+BALANCE = '💰 رصيدي'
+SUPPORT = '📞 الدعم'
+BACK = 'رجوع'
+
+# ============================================================================
+# بناء التحديثات
+# ============================================================================
+
+class UpdateFactory:
+    """بناء تحديثات Telegram بصيغة JSON"""
+
+    def __init__(self, first_update_id=1):
+        self._update_ids = itertools.count(first_update_id)
+        self._message_ids = itertools.count(1)
+        self._callback_ids = itertools.count(1)
+
+    @staticmethod
+    def user(user_id, first_name=None):
+        """كائن مستخدم"""
+        return {
+            'id': user_id,
+            'is_bot': False,
+            'first_name': first_name or f"user{user_id}",
+            'username': f"u{user_id}",
+        }
+
+    def message(self, user_id, text=None, location=None):
+        """تحديث رسالة نصية أو موقع"""
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self.user(user_id),
+        }
+        if text is not None:
+            message['text'] = text
+            if text.startswith('/'):
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        if location is not None:
+            message['location'] = {'latitude': location[0], 'longitude': location[1]}
+        return {'update_id': next(self._update_ids), 'message': message}
+
+    def edited_location(self, user_id, location, message_id):
+        """تحديث موقع مباشر (edited_message)"""
+        now = int(time.time())
+        return {
+            'update_id': next(self._update_ids),
+            'edited_message': {
+                'message_id': message_id,
+                'date': now,
+                'edit_date': now,
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': self.user(user_id),
+                'location': {'latitude': location[0], 'longitude': location[1], 'live_period': 3600},
+            },
+        }
+
+    def callback(self, user_id, data, chat_id=None, message_id=1):
+        """تحديث ضغط زر داخلي"""
+        return {
+            'update_id': next(self._update_ids),
+            'callback_query': {
+                'id': str(next(self._callback_ids)),
+                'from': self.user(user_id),
+                'chat_instance': str(user_id),
+                'data': data,
+                'message': {
+                    'message_id': message_id,
+                    'date': int(time.time()),
+                    'chat': {'id': chat_id or user_id, 'type': 'private'},
+                    'text': '',
+                },
+            },
+        }
+
+def random_point(center, radius_km, rng=random):
+    """نقطة عشوائية ضمن دائرة حول المركز"""
+    distance = radius_km * math.sqrt(rng.random())
+    angle = rng.uniform(0, 2 * math.pi)
+    dlat = (distance / 111.0) * math.cos(angle)
+    dlng = (distance / (111.0 * math.cos(math.radians(center[0])))) * math.sin(angle)
+    return round(center[0] + dlat, 6), round(center[1] + dlng, 6)
+
+# ============================================================================
+# التدفق الواقعي
+# ============================================================================
+
+class UpdateStream:
+    """
+    مولد تدفق تحديثات بمزيج واقعي: تسجيل، طلبات رحلات، مواقع سائقين،
+    ضغطات أزرار القوائم، وضغطات أزرار قبول الرحلات.
+    """
+
+    # أوزان أنواع الأحداث في التدفق
+    DEFAULT_MIX = {
+        'ride_request': 0.20,
+        'driver_location': 0.35,
+        'accept': 0.15,
+        'menu': 0.20,
+        'start': 0.10,
+    }
+
+    def __init__(self, customers=200, drivers=50, center=(24.7136, 46.6753), radius_km=10.0,
+                 mix=None, seed=42, first_user_id=10_000_000):
+        self.rng = random.Random(seed)
+        self.factory = UpdateFactory()
+        self.center = center
+        self.radius_km = radius_km
+        self.mix = mix or self.DEFAULT_MIX
+        self.customer_ids = [first_user_id + i for i in range(customers)]
+        self.driver_ids = [first_user_id + customers + i for i in range(drivers)]
+        self._driver_set = set(self.driver_ids)
+        self._all_ids = self.customer_ids + self.driver_ids
+        self._next_customer = itertools.cycle(self.customer_ids)
+
+    def onboarding(self):
+        """تسجيل جميع المستخدمين وتفعيل السائقين"""
+        for driver_id in self.driver_ids:
+            yield self.factory.message(driver_id, '/start')
+            yield self.factory.message(driver_id, DRIVER_ROLE)
+            yield self.factory.message(driver_id, DRIVER_START)
+            yield self.factory.message(driver_id, location=random_point(self.center, self.radius_km, self.rng))
+        for customer_id in self.customer_ids:
+            yield self.factory.message(customer_id, '/start')
+            yield self.factory.message(customer_id, CUSTOMER_ROLE)
+
+    def ride_request(self, customer_id):
+        """جلسة طلب رحلة كاملة: زر الطلب ثم إرسال الموقع"""
+        yield self.factory.message(customer_id, NEW_RIDE)
+        yield self.factory.message(customer_id, location=random_point(self.center, self.radius_km, self.rng))
+
+    def events(self, count, take_offer=None):
+        """
+        توليد عدد محدد من التحديثات.
+        take_offer: دالة تعيد عرض رحلة معلق (من الخادم الوهمي) لتوليد ضغطة قبول.
+        """
+        kinds = list(self.mix)
+        weights = [self.mix[kind] for kind in kinds]
+        produced = 0
+        while produced < count:
+            kind = self.rng.choices(kinds, weights)[0]
+            if kind == 'ride_request':
+                updates = list(self.ride_request(next(self._next_customer)))
+            elif kind == 'driver_location':
+                driver_id = self.rng.choice(self.driver_ids)
+                updates = [self.factory.message(driver_id, location=random_point(self.center, self.radius_km, self.rng))]
+            elif kind == 'accept':
+                offer = take_offer() if take_offer else None
+                if offer is None:
+                    continue
+                updates = [self.factory.callback(offer['chat_id'], offer['data'], message_id=offer['message_id'])]
+            elif kind == 'menu':
+                user_id = self.rng.choice(self.customer_ids)
+                updates = [self.factory.message(user_id, self.rng.choice([MY_RIDES, BALANCE, SUPPORT, BACK]))]
+            else:
+                user_id = self.rng.choice(self._all_ids)
+                updates = [self.factory.message(user_id, '/start')]
+                # إعادة الدور بعد /start
+                role = DRIVER_ROLE if user_id in self._driver_set else CUSTOMER_ROLE
+                updates.append(self.factory.message(user_id, role))
+            for update in updates:
+                yield update
+                produced += 1
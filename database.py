@@ -0,0 +1,315 @@
+"""
+🗄️ أدوات قاعدة البيانات - خطافات توقيت الاستعلامات وسجل الاستعلامات البطيئة وقاطع الدائرة
+"""
+
+import re
+import time
+import random
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+from psycopg2.extensions import cursor as TupleCursor
+from psycopg2.extras import RealDictCursor
+
+from metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+# ============================================================================
+# تطبيع الاستعلامات
+# ============================================================================
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PARAM_RE = re.compile(r"%\(\w+\)s|%s")
+_IN_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACE_RE = re.compile(r"\s+")
+
+def normalize_sql(sql):
+    """تطبيع نص الاستعلام لتجميع الاستعلامات المتشابهة"""
+    if isinstance(sql, bytes):
+        sql = sql.decode('utf-8', 'replace')
+    sql = _STRING_RE.sub("?", str(sql))
+    sql = _PARAM_RE.sub("?", sql)
+    sql = _NUMBER_RE.sub("?", sql)
+    sql = _IN_LIST_RE.sub("(...)", sql)
+    return _SPACE_RE.sub(" ", sql).strip()
+
+# ============================================================================
+# المؤشر المُقاس
+# ============================================================================
+
+class TimedCursorMixin:
+    """
+    مؤشر يقيس زمن كل استعلام ويستدعي الخطافات المسجلة بحدث يحتوي على:
+    sql, params, duration, rows, pool_wait, cursor
+    """
+    hooks = ()
+    pool_wait = 0.0
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self._notify_hooks(query, vars, time.perf_counter() - start)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            self._notify_hooks(query, None, time.perf_counter() - start)
+
+    def _notify_hooks(self, query, params, duration):
+        """استدعاء خطافات الاستعلام"""
+        if not self.hooks:
+            return
+        event = {
+            'sql': query,
+            'params': params,
+            'duration': duration,
+            'rows': self.rowcount,
+            # وقت انتظار التجمع يُنسب لأول استعلام فقط
+            'pool_wait': self.pool_wait,
+            'cursor': self,
+        }
+        self.pool_wait = 0.0
+        for hook in self.hooks:
+            try:
+                hook(event)
+            except Exception as e:
+                logger.error(f"❌ خطأ في خطاف الاستعلام: {e}")
+
+class TimedCursor(TimedCursorMixin, RealDictCursor):
+    """مؤشر قاموسي مُقاس"""
+
+class TimedTupleCursor(TimedCursorMixin, TupleCursor):
+    """مؤشر مُقاس يعيد tuples (لبناء نماذج الصفوف في models.py)"""
+
+# ============================================================================
+# إحصائيات الاستعلامات
+# ============================================================================
+
+class QueryStats:
+    """تجميع محلي للاستعلامات على غرار pg_stat_statements"""
+
+    def __init__(self, max_statements=500):
+        self.max_statements = max_statements
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, event):
+        """خطاف: تسجيل استعلام منفذ"""
+        key = normalize_sql(event['sql'])
+        duration = event['duration']
+        rows = max(event['rows'], 0)
+        with self._lock:
+            entry = self._stats.get(key)
+            if entry is None:
+                if len(self._stats) >= self.max_statements:
+                    return
+                entry = self._stats[key] = {
+                    'query': key,
+                    'calls': 0,
+                    'total_time': 0.0,
+                    'min_time': duration,
+                    'max_time': 0.0,
+                    'rows': 0,
+                    'pool_wait': 0.0,
+                }
+            entry['calls'] += 1
+            entry['total_time'] += duration
+            entry['min_time'] = min(entry['min_time'], duration)
+            entry['max_time'] = max(entry['max_time'], duration)
+            entry['rows'] += rows
+            entry['pool_wait'] += event['pool_wait']
+
+    def top(self, limit=20, order_by='total_time'):
+        """أعلى الاستعلامات حسب المعيار المحدد (الأزمنة بالمللي ثانية)"""
+        with self._lock:
+            entries = [dict(entry) for entry in self._stats.values()]
+        entries.sort(key=lambda entry: entry[order_by], reverse=True)
+        result = []
+        for entry in entries[:limit]:
+            calls = entry['calls']
+            result.append({
+                'query': entry['query'],
+                'calls': calls,
+                'total_ms': round(entry['total_time'] * 1000, 3),
+                'mean_ms': round(entry['total_time'] * 1000 / calls, 3),
+                'min_ms': round(entry['min_time'] * 1000, 3),
+                'max_ms': round(entry['max_time'] * 1000, 3),
+                'rows': entry['rows'],
+                'pool_wait_ms': round(entry['pool_wait'] * 1000, 3),
+            })
+        return result
+
+    def reset(self):
+        """مسح الإحصائيات"""
+        with self._lock:
+            self._stats.clear()
+
+class SlowQueryLog:
+    """سجل الاستعلامات البطيئة مع أخذ عينات EXPLAIN اختيارياً"""
+
+    def __init__(self, threshold_ms=200, explain_sample_rate=0.0, max_entries=100):
+        self.threshold = threshold_ms / 1000.0
+        self.explain_sample_rate = explain_sample_rate
+        self.entries = deque(maxlen=max_entries)
+
+    def record(self, event):
+        """خطاف: تسجيل الاستعلام إذا تجاوز الحد"""
+        duration = event['duration']
+        if duration < self.threshold:
+            return
+        query = normalize_sql(event['sql'])
+        entry = {
+            'query': query,
+            'duration_ms': round(duration * 1000, 3),
+            'rows': event['rows'],
+            'at': datetime.now().isoformat(),
+            'plan': None,
+        }
+        if self.explain_sample_rate and random.random() < self.explain_sample_rate:
+            entry['plan'] = self.explain(event)
+        self.entries.append(entry)
+        logger.warning(f"🐢 استعلام بطيء ({entry['duration_ms']} ms): {query}")
+
+    def explain(self, event):
+        """تنفيذ EXPLAIN (ANALYZE, BUFFERS) لاستعلامات القراءة فقط"""
+        sql = event['sql']
+        if isinstance(sql, bytes):
+            sql = sql.decode('utf-8', 'replace')
+        if not sql.lstrip().lower().startswith('select'):
+            return None
+        conn = event['cursor'].connection
+        cur = conn.cursor()
+        try:
+            # نقطة حفظ حتى لا يفسد فشل EXPLAIN المعاملة الأصلية
+            cur.execute("SAVEPOINT slow_query_explain")
+            try:
+                cur.execute("EXPLAIN (ANALYZE, BUFFERS) " + sql, event['params'])
+                return "\n".join(row[0] for row in cur.fetchall())
+            except Exception as e:
+                cur.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+                logger.error(f"❌ فشل EXPLAIN للاستعلام البطيء: {e}")
+                return None
+            finally:
+                cur.execute("RELEASE SAVEPOINT slow_query_explain")
+        except Exception as e:
+            logger.error(f"❌ فشل EXPLAIN للاستعلام البطيء: {e}")
+            return None
+        finally:
+            cur.close()
+
+    def recent(self, limit=20):
+        """آخر الاستعلامات البطيئة"""
+        return list(self.entries)[-limit:][::-1]
+
+# ============================================================================
+# قاطع الدائرة
+# ============================================================================
+
+CIRCUIT_STATE = Gauge('db_circuit_state', 'حالة قاطع دائرة قاعدة البيانات (0 مغلق، 1 نصف مفتوح، 2 مفتوح)')
+CIRCUIT_TRANSITIONS = Counter('db_circuit_transitions_total', 'انتقالات قاطع الدائرة', ['state'])
+CIRCUIT_REJECTED = Counter('db_circuit_rejected_total', 'استدعاءات رُفضت فوراً أثناء فتح الدائرة')
+
+class DatabaseUnavailable(Exception):
+    """قاعدة البيانات غير متاحة: الدائرة مفتوحة والاستدعاء رُفض دون محاولة"""
+
+class CircuitBreaker:
+    """
+    قاطع دائرة بنسبة الفشل في نافذة منزلقة: يفتح عند تجاوز النسبة بعد حد أدنى
+    من الاستدعاءات، ويرفض فوراً حتى انقضاء مدة الفتح، ثم يسمح باستدعاء اختباري
+    واحد (نصف مفتوح) يغلق الدائرة عند نجاحه أو يعيد فتحها عند فشله.
+    """
+    CLOSED = 'closed'
+    HALF_OPEN = 'half_open'
+    OPEN = 'open'
+
+    def __init__(self, window_s=10, min_calls=20, failure_rate=0.5, open_s=5):
+        self.window_s = int(window_s)
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_s = open_s
+        self.state = self.CLOSED
+        self.opened_at = None
+        self.probing = False
+        # دلاء بالثانية: [الثانية، الاستدعاءات، الفشل]
+        self._buckets = deque()
+        self._calls = 0
+        self._failures = 0
+        self._lock = threading.Lock()
+        CIRCUIT_STATE.set_function(lambda: {(): (self.CLOSED, self.HALF_OPEN, self.OPEN).index(self.state)})
+
+    def check(self):
+        """فحص بلا أثر جانبي: يرفع DatabaseUnavailable إذا كان الاستدعاء سيُرفض"""
+        if self.state == self.OPEN and time.monotonic() - self.opened_at < self.open_s:
+            raise DatabaseUnavailable("دائرة قاعدة البيانات مفتوحة")
+        if self.state == self.HALF_OPEN and self.probing:
+            raise DatabaseUnavailable("اختبار قاعدة البيانات جارٍ")
+
+    def acquire(self):
+        """طلب الإذن بالاستدعاء؛ يعيد True إذا كان هو الاستدعاء الاختباري"""
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.open_s:
+                    CIRCUIT_REJECTED.inc()
+                    raise DatabaseUnavailable("دائرة قاعدة البيانات مفتوحة")
+                self._transition(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN:
+                if self.probing:
+                    CIRCUIT_REJECTED.inc()
+                    raise DatabaseUnavailable("اختبار قاعدة البيانات جارٍ")
+                self.probing = True
+                return True
+        return False
+
+    def release(self, probe=False):
+        """إنهاء استدعاء سُمح به دون احتساب نتيجته (لم يصل إلى قاعدة البيانات)"""
+        if probe:
+            with self._lock:
+                self.probing = False
+
+    def record(self, ok, probe=False):
+        """تسجيل نتيجة استدعاء سُمح به"""
+        with self._lock:
+            if probe:
+                self.probing = False
+                self._transition(self.CLOSED if ok else self.OPEN)
+                return
+            if self.state != self.CLOSED:
+                return
+            second = int(time.monotonic())
+            while self._buckets and self._buckets[0][0] <= second - self.window_s:
+                _, calls, failures = self._buckets.popleft()
+                self._calls -= calls
+                self._failures -= failures
+            if not self._buckets or self._buckets[-1][0] != second:
+                self._buckets.append([second, 0, 0])
+            bucket = self._buckets[-1]
+            bucket[1] += 1
+            self._calls += 1
+            if not ok:
+                bucket[2] += 1
+                self._failures += 1
+                if self._calls >= self.min_calls and self._failures >= self.failure_rate * self._calls:
+                    self._transition(self.OPEN)
+
+    def _transition(self, state):
+        """تغيير الحالة مع تصفير النافذة"""
+        if state == self.state:
+            if state == self.OPEN:
+                self.opened_at = time.monotonic()
+            return
+        self.state = state
+        if state == self.OPEN:
+            self.opened_at = time.monotonic()
+            logger.warning(f"🔌 فتح دائرة قاعدة البيانات لمدة {self.open_s} ثانية")
+        elif state == self.CLOSED:
+            self._buckets.clear()
+            self._calls = self._failures = 0
+            logger.info("🔌 إغلاق دائرة قاعدة البيانات: عادت للعمل")
+        CIRCUIT_TRANSITIONS.inc(state)
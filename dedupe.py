@@ -0,0 +1,86 @@
+"""
+♻️ معالجة التحديثات مرة واحدة: إزالة التكرار حسب update_id
+"""
+
+import os
+import logging
+import threading
+from collections import deque
+
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+# ============================================================================
+# الإعدادات
+# ============================================================================
+
+# عدد معرفات التحديثات المحفوظة في ذاكرة كل عامل
+DEDUPE_WINDOW = int(os.environ.get('DEDUPE_WINDOW', '10000'))
+# memory = نافذة العامل فقط، postgres = نافذة مشتركة بين العمال في جدول processed_updates
+DEDUPE_BACKEND = os.environ.get('DEDUPE_BACKEND', 'memory')
+# مدة الاحتفاظ بالمعرفات في الجدول المشترك (Telegram يعيد المحاولة حتى يوم تقريباً)
+DEDUPE_RETENTION_HOURS = int(os.environ.get('DEDUPE_RETENTION_HOURS', '24'))
+
+DUPLICATES = Counter('webhook_duplicate_updates_total', 'تحديثات مكررة أُقرّ باستلامها دون معالجة', ['layer'])
+RELEASED = Counter('webhook_dedupe_released_total', 'تحديثات أُعيد فتحها بعد فشل معالجتها')
+
+# ============================================================================
+# النافذة
+# ============================================================================
+
+class UpdateDeduplicator:
+    """
+    نافذة محدودة من معرفات التحديثات المستلمة في الذاكرة، مع نافذة مشتركة
+    اختيارية: claim_shared(update_id) تعيد True للمطالبة الأولى و False للمكرر
+    و None عند تعذر الوصول (فنعتمد على الذاكرة فقط).
+    """
+
+    def __init__(self, window=DEDUPE_WINDOW, claim_shared=None, release_shared=None):
+        self.window = window
+        self.claim_shared = claim_shared
+        self.release_shared = release_shared
+        self._seen = set()
+        self._order = deque()
+        self._lock = threading.Lock()
+
+    def _remember(self, update_id):
+        """إضافة معرف مع إخراج الأقدم عند امتلاء النافذة؛ يعيد False إن كان موجوداً"""
+        with self._lock:
+            if update_id in self._seen:
+                return False
+            self._seen.add(update_id)
+            self._order.append(update_id)
+            while len(self._order) > self.window:
+                self._seen.discard(self._order.popleft())
+            return True
+
+    def _forget(self, update_id):
+        """حذف المعرف من النافذة كلياً حتى لا تُخرج نسخته القديمة إعادة التسليم مبكراً"""
+        with self._lock:
+            if update_id in self._seen:
+                self._seen.discard(update_id)
+                # الإطلاق نادر (فشل المعالجة)، والبحث الخطي في النافذة مقبول
+                try:
+                    self._order.remove(update_id)
+                except ValueError:
+                    pass
+
+    def claim(self, update_id):
+        """المطالبة بمعالجة التحديث؛ يعيد False إن سبقت معالجته"""
+        if not self._remember(update_id):
+            DUPLICATES.inc('memory')
+            return False
+        if self.claim_shared is not None:
+            claimed = self.claim_shared(update_id)
+            if claimed is False:
+                DUPLICATES.inc('postgres')
+                return False
+        return True
+
+    def release(self, update_id):
+        """فشلت المعالجة: السماح بإعادة التسليم القادمة من Telegram"""
+        self._forget(update_id)
+        if self.release_shared is not None:
+            self.release_shared(update_id)
+        RELEASED.inc()
@@ -0,0 +1,96 @@
+"""
+🦄 إعدادات gunicorn للإنتاج
+
+التشغيل:
+    gunicorn -c gunicorn.conf.py app:app
+
+وضع حلقة الأحداث (نفس المعالجات، مقابس و psycopg2 غير حاجبة):
+    EXECUTION_MODE=gevent gunicorn -c gunicorn.conf.py app:app
+"""
+
+import os
+
+EXECUTION_MODE = os.environ.get('EXECUTION_MODE', 'threads')
+
+if EXECUTION_MODE == 'gevent':
+    # الترقيع قبل استيراد التطبيق في العملية الرئيسية (preload_app) حتى ترث العمال
+    # أقفالاً ومقابس تعاونية، ثم جعل psycopg2 يتخلى عن الحلقة أثناء انتظار Postgres
+    from gevent import monkey
+    monkey.patch_all()
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+# ============================================================================
+# العمال والخيوط
+# ============================================================================
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '10000')}"
+
+# عامل واحد: حالات المحادثة والرحلات (user_states و ride_requests و active_rides وعروض
+# الأسعار) ما زالت في ذاكرة العملية، فتحديثات نفس المستخدم يجب أن تصل إلى نفس العامل.
+# التوسع يتم بالخيوط أو gevent داخل العامل حتى تنتقل هذه الحالة إلى Postgres
+workers = 1
+
+if EXECUTION_MODE == 'gevent':
+    # آلاف التحديثات المتزامنة لكل عامل؛ الاتصالات الصادرة محدودة بحجم التجمعات
+    worker_class = 'gevent'
+    worker_connections = int(os.environ.get('GEVENT_CONNECTIONS', '256'))
+    concurrency = worker_connections
+    db_pool_size = int(os.environ.get('GEVENT_DB_POOL', '20'))
+    telegram_pool_size = int(os.environ.get('GEVENT_TELEGRAM_POOL', '64'))
+else:
+    # المعالجات تنتظر Telegram و Postgres معظم الوقت، لذا نعتمد على الخيوط داخل كل عامل
+    worker_class = 'gthread'
+    threads = int(os.environ.get('GUNICORN_THREADS', '8'))
+    concurrency = threads
+    # كل خيط يحتاج اتصال قاعدة بيانات واتصال HTTP صادر واحداً على الأكثر
+    db_pool_size = telegram_pool_size = threads
+
+# حد القبول في الويب هوك: التحديثات المقبولة والمنتظرة تترك دائماً سعة لـ /health و /metrics
+admission_limit = max(1, concurrency * 3 // 4)
+admission_queue = max(0, concurrency - 1 - admission_limit)
+
+timeout = 60
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', '25'))
+keepalive = 5
+
+# تحميل التطبيق مرة واحدة في العملية الرئيسية: الترحيل وتسجيل الويب هوك يتمان مرة واحدة
+# والعمال يرثون الوحدة دون إعادة الاستيراد
+preload_app = True
+
+accesslog = '-'
+errorlog = '-'
+
+# إعدادات التطبيق المشتقة (تُقرأ عند استيراد app)
+os.environ.setdefault('PROCESS_IN_REQUEST', '1')
+os.environ.setdefault('DB_POOL_MAX', str(db_pool_size))
+os.environ.setdefault('TELEGRAM_POOL_SIZE', str(telegram_pool_size))
+os.environ.setdefault('ADMISSION_LIMIT', str(admission_limit))
+os.environ.setdefault('ADMISSION_QUEUE', str(admission_queue))
+
+# ============================================================================
+# الخطافات
+# ============================================================================
+
+def when_ready(server):
+    """العملية الرئيسية جاهزة: إغلاق اتصالاتها قبل إنشاء العمال"""
+    import app
+    app.db.close_pool()
+    app.telegram_client.reset()
+    server.log.info(f"🚀 gunicorn جاهز ({EXECUTION_MODE}): {workers} عامل × {concurrency} تحديث متزامن")
+
+def post_fork(server, worker):
+    """بناء موارد العامل بعد fork: تجمع قاعدة البيانات وجلسة Telegram والمهام الدورية"""
+    import app
+    app.db.get_pool()
+    app.telegram_client.session
+    app.start_background_jobs()
+    server.log.info(f"🔧 تم تهيئة موارد العامل {worker.pid}")
+
+def worker_exit(server, worker):
+    """تفريغ التحديثات الجارية ثم إغلاق الاتصالات عند إيقاف العامل"""
+    import app
+    if not app.wait_for_inflight(graceful_timeout):
+        server.log.warning(f"⚠️ العامل {worker.pid} توقف قبل اكتمال بعض التحديثات")
+    app.db.close_pool()
+    app.telegram_client.reset()
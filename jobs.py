@@ -0,0 +1,57 @@
+"""
+⏱️ المهام الدورية في الخلفية (تجميعات ومطابقات) بخيط لكل عملية
+"""
+
+import os
+import time
+import logging
+import threading
+
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+JOB_RUNS = Counter('background_job_runs_total', 'عدد مرات تشغيل المهام الدورية', ['job', 'result'])
+JOB_SECONDS = Histogram('background_job_seconds', 'زمن تنفيذ المهام الدورية', ['job'])
+
+class PeriodicJob:
+    """
+    تشغيل func() كل interval_s ثانية في خيط خلفي. المهام التي يجب أن تعمل
+    في عامل واحد فقط تحمي نفسها بقفل استشاري داخل func.
+    """
+
+    def __init__(self, name, interval_s, func):
+        self.name = name
+        self.interval_s = interval_s
+        self.func = func
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        """تشغيل خيط المهمة في العملية الحالية (يعاد إنشاؤه بعد fork)"""
+        pid = os.getpid()
+        if self._thread is not None and self._pid == pid:
+            return
+        with self._lock:
+            if self._thread is None or self._pid != pid:
+                self._pid = pid
+                self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval_s)
+            self.run_once()
+
+    def run_once(self):
+        """تشغيل واحد مع القياس؛ الأخطاء تُسجل ولا توقف الخيط"""
+        start = time.perf_counter()
+        try:
+            self.func()
+            JOB_RUNS.inc(self.name, 'ok')
+        except Exception as e:
+            JOB_RUNS.inc(self.name, 'error')
+            logger.error(f"❌ خطأ في المهمة الدورية {self.name}: {e}")
+        finally:
+            JOB_SECONDS.observe(time.perf_counter() - start, self.name)
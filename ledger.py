@@ -0,0 +1,64 @@
+"""
+💳 دفتر المدفوعات: لقطات أرصدة مخزنة مؤقتاً فوق التجميعات الدفعية
+"""
+
+import os
+import time
+import threading
+
+from metrics import Counter
+
+# ============================================================================
+# الإعدادات
+# ============================================================================
+
+# الفترة بين تجميعات الدفتر وأقصى عدد أرقام تسلسلية في التجميع الواحد
+LEDGER_ROLLUP_S = float(os.environ.get('LEDGER_ROLLUP_S', '60'))
+LEDGER_ROLLUP_BATCH = int(os.environ.get('LEDGER_ROLLUP_BATCH', '50000'))
+# مدة صلاحية لقطة الرصيد في ذاكرة العامل (بالثواني)
+BALANCE_CACHE_S = float(os.environ.get('BALANCE_CACHE_S', '30'))
+BALANCE_CACHE_SIZE = int(os.environ.get('BALANCE_CACHE_SIZE', '10000'))
+
+BALANCE_READS = Counter('balance_cache_reads_total', 'قراءات الرصيد حسب المصدر', ['source'])
+
+# ============================================================================
+# ذاكرة الأرصدة
+# ============================================================================
+
+class BalanceCache:
+    """
+    لقطات أرصدة لكل مستخدم بمدة صلاحية. load(user_id) تحسب الرصيد من
+    التجميع والذيل غير المجمع وتعيد None عند الخطأ (فلا يُخزن).
+    """
+
+    def __init__(self, load, ttl_s=BALANCE_CACHE_S, max_size=BALANCE_CACHE_SIZE):
+        self.load = load
+        self.ttl_s = ttl_s
+        self.max_size = max_size
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """الرصيد من اللقطة إن كانت صالحة وإلا من قاعدة البيانات"""
+        now = time.monotonic()
+        entry = self._entries.get(user_id)
+        if entry is not None and now - entry[1] < self.ttl_s:
+            BALANCE_READS.inc('cache')
+            return entry[0]
+        BALANCE_READS.inc('database')
+        balance = self.load(user_id)
+        if balance is not None:
+            with self._lock:
+                if len(self._entries) >= self.max_size:
+                    for key in [key for key, (_, at) in self._entries.items() if now - at >= self.ttl_s]:
+                        del self._entries[key]
+                    if len(self._entries) >= self.max_size:
+                        self._entries.clear()
+                self._entries[user_id] = (balance, now)
+        return balance
+
+    def invalidate(self, *user_ids):
+        """حذف لقطات مستخدمين أُضيفت لهم قيود جديدة في هذا العامل"""
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
@@ -0,0 +1,278 @@
+"""
+🧩 مطابقة دفعية للرحلات المعلقة مع السائقين المتاحين (تعيين بأقل تكلفة)
+"""
+
+import os
+import time
+import logging
+import threading
+import numpy as np
+
+from metrics import Counter, Gauge, Histogram
+from quoting import haversine_km, QUOTE_ROAD_FACTOR
+
+logger = logging.getLogger(__name__)
+
+# ============================================================================
+# الإعدادات
+# ============================================================================
+
+# نافذة تجميع الطلبات قبل حل التعيين (بالثواني)
+BATCH_WINDOW_S = float(os.environ.get('BATCH_WINDOW_S', '1.5'))
+# عدد أقرب السائقين المأخوذين لكل رحلة عند بناء مصفوفة التكلفة
+BATCH_CANDIDATES_PER_RIDE = int(os.environ.get('BATCH_CANDIDATES_PER_RIDE', '8'))
+# الحل الدقيق (الخوارزمية المجرية) حتى هذا العدد من الرحلات في الدفعة، وبعدها الجشع
+BATCH_EXACT_MAX_RIDES = int(os.environ.get('BATCH_EXACT_MAX_RIDES', '200'))
+# أبعد مسافة التقاط مقبولة للتعيين (كم)
+BATCH_MAX_PICKUP_KM = float(os.environ.get('BATCH_MAX_PICKUP_KM', '15'))
+# مهلة رد السائق على العرض قبل إعادة الرحلة للدفعة التالية
+BATCH_OFFER_TIMEOUT_S = float(os.environ.get('BATCH_OFFER_TIMEOUT_S', '20'))
+# مهلة بقاء الرحلة دون تعيين قبل التخلي عنها
+BATCH_RIDE_TIMEOUT_S = float(os.environ.get('BATCH_RIDE_TIMEOUT_S', '300'))
+
+SOLVE_TIME = Histogram('dispatch_batch_solve_seconds', 'زمن حل التعيين لكل دفعة', ['solver'])
+BATCH_RIDES = Counter('dispatch_batch_rides_total', 'نتيجة الرحلات في كل دفعة', ['result'])
+PENDING_RIDES = Gauge('dispatch_batch_pending_rides', 'رحلات بانتظار التعيين أو رد السائق', ['state'])
+
+# تكلفة الأزواج غير المسموحة (أبعد من الحد أو سائق رفض الرحلة)
+FORBIDDEN = 1e9
+
+# ============================================================================
+# حل التعيين
+# ============================================================================
+
+def hungarian(cost):
+    """
+    تعيين بأقل تكلفة (مسار التعزيز الأقصر مع الجهود) لمصفوفة n×m حيث n ≤ m.
+    يعيد مصفوفة عمود لكل صف. الحلقة الداخلية على الأعمدة متجهة بـ NumPy.
+    """
+    n, m = cost.shape
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    p = np.zeros(m + 1, dtype=np.int64)
+    way = np.zeros(m + 1, dtype=np.int64)
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            free = ~used[1:]
+            reduced = cost[i0 - 1] - u[i0] - v[1:]
+            better = free & (reduced < minv[1:])
+            minv[1:][better] = reduced[better]
+            way[1:][better] = j0
+            masked = np.where(free, minv[1:], np.inf)
+            j1 = int(np.argmin(masked)) + 1
+            delta = masked[j1 - 1]
+            columns = np.flatnonzero(used)
+            u[p[columns]] += delta
+            v[columns] -= delta
+            minv[1:][free] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+    assignment = np.full(n, -1, dtype=np.int64)
+    columns = np.flatnonzero(p[1:])
+    assignment[p[columns + 1] - 1] = columns
+    return assignment
+
+def greedy(cost, candidates=BATCH_CANDIDATES_PER_RIDE):
+    """تعيين جشع: أرخص الأزواج أولاً من بين أقرب المرشحين لكل صف"""
+    n, m = cost.shape
+    k = min(candidates, m)
+    nearest = np.argpartition(cost, k - 1, axis=1)[:, :k] if k < m else np.tile(np.arange(m), (n, 1))
+    rows = np.repeat(np.arange(n), k)
+    cols = nearest.ravel()
+    order = np.argsort(cost[rows, cols], kind='stable')
+    assignment = np.full(n, -1, dtype=np.int64)
+    taken = np.zeros(m, dtype=bool)
+    for index in order.tolist():
+        row, col = rows[index], cols[index]
+        if assignment[row] < 0 and not taken[col]:
+            assignment[row] = col
+            taken[col] = True
+    return assignment
+
+def solve_assignment(cost, exact_max_rows=BATCH_EXACT_MAX_RIDES):
+    """اختيار الحل الدقيق أو الجشع حسب حجم الدفعة؛ يعيد (التعيين، اسم الحل)"""
+    n, m = cost.shape
+    if n > exact_max_rows:
+        return greedy(cost), 'greedy'
+    # تقليص الأعمدة إلى اتحاد أقرب المرشحين لكل صف قبل الحل الدقيق
+    k = min(BATCH_CANDIDATES_PER_RIDE, m)
+    if k < m:
+        columns = np.unique(np.argpartition(cost, k - 1, axis=1)[:, :k])
+    else:
+        columns = np.arange(m)
+    reduced = cost[:, columns]
+    if reduced.shape[0] <= reduced.shape[1]:
+        assignment = hungarian(reduced)
+    else:
+        # صفوف أكثر من الأعمدة: الحل على المنقول ثم عكس الاتجاه
+        transposed = hungarian(reduced.T)
+        assignment = np.full(n, -1, dtype=np.int64)
+        assignment[transposed] = np.arange(reduced.shape[1])
+    result = np.full(n, -1, dtype=np.int64)
+    matched = assignment >= 0
+    result[matched] = columns[assignment[matched]]
+    return result, 'hungarian'
+
+# ============================================================================
+# المطابق الدفعي
+# ============================================================================
+
+class BatchMatcher:
+    """
+    يجمع الرحلات المعلقة خلال نافذة قصيرة ثم يعين كل رحلة لسائق واحد
+    ويرسل له عرضاً موجهاً. الرحلات المرفوضة أو المنتهية المهلة تعود للدفعة التالية.
+
+    fetch_drivers(points) تعيد صفوف السائقين المتاحين قرب نقاط الالتقاط [(lat, lng)] بإحداثيات عشرية،
+    send_offer(ride, driver, distance_km) ترسل العرض وتعيد True عند النجاح،
+    is_pending(ride_id) تتحقق من أن الرحلة ما زالت بانتظار سائق،
+    on_expired(ride) تُستدعى عند التخلي عن رحلة لم يُعثر لها على سائق.
+    """
+
+    def __init__(self, fetch_drivers, send_offer, is_pending, on_expired=None, window_s=BATCH_WINDOW_S):
+        self.fetch_drivers = fetch_drivers
+        self.send_offer = send_offer
+        self.is_pending = is_pending
+        self.on_expired = on_expired
+        self.window_s = window_s
+        self._queue = {}
+        self._offers = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        PENDING_RIDES.set_function(lambda: {
+            ('queued',): len(self._queue),
+            ('offered',): len(self._offers),
+        })
+
+    def _ensure_running(self):
+        """تشغيل خيط الدفعات في العملية الحالية (يعاد إنشاؤه بعد fork)"""
+        pid = os.getpid()
+        if self._thread is not None and self._pid == pid:
+            return
+        with self._lock:
+            if self._thread is None or self._pid != pid:
+                self._pid = pid
+                self._thread = threading.Thread(target=self._loop, name='batch-matcher', daemon=True)
+                self._thread.start()
+
+    def submit(self, ride):
+        """إضافة رحلة (ride_id, lat, lng وأي بيانات للعرض) إلى الدفعة القادمة"""
+        ride.setdefault('submitted_at', time.time())
+        ride.setdefault('rejected_by', set())
+        with self._lock:
+            self._queue[ride['ride_id']] = ride
+        self._ensure_running()
+
+    def reject(self, ride_id, driver_id):
+        """رفض السائق للعرض: إعادة الرحلة للدفعة مع استبعاده"""
+        with self._lock:
+            offer = self._offers.get(ride_id)
+            if offer is None or offer[1] != driver_id:
+                return False
+            ride = self._offers.pop(ride_id)[0]
+            ride['rejected_by'].add(driver_id)
+            self._queue[ride_id] = ride
+        return True
+
+    def accepted(self, ride_id):
+        """قبول الرحلة: إزالة العرض المعلق"""
+        with self._lock:
+            self._offers.pop(ride_id, None)
+            self._queue.pop(ride_id, None)
+
+    def _loop(self):
+        while True:
+            time.sleep(self.window_s)
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"❌ خطأ في دفعة المطابقة: {e}")
+
+    def _expire_offers(self, now):
+        """إعادة العروض التي لم يرد عليها السائق خلال المهلة"""
+        with self._lock:
+            expired = [
+                (ride_id, entry) for ride_id, entry in self._offers.items()
+                if now - entry[2] > BATCH_OFFER_TIMEOUT_S
+            ]
+            for ride_id, _ in expired:
+                del self._offers[ride_id]
+        for ride_id, (ride, driver_id, _) in expired:
+            # قد تكون الرحلة قُبلت في عامل آخر
+            if self.is_pending(ride_id):
+                ride['rejected_by'].add(driver_id)
+                with self._lock:
+                    self._queue[ride_id] = ride
+
+    def run_once(self, now=None):
+        """حل دفعة واحدة: يعيد عدد الرحلات التي أُرسل لها عرض"""
+        now = time.time() if now is None else now
+        self._expire_offers(now)
+
+        with self._lock:
+            expired = [ride for ride in self._queue.values() if now - ride['submitted_at'] > BATCH_RIDE_TIMEOUT_S]
+            for ride in expired:
+                del self._queue[ride['ride_id']]
+            rides = list(self._queue.values())
+            busy = {entry[1] for entry in self._offers.values()}
+        for ride in expired:
+            BATCH_RIDES.inc('expired')
+            if self.on_expired:
+                self.on_expired(ride)
+        if not rides:
+            return 0
+
+        points = [(ride['lat'], ride['lng']) for ride in rides]
+        drivers = [d for d in self.fetch_drivers(points) if str(d['driver_id']) not in busy]
+        if not drivers:
+            BATCH_RIDES.inc('unassigned', amount=len(rides))
+            return 0
+
+        start = time.perf_counter()
+        lats = np.array([d['current_lat'] for d in drivers], dtype=np.float64)
+        lngs = np.array([d['current_lng'] for d in drivers], dtype=np.float64)
+        driver_ids = [str(d['driver_id']) for d in drivers]
+        column_of = {driver_id: col for col, driver_id in enumerate(driver_ids)}
+        cost = np.empty((len(rides), len(drivers)))
+        for row, ride in enumerate(rides):
+            cost[row] = haversine_km(ride['lat'], ride['lng'], lats, lngs) * QUOTE_ROAD_FACTOR
+            for driver_id in ride['rejected_by']:
+                if driver_id in column_of:
+                    cost[row, column_of[driver_id]] = FORBIDDEN
+        cost[np.isnan(cost) | (cost > BATCH_MAX_PICKUP_KM)] = FORBIDDEN
+
+        assignment, solver = solve_assignment(cost)
+        SOLVE_TIME.observe(time.perf_counter() - start, solver)
+
+        sent = 0
+        for row, col in enumerate(assignment.tolist()):
+            ride = rides[row]
+            if col < 0 or cost[row, col] >= FORBIDDEN:
+                BATCH_RIDES.inc('unassigned')
+                continue
+            driver = drivers[col]
+            with self._lock:
+                if self._queue.pop(ride['ride_id'], None) is None:
+                    continue
+                self._offers[ride['ride_id']] = (ride, driver_ids[col], now)
+            if self.send_offer(ride, driver, float(cost[row, col])):
+                BATCH_RIDES.inc('assigned')
+                sent += 1
+            else:
+                # فشل الإرسال: استبعاد السائق وإعادة الرحلة
+                with self._lock:
+                    self._offers.pop(ride['ride_id'], None)
+                    ride['rejected_by'].add(driver_ids[col])
+                    self._queue[ride['ride_id']] = ride
+        return sent
@@ -0,0 +1,211 @@
+"""
+📈 مقاييس بصيغة Prometheus - تنفيذ خفيف الأقفال
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    # في وضع gevent يصبح threading.local محلياً لكل greenlet، بينما نريد جزءاً لكل خيط حقيقي
+    from gevent.monkey import get_original
+    _thread_local = get_original('threading', 'local')
+except ImportError:
+    _thread_local = threading.local
+
+# ============================================================================
+# إعدادات أساسية
+# ============================================================================
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# حدود الفترات الافتراضية بالثواني
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# ============================================================================
+# السجل
+# ============================================================================
+
+class Registry:
+    """سجل المقاييس المعرفة"""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """تسجيل مقياس جديد"""
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self):
+        """إخراج جميع المقاييس بصيغة Prometheus النصية"""
+        lines = []
+        for metric in list(self._metrics):
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+def _escape(value):
+    """تهريب قيمة التسمية"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=None):
+    """تنسيق التسميات"""
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value):
+    """تنسيق القيمة الرقمية"""
+    if value == float('inf'):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+# ============================================================================
+# أنواع المقاييس
+# ============================================================================
+
+class _ShardedMetric:
+    """
+    مقياس مقسم حسب الخيط: كل خيط يكتب في جزئه الخاص دون أقفال،
+    ويتم الدمج فقط عند القراءة.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = _thread_local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _shard(self):
+        """الحصول على جزء الخيط الحالي"""
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = {}
+            # القفل يؤخذ مرة واحدة فقط لكل خيط
+            with self._shards_lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+        return shard
+
+    def _snapshots(self):
+        """نسخ محتوى جميع الأجزاء"""
+        with self._shards_lock:
+            shards = list(self._shards)
+        return [list(shard.items()) for shard in shards]
+
+class Counter(_ShardedMetric):
+    """عداد تراكمي"""
+    kind = "counter"
+
+    def inc(self, *labelvalues, amount=1):
+        """زيادة العداد"""
+        shard = self._shard()
+        shard[labelvalues] = shard.get(labelvalues, 0) + amount
+
+    def value(self, *labelvalues):
+        """القيمة الحالية المدمجة"""
+        return sum(v for items in self._snapshots() for k, v in items if k == labelvalues)
+
+    def collect(self):
+        totals = {}
+        for items in self._snapshots():
+            for key, value in items:
+                totals[key] = totals.get(key, 0) + value
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in sorted(totals.items())
+        ]
+
+class Histogram(_ShardedMetric):
+    """مدرج تكراري لتوزيع الأزمنة"""
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labelvalues):
+        """تسجيل قيمة"""
+        shard = self._shard()
+        entry = shard.get(labelvalues)
+        if entry is None:
+            # [عدادات الفترات..., فترة +Inf, المجموع]
+            entry = [0] * (len(self.buckets) + 2)
+            shard[labelvalues] = entry
+        entry[bisect.bisect_left(self.buckets, value)] += 1
+        entry[-1] += value
+
+    @contextmanager
+    def time(self, *labelvalues):
+        """قياس زمن كتلة برمجية"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labelvalues)
+
+    def collect(self):
+        totals = {}
+        for items in self._snapshots():
+            for key, entry in items:
+                merged = totals.setdefault(key, [0] * len(entry))
+                for i, value in enumerate(list(entry)):
+                    merged[i] += value
+        lines = []
+        for key, entry in sorted(totals.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), entry[:-1]):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, ('le', _format_value(bound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(entry[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+class Gauge:
+    """مقياس لحظي - آخر قيمة مكتوبة أو دالة تُستدعى عند القراءة"""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._function = None
+        if registry is not None:
+            registry.register(self)
+
+    def set(self, value, *labelvalues):
+        """تعيين القيمة"""
+        self._values[labelvalues] = value
+
+    def set_function(self, function):
+        """تعيين دالة تعيد قاموس {التسميات: القيمة} عند القراءة"""
+        self._function = function
+
+    def collect(self):
+        values = dict(self._values)
+        if self._function is not None:
+            try:
+                values.update(self._function())
+            except Exception:
+                pass
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in sorted(values.items())
+        ]
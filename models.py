@@ -0,0 +1,90 @@
+"""
+🧱 نماذج صفوف قاعدة البيانات: كائنات بفتحات ثابتة (__slots__) تُبنى من مؤشرات tuple
+"""
+
+# ============================================================================
+# الصف الأساسي
+# ============================================================================
+
+class Row:
+    """
+    صف بحقول ثابتة بدل قاموس لكل صف: لا مفاتيح نصية مكررة ولا جدول تجزئة.
+    يدعم row['field'] و row.get() والتعيين بالفهرس ليعمل مع الكود المكتوب للصفوف القاموسية.
+    """
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    @classmethod
+    def columns(cls, table=None):
+        """قائمة أعمدة النموذج لاستعلام SELECT (مع اسم الجدول عند الربط)"""
+        prefix = f"{table}." if table else ""
+        return ", ".join(prefix + name for name in cls.__slots__)
+
+    @classmethod
+    def from_rows(cls, description, rows):
+        """بناء النماذج من صفوف tuple بخريطة فهارس الأعمدة (الأعمدة الناقصة None)"""
+        names = tuple(column[0] for column in description)
+        if names == cls.__slots__:
+            return [cls(*row) for row in rows]
+        index = {name: position for position, name in enumerate(names)}
+        picks = [index.get(name) for name in cls.__slots__]
+        return [cls(*[None if position is None else row[position] for position in picks]) for row in rows]
+
+    @classmethod
+    def fetchall(cls, cur):
+        """كل صفوف آخر استعلام كنماذج"""
+        return cls.from_rows(cur.description, cur.fetchall())
+
+    @classmethod
+    def fetchone(cls, cur):
+        """أول صف من آخر استعلام كنموذج أو None"""
+        row = cur.fetchone()
+        return cls.from_rows(cur.description, [row])[0] if row is not None else None
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def get(self, key, default=None):
+        """مثل dict.get: القيمة أو default إذا لم يكن الحقل من حقول النموذج"""
+        return getattr(self, key, default) if key in self.__slots__ else default
+
+    def to_dict(self):
+        """نسخة قاموسية (للتسجيل أو JSON)"""
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+# ============================================================================
+# النماذج
+# ============================================================================
+
+class User(Row):
+    """مستخدم (عميل أو سائق)"""
+    __slots__ = ('user_id', 'username', 'first_name', 'last_name', 'role',
+                 'rating', 'rating_count', 'total_rides', 'payment_method', 'created_at', 'is_active')
+
+class Ride(Row):
+    """رحلة مع حالتها وتكلفتها وأطرافها"""
+    __slots__ = ('ride_id', 'customer_id', 'driver_id', 'pickup_location', 'destination',
+                 'pickup_lat', 'pickup_lng', 'status', 'fare', 'payment_method',
+                 'created_at', 'accepted_at', 'completed_at')
+
+class ActiveDriver(Row):
+    """سائق متصل وآخر موقع معروف له"""
+    __slots__ = ('driver_id', 'username', 'vehicle_type', 'vehicle_number',
+                 'current_lat', 'current_lng', 'is_available', 'updated_at')
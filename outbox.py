@@ -0,0 +1,159 @@
+"""
+📮 صندوق الصادر: إرسال الإشعارات المحفوظة مع تغيير حالة الرحلة بدفعات وإعادة محاولة وترتيب لكل محادثة
+"""
+
+import os
+import time
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+# ============================================================================
+# الإعدادات
+# ============================================================================
+
+# الفترة بين دورات السحب عند عدم وجود إشعارات جديدة في هذا العامل (بالثواني)
+OUTBOX_POLL_S = float(os.environ.get('OUTBOX_POLL_S', '1'))
+# أقصى عدد رسائل في الدفعة، وعدد المحادثات المرسل إليها بالتوازي
+OUTBOX_BATCH = int(os.environ.get('OUTBOX_BATCH', '50'))
+OUTBOX_CONCURRENCY = int(os.environ.get('OUTBOX_CONCURRENCY', '8'))
+# مدة حجز الدفعة قبل أن تعود متاحة (إذا توقف العامل أثناء الإرسال)
+OUTBOX_LEASE_S = float(os.environ.get('OUTBOX_LEASE_S', '60'))
+# التراجع الأسي بين المحاولات وأقصى عدد محاولات قبل التخلي عن الرسالة
+OUTBOX_BACKOFF_BASE_S = float(os.environ.get('OUTBOX_BACKOFF_BASE_S', '2'))
+OUTBOX_BACKOFF_MAX_S = float(os.environ.get('OUTBOX_BACKOFF_MAX_S', '300'))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '8'))
+
+OUTBOX_MESSAGES = Counter('outbox_messages_total', 'نتائج إرسال رسائل صندوق الصادر', ['result'])
+OUTBOX_LAG = Histogram('outbox_delivery_lag_seconds', 'الزمن من حفظ الإشعار حتى تسليمه')
+OUTBOX_BACKLOG = Gauge('outbox_backlog', 'رسائل صندوق الصادر المعلقة عند آخر دفعة', ['measure'])
+
+# ============================================================================
+# أخطاء الإرسال
+# ============================================================================
+
+class PermanentError(Exception):
+    """خطأ لن تصلحه إعادة المحاولة (المستخدم حظر البوت، محادثة غير موجودة)"""
+
+class RetryAfter(Exception):
+    """طلب صريح بالانتظار قبل إعادة المحاولة (429)"""
+
+    def __init__(self, delay_s, message=''):
+        super().__init__(message or f"retry after {delay_s}s")
+        self.delay_s = delay_s
+
+def backoff_delay(attempts):
+    """تراجع أسي مع تشويش للمحاولة رقم attempts"""
+    delay = min(OUTBOX_BACKOFF_MAX_S, OUTBOX_BACKOFF_BASE_S * (2 ** attempts))
+    return delay * random.uniform(0.5, 1.0)
+
+# ============================================================================
+# المرسل
+# ============================================================================
+
+class OutboxDispatcher:
+    """
+    claim(limit, lease_s) تحجز دفعة من الرسائل الجاهزة مرتبة حسب id وتعيد
+    (الصفوف، {'pending', 'oldest_s'}) أو None إذا كان عامل آخر يحجز الآن،
+    send(row) ترسل الرسالة أو ترفع استثناء،
+    finish(results) تسجل [(id, action, delay_s, error)] حيث action أحد
+    sent / retry / failed / release.
+    """
+
+    def __init__(self, claim, send, finish):
+        self.claim = claim
+        self.send = send
+        self.finish = finish
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._executor = None
+        self._backlog = {}
+        OUTBOX_BACKLOG.set_function(lambda: {(measure,): value for measure, value in self._backlog.items()})
+
+    def _ensure_running(self):
+        """تشغيل خيط الإرسال في العملية الحالية (يعاد إنشاؤه بعد fork)"""
+        pid = os.getpid()
+        if self._thread is not None and self._pid == pid:
+            return
+        with self._lock:
+            if self._thread is None or self._pid != pid:
+                self._pid = pid
+                self._executor = ThreadPoolExecutor(OUTBOX_CONCURRENCY, thread_name_prefix='outbox-send')
+                self._thread = threading.Thread(target=self._loop, name='outbox', daemon=True)
+                self._thread.start()
+
+    def start(self):
+        """تشغيل دورة السحب في هذا العامل: الرسائل المعلقة من قبل إعادة التشغيل تُرسل دون انتظار إشعار جديد"""
+        self._ensure_running()
+
+    def wake(self):
+        """إشعارات جديدة حُفظت: الإرسال فوراً بدلاً من انتظار الدورة التالية"""
+        self._ensure_running()
+        self._wake.set()
+
+    def _loop(self):
+        while True:
+            self._wake.wait(OUTBOX_POLL_S)
+            self._wake.clear()
+            try:
+                # دفعة ممتلئة تعني وجود المزيد
+                while self.run_once() >= OUTBOX_BATCH:
+                    pass
+            except Exception as e:
+                logger.error(f"❌ خطأ في إرسال صندوق الصادر: {e}")
+
+    def _send_chat(self, rows):
+        """إرسال رسائل محادثة واحدة بالترتيب؛ التوقف عند أول فشل"""
+        results = []
+        for index, row in enumerate(rows):
+            try:
+                self.send(row)
+            except PermanentError as e:
+                results.append((row['id'], 'failed', None, str(e)[:500]))
+                OUTBOX_MESSAGES.inc('failed')
+                continue
+            except Exception as e:
+                attempts = row['attempts'] + 1
+                if attempts >= OUTBOX_MAX_ATTEMPTS:
+                    results.append((row['id'], 'failed', None, str(e)[:500]))
+                    OUTBOX_MESSAGES.inc('failed')
+                    continue
+                delay = e.delay_s if isinstance(e, RetryAfter) else backoff_delay(attempts)
+                results.append((row['id'], 'retry', delay, str(e)[:500]))
+                OUTBOX_MESSAGES.inc('retry')
+                # الرسائل التالية لنفس المحادثة تنتظر خلفها
+                results.extend((later['id'], 'release', None, None) for later in rows[index + 1:])
+                break
+            results.append((row['id'], 'sent', None, None))
+            OUTBOX_MESSAGES.inc('sent')
+            OUTBOX_LAG.observe(row['age_s'] + (time.monotonic() - row['claimed_at']))
+        return results
+
+    def run_once(self):
+        """دفعة واحدة: الحجز ثم الإرسال بالتوازي بين المحادثات؛ يعيد عدد الرسائل المحجوزة"""
+        claimed = self.claim(OUTBOX_BATCH, OUTBOX_LEASE_S)
+        if claimed is None:
+            return 0
+        rows, self._backlog = claimed
+        if not rows:
+            return 0
+
+        now = time.monotonic()
+        chats = {}
+        for row in rows:
+            row['claimed_at'] = now
+            chats.setdefault(row['chat_id'], []).append(row)
+
+        self._ensure_running()
+        results = []
+        for chat_results in self._executor.map(self._send_chat, chats.values()):
+            results.extend(chat_results)
+        self.finish(results)
+        return len(rows)
@@ -0,0 +1,200 @@
+"""
+💓 حضور السائقين: فهرس نبضات في الذاكرة مع عجلة مؤقتات ومزامنة دفعية لـ active_drivers
+"""
+
+import os
+import math
+import time
+import logging
+import threading
+
+from metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+# ============================================================================
+# الإعدادات
+# ============================================================================
+
+# مدة بقاء السائق متاحاً بعد آخر نبضة (موقع أو ضغط زر)
+PRESENCE_TTL_S = float(os.environ.get('PRESENCE_TTL_S', '600'))
+# دقة عجلة المؤقتات
+PRESENCE_TICK_S = float(os.environ.get('PRESENCE_TICK_S', '1'))
+# الفترة بين دفعات المزامنة مع قاعدة البيانات
+PRESENCE_SYNC_S = float(os.environ.get('PRESENCE_SYNC_S', '2'))
+# إعادة تحميل السائقين المتصلين من قاعدة البيانات (لتبني من ظهروا في عمال آخرين)
+PRESENCE_RELOAD_S = float(os.environ.get('PRESENCE_RELOAD_S', '60'))
+
+PRESENCE_EVENTS = Counter('driver_presence_events_total', 'أحداث حضور السائقين', ['event'])
+PRESENCE_ONLINE = Gauge('driver_presence_online', 'السائقون المتصلون في فهرس العامل الحالي')
+
+# ============================================================================
+# عجلة المؤقتات
+# ============================================================================
+
+class TimerWheel:
+    """
+    عجلة مؤقتات مجزأة: الجدولة والإلغاء بزمن ثابت، والتقدم يزور خانات
+    الدقات المنقضية فقط. المواعيد الأبعد من دورة كاملة تبقى حتى دورتها.
+    """
+
+    def __init__(self, span_s=PRESENCE_TTL_S, tick_s=PRESENCE_TICK_S):
+        self.tick_s = tick_s
+        self.size = int(math.ceil(span_s / tick_s)) + 1
+        self.slots = [set() for _ in range(self.size)]
+        self.deadlines = {}
+        self.current = None
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def schedule(self, key, deadline):
+        """جدولة (أو إعادة جدولة) انتهاء المفتاح عند deadline بالثواني"""
+        tick = int(math.ceil(deadline / self.tick_s))
+        if self.current is not None and tick <= self.current:
+            tick = self.current + 1
+        self.cancel(key)
+        self.slots[tick % self.size].add(key)
+        self.deadlines[key] = tick
+
+    def cancel(self, key):
+        """إلغاء مؤقت المفتاح"""
+        tick = self.deadlines.pop(key, None)
+        if tick is not None:
+            self.slots[tick % self.size].discard(key)
+
+    def advance(self, now):
+        """التقدم حتى الوقت now وإرجاع المفاتيح المنتهية"""
+        tick = int(now // self.tick_s)
+        if self.current is None:
+            self.current = tick
+            return []
+        expired = []
+        for step in range(max(self.current + 1, tick - self.size + 1), tick + 1):
+            slot = self.slots[step % self.size]
+            due = [key for key in slot if self.deadlines[key] <= tick]
+            for key in due:
+                slot.discard(key)
+                del self.deadlines[key]
+            expired.extend(due)
+        self.current = max(self.current, tick)
+        return expired
+
+# ============================================================================
+# فهرس الحضور
+# ============================================================================
+
+class DriverPresence:
+    """
+    يسجل نبضات السائقين في الذاكرة ويكتبها إلى active_drivers في دفعات.
+
+    flush_heartbeats(rows) تكتب [(driver_id, lat, lng, age_s)] دفعة واحدة،
+    flush_expired(driver_ids, ttl_s) تعلّم السائقين غير متاحين إن لم تصل نبضتهم
+    من عامل آخر، وتعيد {driver_id: age_s} لمن ما زالوا متصلين،
+    load_online() تعيد {driver_id: age_s} للسائقين المتاحين في قاعدة البيانات.
+    """
+
+    def __init__(self, flush_heartbeats, flush_expired, load_online,
+                 ttl_s=PRESENCE_TTL_S, tick_s=PRESENCE_TICK_S, sync_s=PRESENCE_SYNC_S):
+        self.flush_heartbeats = flush_heartbeats
+        self.flush_expired = flush_expired
+        self.load_online = load_online
+        self.ttl_s = ttl_s
+        self.sync_s = sync_s
+        self.wheel = TimerWheel(ttl_s, tick_s)
+        self._pending = {}
+        self._expired = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._loaded_at = None
+        PRESENCE_ONLINE.set_function(lambda: {(): len(self.wheel)})
+
+    def _ensure_running(self):
+        """تشغيل خيط المزامنة في العملية الحالية (يعاد إنشاؤه بعد fork)"""
+        pid = os.getpid()
+        if self._thread is not None and self._pid == pid:
+            return
+        with self._lock:
+            if self._thread is None or self._pid != pid:
+                self._pid = pid
+                self._thread = threading.Thread(target=self._loop, name='driver-presence', daemon=True)
+                self._thread.start()
+
+    def heartbeat(self, driver_id, lat=None, lng=None, now=None):
+        """نبضة من سائق (مع موقعه إن وجد): تمديد حضوره وجدولة كتابتها"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            previous = self._pending.get(driver_id)
+            if lat is None and previous is not None:
+                lat, lng = previous[0], previous[1]
+            self._pending[driver_id] = (lat, lng, now)
+            self._expired.discard(driver_id)
+            self.wheel.schedule(driver_id, now + self.ttl_s)
+        PRESENCE_EVENTS.inc('heartbeat')
+        self._ensure_running()
+
+    def touch(self, driver_id, lat=None, lng=None, now=None):
+        """نشاط أزرار أو موقع مباشر: يمدد حضور السائقين المعروفين فقط"""
+        if driver_id in self.wheel:
+            self.heartbeat(driver_id, lat, lng, now=now)
+
+    def offline(self, driver_id):
+        """إنهاء العمل صراحة (الحذف من الجدول يتم مباشرة)"""
+        with self._lock:
+            self.wheel.cancel(driver_id)
+            self._pending.pop(driver_id, None)
+            self._expired.discard(driver_id)
+        PRESENCE_EVENTS.inc('offline')
+
+    def _loop(self):
+        while True:
+            time.sleep(self.sync_s)
+            try:
+                self.sync()
+            except Exception as e:
+                logger.error(f"❌ خطأ في مزامنة حضور السائقين: {e}")
+
+    def _reload(self, now):
+        """تبني السائقين المتاحين في قاعدة البيانات بمواعيد انتهائهم الفعلية"""
+        online = self.load_online()
+        with self._lock:
+            for driver_id, age_s in online.items():
+                if driver_id not in self._pending:
+                    self.wheel.schedule(driver_id, now - age_s + self.ttl_s)
+        self._loaded_at = now
+
+    def sync(self, now=None):
+        """دفعة مزامنة واحدة: النبضات أولاً ثم حالات الانتهاء"""
+        now = time.monotonic() if now is None else now
+        if self._loaded_at is None or now - self._loaded_at >= PRESENCE_RELOAD_S:
+            self._reload(now)
+
+        with self._lock:
+            self._expired.update(self.wheel.advance(now))
+            pending, self._pending = self._pending, {}
+            expired, self._expired = self._expired, set()
+
+        if pending:
+            rows = [(driver_id, lat, lng, max(0.0, now - seen)) for driver_id, (lat, lng, seen) in pending.items()]
+            if not self.flush_heartbeats(rows):
+                # إعادة المحاولة في الدفعة التالية دون الكتابة فوق نبضات أحدث
+                with self._lock:
+                    for driver_id, entry in pending.items():
+                        self._pending.setdefault(driver_id, entry)
+                return
+
+        if expired:
+            alive = self.flush_expired(sorted(expired), self.ttl_s)
+            if alive is None:
+                with self._lock:
+                    self._expired.update(expired - set(self._pending))
+                return
+            PRESENCE_EVENTS.inc('expired', amount=len(expired) - len(alive))
+            with self._lock:
+                for driver_id, age_s in alive.items():
+                    if driver_id not in self.wheel:
+                        self.wheel.schedule(driver_id, now - age_s + self.ttl_s)
@@ -0,0 +1,76 @@
+"""
+🧮 تسعير الرحلات وتقدير وقت الوصول لجميع السائقين المرشحين دفعة واحدة (NumPy)
+"""
+
+import os
+import numpy as np
+
+# ============================================================================
+# الإعدادات
+# ============================================================================
+
+# متوسط سرعة السائق داخل المدينة لتقدير وقت الوصول
+QUOTE_SPEED_KMH = float(os.environ.get('QUOTE_SPEED_KMH', '30'))
+# معامل تحويل المسافة المستقيمة إلى مسافة طرق تقريبية
+QUOTE_ROAD_FACTOR = float(os.environ.get('QUOTE_ROAD_FACTOR', '1.3'))
+
+EARTH_RADIUS_KM = 6371.0088
+
+# ============================================================================
+# الحساب المتجه
+# ============================================================================
+
+def haversine_km(lat, lng, lats, lngs):
+    """المسافة (كم) من نقطة واحدة إلى مصفوفة نقاط"""
+    lat1 = np.radians(lat)
+    lat2 = np.radians(lats)
+    dlat = lat2 - lat1
+    dlng = np.radians(lngs) - np.radians(lng)
+    a = np.sin(dlat * 0.5) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlng * 0.5) ** 2
+    return 2.0 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+def quote_arrays(pickup_lat, pickup_lng, lats, lngs, fare_fn, limit=None):
+    """
+    ترتيب المرشحين حسب المسافة وحساب وقت الوصول والتكلفة لكل منهم.
+    يعيد (الفهارس مرتبة، المسافة كم، وقت الوصول دقيقة، التكلفة) لأقرب limit مرشح.
+    fare_fn هي دالة التسعير (distance_km, duration_min) وتُطبق على المصفوفات مباشرة.
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lngs = np.asarray(lngs, dtype=np.float64)
+    distance = haversine_km(pickup_lat, pickup_lng, lats, lngs) * QUOTE_ROAD_FACTOR
+
+    # السائقون بدون موقع معروف لا يدخلون الترتيب
+    valid = np.flatnonzero(~np.isnan(distance))
+    if limit is not None and limit < valid.size:
+        nearest = np.argpartition(distance[valid], limit - 1)[:limit]
+        valid = valid[nearest]
+    order = valid[np.argsort(distance[valid], kind='stable')]
+
+    distance = distance[order]
+    eta = distance / QUOTE_SPEED_KMH * 60.0
+    fare = fare_fn(distance, eta)
+    return order, distance, eta, fare
+
+def driver_coordinates(drivers):
+    """مصفوفتا خطوط العرض والطول لصفوف active_drivers (القيم الفارغة تصبح NaN)"""
+    lats = np.array([d['current_lat'] for d in drivers], dtype=np.float64)
+    lngs = np.array([d['current_lng'] for d in drivers], dtype=np.float64)
+    return lats, lngs
+
+def quote_drivers(pickup_lat, pickup_lng, drivers, fare_fn, limit=None, coordinates=None):
+    """
+    تسعير صفوف active_drivers: يعيد قائمة (السائق، العرض) مرتبة من الأقرب،
+    والعرض قاموس بالمفاتيح distance_km و eta_min و fare.
+    """
+    if not drivers:
+        return []
+    lats, lngs = coordinates if coordinates is not None else driver_coordinates(drivers)
+    order, distance, eta, fare = quote_arrays(pickup_lat, pickup_lng, lats, lngs, fare_fn, limit)
+    return [
+        (drivers[index], {
+            'distance_km': round(float(distance_km), 2),
+            'eta_min': max(1, int(round(float(eta_min)))),
+            'fare': round(float(amount), 2),
+        })
+        for index, distance_km, eta_min, amount in zip(order.tolist(), distance, eta, fare)
+    ]
@@ -0,0 +1,88 @@
+"""
+🪣 تقييد معدل الإجراءات المكلفة لكل مستخدم (دلو رموز بصيغة GCRA)
+"""
+
+import os
+import time
+import threading
+
+from metrics import Counter, Gauge
+
+# ============================================================================
+# الإعدادات
+# ============================================================================
+
+def _limit(name, burst, per_min):
+    """قراءة (السعة، المعدل بالدقيقة) لفئة إجراء من البيئة"""
+    return (
+        int(os.environ.get(f'RATE_{name}_BURST', burst)),
+        float(os.environ.get(f'RATE_{name}_PER_MIN', per_min)),
+    )
+
+# فئات الإجراءات: ride = إنشاء رحلة (يرسل عروضاً لعشرات السائقين)،
+# location = تحديثات موقع السائق، history = استعلامات السجل والرصيد
+RATE_LIMITS = {
+    'ride': _limit('RIDE', '3', '2'),
+    'location': _limit('LOCATION', '10', '30'),
+    'history': _limit('HISTORY', '5', '6'),
+}
+# الفترة بين عمليات حذف الدلاء الممتلئة من الذاكرة (بالثواني)
+RATE_SWEEP_S = float(os.environ.get('RATE_SWEEP_S', '60'))
+
+RATE_DECISIONS = Counter('rate_limit_decisions_total', 'قرارات تقييد المعدل', ['action', 'result'])
+RATE_TRACKED = Gauge('rate_limit_tracked_users', 'المستخدمون ذوو الدلاء غير الممتلئة', ['action'])
+
+# ============================================================================
+# المقيد
+# ============================================================================
+
+class RateLimiter:
+    """
+    دلو رموز لكل (فئة، مستخدم) مخزن كرقم واحد: الوقت الذي يمتلئ فيه الدلو
+    (GCRA). الدلو الممتلئ مطابق لعدم وجود سجل، لذا يحذف دورياً دون تغيير السلوك.
+    """
+
+    def __init__(self, limits=RATE_LIMITS, sweep_s=RATE_SWEEP_S):
+        self.limits = {}
+        self._buckets = {}
+        for action, (burst, per_min) in limits.items():
+            interval = 60.0 / per_min
+            # (الفاصل بين الرموز، سماحية الاندفاع)
+            self.limits[action] = (interval, max(0, burst - 1) * interval)
+            self._buckets[action] = {}
+        self.sweep_s = sweep_s
+        self._swept_at = time.monotonic()
+        self._lock = threading.Lock()
+        RATE_TRACKED.set_function(lambda: {
+            (action,): len(buckets) for action, buckets in self._buckets.items()
+        })
+
+    def check(self, action, user_id, now=None):
+        """استهلاك رمز؛ يعيد 0 عند السماح أو عدد الثواني حتى توفر الرمز التالي"""
+        interval, tolerance = self.limits[action]
+        key = int(user_id)
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if now - self._swept_at >= self.sweep_s:
+                self._sweep(now)
+            buckets = self._buckets[action]
+            full_at = max(buckets.get(key, now), now)
+            wait = full_at - tolerance - now
+            if wait > 0:
+                RATE_DECISIONS.inc(action, 'limited')
+                return wait
+            buckets[key] = full_at + interval
+        RATE_DECISIONS.inc(action, 'allowed')
+        return 0
+
+    def recent(self, action, user_id, now=None):
+        """هل استهلك المستخدم رموزاً من هذه الفئة ولم يمتلئ دلوه بعد؟ (دون استهلاك)"""
+        now = time.monotonic() if now is None else now
+        return self._buckets[action].get(int(user_id), now) > now
+
+    def _sweep(self, now):
+        """حذف الدلاء التي امتلأت من جديد"""
+        for buckets in self._buckets.values():
+            for key in [key for key, full_at in buckets.items() if full_at <= now]:
+                del buckets[key]
+        self._swept_at = now
@@ -0,0 +1,174 @@
+"""
+⚡ تسعير الذروة: عدادات نافذة منزلقة للعرض والطلب لكل خلية جغرافية
+"""
+
+import os
+import math
+import time
+import threading
+import numpy as np
+
+# ============================================================================
+# الإعدادات
+# ============================================================================
+
+# حجم الخلية بالدرجات (0.02 ≈ 2 كم)
+SURGE_CELL_DEG = float(os.environ.get('SURGE_CELL_DEG', '0.02'))
+# طول النافذة المنزلقة بالثواني وعدد الدلاء فيها
+SURGE_WINDOW_S = float(os.environ.get('SURGE_WINDOW_S', '600'))
+SURGE_BUCKETS = int(os.environ.get('SURGE_BUCKETS', '10'))
+# نسبة الطلبات إلى السائقين التي يبدأ بعدها الارتفاع، ومقدار الزيادة لكل وحدة فوقها
+SURGE_THRESHOLD = float(os.environ.get('SURGE_THRESHOLD', '1.0'))
+SURGE_SENSITIVITY = float(os.environ.get('SURGE_SENSITIVITY', '0.5'))
+SURGE_MAX = float(os.environ.get('SURGE_MAX', '2.5'))
+# الفترة بين عمليات حذف الخلايا الخاملة عند تسجيل الطلبات
+SURGE_SWEEP_S = float(os.environ.get('SURGE_SWEEP_S', '60'))
+
+# ============================================================================
+# العداد الحلقي
+# ============================================================================
+
+class RingCounter:
+    """
+    عداد نافذة منزلقة من دلاء ثابتة العدد: الإضافة والقراءة بزمن ثابت،
+    والدلاء المنتهية تُصفّر عند التقدم في الزمن مع تحديث المجموع الجاري.
+    """
+    __slots__ = ('bucket_s', 'size', 'counts', 'samples', 'head', 'total', 'total_samples')
+
+    def __init__(self, window_s=SURGE_WINDOW_S, buckets=SURGE_BUCKETS):
+        self.bucket_s = window_s / buckets
+        self.size = buckets
+        self.counts = [0] * buckets
+        self.samples = [0] * buckets
+        self.head = None
+        self.total = 0
+        self.total_samples = 0
+
+    def _advance(self, now):
+        """تصفير الدلاء التي خرجت من النافذة (على الأكثر size دلو)"""
+        epoch = int(now // self.bucket_s)
+        if self.head is None:
+            self.head = epoch
+        elif epoch > self.head:
+            for step in range(max(self.head + 1, epoch - self.size + 1), epoch + 1):
+                index = step % self.size
+                self.total -= self.counts[index]
+                self.total_samples -= self.samples[index]
+                self.counts[index] = 0
+                self.samples[index] = 0
+            self.head = epoch
+        return self.head % self.size
+
+    def add(self, amount=1, now=None):
+        """إضافة قيمة إلى الدلو الحالي"""
+        index = self._advance(time.time() if now is None else now)
+        self.counts[index] += amount
+        self.samples[index] += 1
+        self.total += amount
+        self.total_samples += 1
+
+    def sum(self, now=None):
+        """مجموع القيم داخل النافذة"""
+        self._advance(time.time() if now is None else now)
+        return self.total
+
+    def mean(self, now=None):
+        """متوسط العينات داخل النافذة"""
+        self._advance(time.time() if now is None else now)
+        return self.total / self.total_samples if self.total_samples else 0.0
+
+# ============================================================================
+# تسعير الذروة
+# ============================================================================
+
+class SurgePricing:
+    """
+    الطلب = عدد طلبات الرحلات في الخلية خلال النافذة،
+    العرض = متوسط عدد السائقين المتاحين في الخلية عند كل طلب.
+    """
+
+    def __init__(self, cell_deg=SURGE_CELL_DEG, window_s=SURGE_WINDOW_S, buckets=SURGE_BUCKETS,
+                 sweep_s=SURGE_SWEEP_S):
+        self.cell_deg = cell_deg
+        self.window_s = window_s
+        self.buckets = buckets
+        self.sweep_s = sweep_s
+        self._cells = {}
+        self._swept_at = time.time()
+        self._lock = threading.Lock()
+
+    def cell(self, lat, lng):
+        """مفتاح الخلية التي تقع فيها النقطة"""
+        return (math.floor(lat / self.cell_deg), math.floor(lng / self.cell_deg))
+
+    def _counters(self, key):
+        counters = self._cells.get(key)
+        if counters is None:
+            counters = self._cells[key] = (
+                RingCounter(self.window_s, self.buckets),
+                RingCounter(self.window_s, self.buckets),
+            )
+        return counters
+
+    def supply_in_cell(self, lat, lng, lats, lngs):
+        """عدد السائقين (من مصفوفات الإحداثيات) داخل خلية النقطة"""
+        row, col = self.cell(lat, lng)
+        with np.errstate(invalid='ignore'):
+            same = (np.floor(lats / self.cell_deg) == row) & (np.floor(lngs / self.cell_deg) == col)
+        return int(np.count_nonzero(same))
+
+    def observe_request(self, lat, lng, lats, lngs, now=None):
+        """تسجيل طلب رحلة وعينة العرض في خليته ثم إرجاع معامل الذروة"""
+        now = time.time() if now is None else now
+        supply = self.supply_in_cell(lat, lng, lats, lngs)
+        with self._lock:
+            if now - self._swept_at >= self.sweep_s:
+                self._sweep(now)
+            demand_counter, supply_counter = self._counters(self.cell(lat, lng))
+            demand_counter.add(1, now)
+            supply_counter.add(supply, now)
+            return self._multiplier(demand_counter.sum(now), supply_counter.mean(now))
+
+    def multiplier(self, lat, lng, now=None):
+        """معامل الذروة الحالي للخلية دون تسجيل طلب"""
+        now = time.time() if now is None else now
+        with self._lock:
+            counters = self._cells.get(self.cell(lat, lng))
+            if counters is None:
+                return 1.0
+            return self._multiplier(counters[0].sum(now), counters[1].mean(now))
+
+    def _sweep(self, now):
+        """حذف الخلايا التي لم يبق لها طلب داخل النافذة"""
+        for key in [key for key, counters in self._cells.items() if not counters[0].sum(now)]:
+            del self._cells[key]
+        self._swept_at = now
+
+    @staticmethod
+    def _multiplier(demand, supply):
+        """تحويل نسبة الطلب إلى العرض إلى معامل مقرب لأقرب 0.1"""
+        ratio = demand / max(supply, 1.0)
+        value = 1.0 + SURGE_SENSITIVITY * max(0.0, ratio - SURGE_THRESHOLD)
+        return round(min(value, SURGE_MAX), 1)
+
+    def snapshot(self, limit=20, now=None):
+        """الخلايا النشطة مرتبة حسب المعامل (للوحة التحكم)؛ تحذف الخلايا الخاملة"""
+        now = time.time() if now is None else now
+        cells = []
+        with self._lock:
+            for key in list(self._cells):
+                demand_counter, supply_counter = self._cells[key]
+                demand = demand_counter.sum(now)
+                if not demand:
+                    del self._cells[key]
+                    continue
+                supply = supply_counter.mean(now)
+                cells.append({
+                    'lat': round((key[0] + 0.5) * self.cell_deg, 4),
+                    'lng': round((key[1] + 0.5) * self.cell_deg, 4),
+                    'demand': demand,
+                    'supply': round(supply, 1),
+                    'multiplier': self._multiplier(demand, supply),
+                })
+        cells.sort(key=lambda cell: (cell['multiplier'], cell['demand']), reverse=True)
+        return cells[:limit]
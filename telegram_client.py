@@ -0,0 +1,138 @@
+"""
+🌐 عميل HTTP صادر لـ Telegram Bot API - تجمع اتصالات دائمة لكل عامل
+"""
+
+import os
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from metrics import Gauge
+
+logger = logging.getLogger(__name__)
+
+# ============================================================================
+# الإعدادات
+# ============================================================================
+
+TELEGRAM_POOL_SIZE = int(os.environ.get('TELEGRAM_POOL_SIZE', '16'))
+TELEGRAM_CONNECT_TIMEOUT = float(os.environ.get('TELEGRAM_CONNECT_TIMEOUT', '3.05'))
+TELEGRAM_READ_TIMEOUT = float(os.environ.get('TELEGRAM_READ_TIMEOUT', '10'))
+TELEGRAM_MAX_RETRIES = int(os.environ.get('TELEGRAM_MAX_RETRIES', '3'))
+TELEGRAM_BACKOFF_FACTOR = float(os.environ.get('TELEGRAM_BACKOFF_FACTOR', '0.3'))
+# أقصى انتظار نقبله من ترويسة Retry-After قبل إعادة المحاولة
+TELEGRAM_MAX_RETRY_AFTER = float(os.environ.get('TELEGRAM_MAX_RETRY_AFTER', '5'))
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+CONNECTIONS = Gauge('telegram_http_connections', 'اتصالات HTTP الصادرة إلى Telegram', ['kind'])
+REUSE_RATIO = Gauge('telegram_http_connection_reuse_ratio', 'نسبة الطلبات التي أعادت استخدام اتصالاً قائماً')
+
+class _CappedRetry(Retry):
+    """إعادة محاولة مع حد أقصى لمدة Retry-After حتى لا يتعطل خيط الويب هوك"""
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, TELEGRAM_MAX_RETRY_AFTER)
+
+# ============================================================================
+# العميل
+# ============================================================================
+
+class TelegramClient:
+    """
+    جلسة requests واحدة لكل عملية (تُنشأ بعد fork) بتجمع اتصالات محدد الحجم،
+    مع إعادة المحاولة على مستوى HTTP لحالات 5xx و 429.
+    """
+
+    def __init__(self, pool_size=TELEGRAM_POOL_SIZE, max_retries=TELEGRAM_MAX_RETRIES,
+                 backoff_factor=TELEGRAM_BACKOFF_FACTOR):
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+        CONNECTIONS.set_function(self._connection_counts)
+        REUSE_RATIO.set_function(self._reuse_ratio)
+
+    def _build_session(self):
+        """إنشاء جلسة جديدة بمحول اتصالات مضبوط"""
+        retry = _CappedRetry(
+            total=self.max_retries,
+            connect=self.max_retries,
+            # لا نعيد المحاولة عند انتهاء مهلة القراءة حتى لا تتكرر الرسائل
+            read=0,
+            status=self.max_retries,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=None,
+            backoff_factor=self.backoff_factor,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=2,
+            pool_maxsize=self.pool_size,
+            pool_block=True,
+            max_retries=retry,
+        )
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    @property
+    def session(self):
+        """جلسة العملية الحالية (يعاد إنشاؤها تلقائياً بعد fork)"""
+        pid = os.getpid()
+        if self._session is None or self._pid != pid:
+            with self._lock:
+                if self._session is None or self._pid != pid:
+                    self._session = self._build_session()
+                    self._pid = pid
+                    logger.info(f"🌐 تم إنشاء جلسة Telegram (تجمع {self.pool_size} اتصال) للعملية {pid}")
+        return self._session
+
+    def request(self, method, url, **kwargs):
+        """تنفيذ طلب عبر الجلسة المشتركة"""
+        return self.session.request(method, url, **kwargs)
+
+    def reset(self):
+        """إغلاق الجلسة الحالية (تُنشأ جلسة جديدة عند أول طلب)"""
+        with self._lock:
+            session, self._session, self._pid = self._session, None, None
+        if session is not None:
+            session.close()
+
+    def _pools(self):
+        """تجمعات urllib3 المفتوحة في الجلسة الحالية"""
+        session = self._session
+        if session is None:
+            return []
+        pools = []
+        for adapter in set(session.adapters.values()):
+            container = adapter.poolmanager.pools
+            for key in list(container.keys()):
+                pool = container.get(key)
+                if pool is not None:
+                    pools.append(pool)
+        return pools
+
+    def _connection_counts(self):
+        """عدد الاتصالات الجديدة والطلبات المنفذة"""
+        pools = self._pools()
+        return {
+            ('opened',): sum(pool.num_connections for pool in pools),
+            ('requests',): sum(pool.num_requests for pool in pools),
+        }
+
+    def _reuse_ratio(self):
+        """نسبة إعادة استخدام الاتصالات"""
+        counts = self._connection_counts()
+        requests_count = counts[('requests',)]
+        if not requests_count:
+            return {}
+        return {(): 1.0 - counts[('opened',)] / requests_count}
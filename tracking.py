@@ -0,0 +1,184 @@
+"""
+🛰️ تتبع الموقع المباشر أثناء الرحلة: مسار مضغوط بترميز الفروق في مصفوفات
+"""
+
+import os
+import time
+import struct
+import threading
+from array import array
+import numpy as np
+
+from quoting import haversine_km
+
+# ============================================================================
+# الإعدادات
+# ============================================================================
+
+# أقل فترة بين نقطتين مقبولتين من نفس السائق (بالثواني)
+LIVE_LOCATION_INTERVAL_S = float(os.environ.get('LIVE_LOCATION_INTERVAL_S', '5'))
+# سماحية التبسيط عند حفظ المسار (بالأمتار)
+TRACE_TOLERANCE_M = float(os.environ.get('TRACE_TOLERANCE_M', '10'))
+# أقصى عدد نقاط في الذاكرة لكل رحلة قبل تبسيط المسار في مكانه
+TRACE_MAX_POINTS = int(os.environ.get('TRACE_MAX_POINTS', '20000'))
+
+# دقة التخزين: 1e-5 درجة ≈ 1.1 متر
+COORD_SCALE = 100000
+_HEADER = struct.Struct('<qqq')
+
+# ============================================================================
+# تقييد المعدل
+# ============================================================================
+
+class Throttle:
+    """السماح بحدث واحد لكل مفتاح خلال الفترة المحددة"""
+
+    def __init__(self, interval_s=LIVE_LOCATION_INTERVAL_S):
+        self.interval_s = interval_s
+        self._last = {}
+        self._lock = threading.Lock()
+
+    def allow(self, key, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            last = self._last.get(key)
+            if last is not None and now - last < self.interval_s:
+                return False
+            self._last[key] = now
+            return True
+
+    def forget(self, key):
+        with self._lock:
+            self._last.pop(key, None)
+
+# ============================================================================
+# المسار المضغوط
+# ============================================================================
+
+class RideTrace:
+    """
+    نقاط الرحلة كأعداد صحيحة ثابتة الفاصلة: النقطة الأولى مطلقة والباقي فروق
+    int32 في ثلاث مصفوفات (عرض، طول، ثوانٍ)؛ 12 بايت لكل نقطة.
+    """
+    __slots__ = ('origin', '_last', 'dlat', 'dlng', 'dt')
+
+    def __init__(self):
+        self.origin = None
+        self._last = None
+        self.dlat = array('i')
+        self.dlng = array('i')
+        self.dt = array('i')
+
+    def __len__(self):
+        return 0 if self.origin is None else len(self.dlat) + 1
+
+    def append(self, lat, lng, timestamp=None):
+        """إضافة نقطة (timestamp بثواني يونكس)"""
+        point = (
+            int(round(lat * COORD_SCALE)),
+            int(round(lng * COORD_SCALE)),
+            int(round(time.time() if timestamp is None else timestamp)),
+        )
+        if self.origin is None:
+            self.origin = self._last = point
+            return
+        last = self._last
+        self.dlat.append(point[0] - last[0])
+        self.dlng.append(point[1] - last[1])
+        self.dt.append(point[2] - last[2])
+        self._last = point
+        if len(self.dlat) >= TRACE_MAX_POINTS:
+            self._replace(*simplify(*self.arrays(), TRACE_TOLERANCE_M))
+
+    def arrays(self):
+        """فك الترميز إلى مصفوفات (عرض، طول، وقت)"""
+        if self.origin is None:
+            empty = np.empty(0)
+            return empty, empty, empty
+        columns = []
+        for start, deltas in zip(self.origin, (self.dlat, self.dlng, self.dt)):
+            values = np.empty(len(deltas) + 1, dtype=np.int64)
+            values[0] = start
+            np.cumsum(np.frombuffer(deltas, dtype=np.int32), out=values[1:])
+            values[1:] += start
+            columns.append(values)
+        lat, lng, ts = columns
+        return lat / COORD_SCALE, lng / COORD_SCALE, ts.astype(np.float64)
+
+    def _replace(self, lat, lng, ts):
+        """إعادة بناء المسار من مصفوفات مفكوكة"""
+        self.__init__()
+        for point in zip(lat.tolist(), lng.tolist(), ts.tolist()):
+            self.append(*point)
+
+    def distance_km(self):
+        """طول المسار بالكيلومترات"""
+        lat, lng, _ = self.arrays()
+        if lat.size < 2:
+            return 0.0
+        return float(np.sum(haversine_km(lat[:-1], lng[:-1], lat[1:], lng[1:])))
+
+    def duration_s(self):
+        """المدة بين أول نقطة وآخر نقطة"""
+        if self.origin is None:
+            return 0
+        return self._last[2] - self.origin[2]
+
+    def encode(self, tolerance_m=TRACE_TOLERANCE_M):
+        """المسار المبسط كبايتات: ترويسة int64 للنقطة الأولى ثم فروق int32 متداخلة"""
+        lat, lng, ts = simplify(*self.arrays(), tolerance_m)
+        if lat.size == 0:
+            return b''
+        fixed = np.stack([
+            np.round(lat * COORD_SCALE), np.round(lng * COORD_SCALE), ts
+        ], axis=1).astype(np.int64)
+        deltas = np.diff(fixed, axis=0).astype('<i4')
+        return _HEADER.pack(*fixed[0].tolist()) + deltas.tobytes()
+
+    @staticmethod
+    def point_count(data):
+        """عدد النقاط في بايتات encode"""
+        if not data:
+            return 0
+        return (len(data) - _HEADER.size) // 12 + 1
+
+    @staticmethod
+    def decode(data):
+        """فك بايتات encode إلى مصفوفات (عرض، طول، وقت)"""
+        if not data:
+            empty = np.empty(0)
+            return empty, empty, empty
+        first = np.array(_HEADER.unpack_from(data), dtype=np.int64)
+        deltas = np.frombuffer(data, dtype='<i4', offset=_HEADER.size).reshape(-1, 3)
+        fixed = np.vstack([first, first + np.cumsum(deltas, axis=0)])
+        return fixed[:, 0] / COORD_SCALE, fixed[:, 1] / COORD_SCALE, fixed[:, 2].astype(np.float64)
+
+def simplify(lat, lng, ts, tolerance_m):
+    """تبسيط المسار (Ramer–Douglas–Peucker) في إسقاط محلي مستوٍ بالأمتار"""
+    count = lat.size
+    if count < 3:
+        return lat, lng, ts
+    scale = 111320.0
+    y = (lat - lat[0]) * scale
+    x = (lng - lng[0]) * scale * np.cos(np.radians(lat[0]))
+    keep = np.zeros(count, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        dx, dy = x[last] - x[first], y[last] - y[first]
+        px, py = x[first + 1:last] - x[first], y[first + 1:last] - y[first]
+        length = np.hypot(dx, dy)
+        if length == 0:
+            distance = np.hypot(px, py)
+        else:
+            distance = np.abs(dx * py - dy * px) / length
+        index = int(np.argmax(distance))
+        if distance[index] > tolerance_m:
+            middle = first + 1 + index
+            keep[middle] = True
+            stack.append((first, middle))
+            stack.append((middle, last))
+    return lat[keep], lng[keep], ts[keep]